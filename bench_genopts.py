@@ -0,0 +1,195 @@
+#!/usr/bin/python
+#
+# Benchmarks how genopts.py scales with the size of the template. Synthetic
+# templates with a growing number of commands are generated in-process and
+# the time of each phase of genopts(), the size of the output and the time
+# to compile it are written as JSON.
+#
+
+from __future__ import print_function
+
+import argparse
+import collections
+import gc
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import types
+
+from StringIO import StringIO
+
+# Import only the names that are used, main() would shadow the one of genopts
+from genopts import (CBackend, DISPATCH_MODES, JavaBackend, PhaseTimings, VALIDATION_MODES, analyze, genopts,
+    parse_patterns)
+
+if False: # For MyPy
+    from typing import Any, Dict, List, Tuple
+
+################################################################################
+
+def synthetic_patterns(num_commands):
+    # type: (int) -> List[str]
+    """
+    Return the patterns of a template with the given number of commands.
+    Each command has a group of mutually exclusive options, a --[no-]
+    shortcut, an option with an argument, a global option and a positional
+    argument.
+    """
+    patterns = [] # type: List[str]
+    for k in range(num_commands):
+        patterns.append(
+            "cmd{0} [-a | --all-{0} | --none-{0}] [--[no-]check-{0}] [--output-{0} <output{0}>] [--quiet] [<file{0}>]".format(k))
+    return patterns
+
+def compile_output(source, backend):
+    # type: (str, str) -> float
+    """
+    Compile the given generated source and return the time it took, or None
+    if the compiler is not available.
+    """
+    tmpdir = tempfile.mkdtemp()
+    try:
+        if backend == 'java':
+            # The public class must reside in a file of the same name
+            filename = os.path.join(tmpdir, "CliParser.java")
+            cmd = ["javac", "-d", tmpdir, filename]
+        else:
+            filename = os.path.join(tmpdir, "cli.c")
+            cmd = ["gcc", "-c", "-O2", "-o", os.path.join(tmpdir, "cli.o"), filename]
+        with open(filename, 'w') as f:
+            f.write(source)
+        start = time.time()
+        try:
+            subprocess.check_call(cmd)
+        except OSError:
+            return None
+        return time.time() - start
+    finally:
+        for name in os.listdir(tmpdir):
+            os.remove(os.path.join(tmpdir, name))
+        os.rmdir(tmpdir)
+
+# Objects that are shared by everything rather than retained by a result
+SHARED_TYPES = (type, types.ModuleType, types.FunctionType, types.BuiltinFunctionType, types.ClassType)
+
+def retained_size(root):
+    # type: (Any) -> Tuple[int, int]
+    """
+    Return the number of objects that are reachable from the given root and
+    their total size in bytes, excluding classes, modules and functions.
+    """
+    seen = set([id(root)])
+    stack = [root]
+    objects = 0
+    size = 0
+    while len(stack) > 0:
+        obj = stack.pop()
+        objects += 1
+        size += sys.getsizeof(obj)
+        for ref in gc.get_referents(obj):
+            if id(ref) not in seen and not isinstance(ref, SHARED_TYPES):
+                seen.add(id(ref))
+                stack.append(ref)
+    return objects, size
+
+def bench_memory(num_commands, options):
+    # type: (int, Dict[str, Any]) -> Dict[str, Any]
+    """
+    Return the number and the size of the objects that the parse trees and
+    the analysis result of a synthetic template retain.
+    """
+    patterns = synthetic_patterns(num_commands)
+    trees = parse_patterns(patterns)
+    tree_objects, tree_bytes = retained_size(trees)
+    result = analyze(patterns, CBackend(), False, **options)
+    result_objects, result_bytes = retained_size(result)
+    return collections.OrderedDict([
+        ('commands', num_commands),
+        ('tokens', len(result.context.token_action_map.token_action_map)),
+        ('parse_tree_objects', tree_objects),
+        ('parse_tree_bytes', tree_bytes),
+        ('result_objects', result_objects),
+        ('result_bytes', result_bytes)])
+
+def bench(num_commands, backend, compile, options):
+    # type: (int, str, bool, Dict[str, Any]) -> Dict[str, Any]
+    """Run genopts() on a synthetic template and return the results"""
+    patterns = synthetic_patterns(num_commands)
+    result = collections.OrderedDict([('commands', num_commands)]) # type: Dict[str, Any]
+
+    out = StringIO()
+    timings = PhaseTimings()
+    start = time.time()
+    try:
+        genopts(patterns, JavaBackend() if backend == 'java' else CBackend(), False,
+                out=out, timings=timings, **options)
+    except RuntimeError as e:
+        # E.g., if the recursion limit is exceeded. Record it, as this is
+        # just what the benchmark should reveal
+        result['error'] = str(e)
+        return result
+    total = time.time() - start
+    source = out.getvalue()
+
+    result.update([
+        ('tokens', timings.counts['tokens']),
+        ('phases', timings.phases),
+        ('steps', timings.steps),
+        ('counts', timings.counts),
+        ('total', total),
+        ('lines', source.count('\n')),
+        ('bytes', len(source)),
+        ('compile', compile_output(source, backend) if compile else None)])
+    return result
+
+def main():
+    # type: () -> None
+    parser = argparse.ArgumentParser(description="Benchmark genopts.py with synthetic templates")
+    parser.add_argument('--sizes', default="10,100,1000,10000",
+        help="comma separated list of the numbers of commands (default: %(default)s)")
+    parser.add_argument('--java', action='store_true', help="benchmark the Java backend")
+    parser.add_argument('--dispatch', choices=DISPATCH_MODES, default='chain')
+    parser.add_argument('--validation', choices=VALIDATION_MODES, default='inline')
+    parser.add_argument('--scoped', action='store_true')
+    parser.add_argument('--packed-flags', action='store_true')
+    parser.add_argument('--no-compile', action='store_true', help="don't compile the generated code")
+    parser.add_argument('--memory', action='store_true',
+        help="measure the memory that the parse trees and the analysis retain instead of the time")
+    parser.add_argument('-o', '--output', help="write the JSON results to this file instead of stdout")
+    args = parser.parse_args()
+
+    backend = 'java' if args.java else 'c'
+    options = collections.OrderedDict([
+        ('dispatch', args.dispatch),
+        ('validation', args.validation),
+        ('scoped', args.scoped),
+        ('packed_flags', args.packed_flags)])
+
+    results = collections.OrderedDict([
+        ('python', platform.python_version()),
+        ('platform', platform.platform()),
+        ('time', time.strftime("%Y-%m-%dT%H:%M:%S")),
+        ('backend', backend),
+        ('options', options),
+        ('runs', [])]) # type: Dict[str, Any]
+    for size in [int(s) for s in args.sizes.split(',')]:
+        print("Benchmarking {0} commands".format(size), file=sys.stderr)
+        if args.memory:
+            results['runs'].append(bench_memory(size, options))
+        else:
+            results['runs'].append(bench(size, backend, not args.no_compile, options))
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, separators=(',', ': '))
+            f.write('\n')
+    else:
+        json.dump(results, sys.stdout, indent=2, separators=(',', ': '))
+        print()
+
+if __name__ == "__main__":
+    main()
@@ -14,13 +14,31 @@
 from __future__ import print_function
 
 import collections
+import cPickle as pickle
+import cProfile
+import filecmp
+import glob
+import hashlib
+import itertools
+import json
+import multiprocessing
+import os
+import re
+import signal
+import socket
 import sys
+import tempfile
 import textwrap
+import time
+import traceback
+import weakref
+
+from StringIO import StringIO
 
 from lib.parser import *
 
 if False: # For MyPy, see https://stackoverflow.com/questions/446052/how-can-i-check-for-python-version-in-a-program-that-uses-new-language-features
-    from typing import TypeVar
+    from typing import Any, Callable, DefaultDict, Deque, Iterable, Iterator, Sequence, TypeVar
 
     # For generic self inBlock
     T = TypeVar('T', bound='Block')
@@ -28,12 +46,16 @@ if False: # For MyPy, see https://stackoverflow.com/questions/446052/how-can-i-c
 ################################################################################
 
 class Statement(object):
+    __slots__ = ()
+
     def __init__(self):
         # type: () -> None
         pass
 
 class DirectStatement(Statement):
     """A direct statement is a statement that is put literally into the code"""
+    __slots__ = ('st',)
+
     def __init__(self, st):
         # type: (str) -> None
         self.st = st
@@ -44,16 +66,20 @@ class DirectStatement(Statement):
 
 class ExpressionStatement(Statement):
     """A statement that consist of an expression"""
+    __slots__ = ('expr',)
+
     def __init__(self, expr):
         # type: (Expression) -> None
         self.expr = expr
 
     def __repr__(self):
         # type: () -> str
-        return repr(self.expr) + ";"
+        return "{0};".format(repr(self.expr))
 
 class ReturnStatement(Statement):
     """A return statement emits an instruction to exit a function execution"""
+    __slots__ = ('expr',)
+
     def __init__(self, expr):
         # type: (Expression) -> None
         self.expr = expr
@@ -64,6 +90,8 @@ class ReturnStatement(Statement):
 
 class BreakStatement(Statement):
     """A break statement emits an instruction to leave the most inner loop quickly"""
+    __slots__ = ()
+
     def __init__(self):
         # type: () -> None
         pass
@@ -72,8 +100,22 @@ class BreakStatement(Statement):
         # type: () -> str
         return "break;"
 
+class ContinueStatement(Statement):
+    """A continue statement emits an instruction to start the next iteration of the most inner loop"""
+    __slots__ = ()
+
+    def __init__(self):
+        # type: () -> None
+        pass
+
+    def __repr__(self):
+        # type: () -> str
+        return "continue;"
+
 class PrintErrorStatement(Statement):
     """A statement to print an error message"""
+    __slots__ = ('msg', 'args')
+
     def __init__(self, msg, *args):
         # type: (str, Expression) -> None
         self.msg = msg
@@ -86,14 +128,62 @@ class PrintErrorStatement(Statement):
             args = ", " + ", ".join([repr(e) for e in self.args])
         return "fprintf(stderr, \"{0}\"{1});".format(self.msg, args)
 
+class ErrorStatement(PrintErrorStatement):
+    """
+    A statement to report an error. It is printed like a PrintErrorStatement
+    unless it is part of a reentrant function, in which case it is stored in
+    the result struct of that function instead. The arguments of the message
+    are given as templates that may refer to the {index} and {option} of the
+    error, so that the message can be formatted later on.
+    """
+    __slots__ = ('id', 'code', 'index', 'option', 'arg_templates')
+
+    def __init__(self, id, code, msg, index=None, option=None, arg_templates=None):
+        # type: (int, str, str, str, str, List[str]) -> None
+        arg_templates = arg_templates or []
+        args = [DirectExpression(a.format(index=index, option=option)) for a in arg_templates]
+        super(ErrorStatement, self).__init__(msg, *args)
+        self.id = id
+        self.code = code
+        self.index = index
+        self.option = option
+        self.arg_templates = arg_templates
+
+class SwitchStatement(DirectStatement):
+    """
+    The head of a switch statement on the given expression, the braces and
+    the cases follow as separate statements.
+    """
+    __slots__ = ('expr',)
+
+    def __init__(self, expr):
+        # type: (Expression) -> None
+        super(SwitchStatement, self).__init__("switch ({0})".format(repr(expr)))
+        self.expr = expr
+
 class IfStatement(Statement):
+    __slots__ = ('cond', 'then', 'otherwise')
+
     def __init__(self, cond, then, otherwise=None):
         # type: (Expression, ThenBlock, Block) -> None
         self.cond = cond
         self.then = then
         self.otherwise = otherwise
 
-class Expression:
+class LoopStatement(Statement):
+    """A loop with the semantics of the for loop of C"""
+    __slots__ = ('init', 'cond', 'step', 'body')
+
+    def __init__(self, init, cond, step, body):
+        # type: (Expression, Expression, Expression, Block) -> None
+        self.init = init
+        self.cond = cond
+        self.step = step
+        self.body = body
+
+class Expression(object):
+    __slots__ = ()
+
     def __lshift__(self, other):
         # type: (Union[Expression, str, int]) -> AssignmentExpression
         return AssignmentExpression(self, make_expr(other))
@@ -132,7 +222,7 @@ class Expression:
 
     def access(self, other):
         # type: (Variable) -> AccessMemberExpression
-        return AccessMemberExpression(self, repr(other))
+        return leaf(AccessMemberExpression, self, repr(other))
 
     def slice(self, index):
         # type: (Expression) -> SliceExpression
@@ -141,12 +231,14 @@ class Expression:
     def __getitem__(self, key):
         # type: (Union[int, Expression]) -> VectorElementExpression
         if isinstance(key, int):
-            expr = DirectExpression(str(key)) # type: Expression
+            expr = leaf(DirectExpression, str(key)) # type: Expression
         else:
             expr = key;
         return VectorElementExpression(self, expr)
 
 class AssignmentExpression(Expression):
+    __slots__ = ('left', 'right')
+
     def __init__(self, left, right):
         # type: (Expression, Expression) -> None
         self.left = left
@@ -154,9 +246,11 @@ class AssignmentExpression(Expression):
 
     def __repr__(self):
         # type: () -> str
-        return repr(self.left) + " = " + repr(self.right)
+        return "{0} = {1}".format(repr(self.left), repr(self.right))
 
 class BinaryExpression(Expression):
+    __slots__ = ('left', 'rel', 'right')
+
     def __init__(self, left, rel, right):
         # type: (Expression, str, Expression) -> None
         self.left = left
@@ -165,9 +259,31 @@ class BinaryExpression(Expression):
 
     def __repr__(self):
         # type: () -> str
-        return '(' + repr(self.left) + ') ' + self.rel + ' (' + repr(self.right) + ')'
+        if is_atom(self.left, self.rel) and is_atom(self.right, None):
+            return "{0} {1} {2}".format(repr(self.left), self.rel, repr(self.right))
+        return "({0}) {1} ({2})".format(repr(self.left), self.rel, repr(self.right))
+
+def is_atom(expr, rel):
+    # type: (Expression, str) -> bool
+    """
+    Return whether the given operand is written without parentheses, i.e.,
+    a member access or its negation, or a chain of the given operator over
+    such operands, e.g., the left one of a + b + c. Literals are atoms only
+    as the right operand, for which rel is None.
+    """
+    if isinstance(expr, AccessMemberExpression):
+        return True
+    if isinstance(expr, IsFalseExpression):
+        return is_atom(expr.expr, '!')
+    if isinstance(expr, DirectExpression):
+        return rel is None and re.match(r'^\w+$', expr.expr) is not None
+    if isinstance(expr, BinaryExpression):
+        return expr.rel == rel == '+' and is_atom(expr.left, rel) and is_atom(expr.right, None)
+    return False
 
 class SliceExpression(Expression):
+    __slots__ = ('expr', 'start_index')
+
     def __init__(self, expr, start_index):
         # type: (Expression, Expression) -> None
         self.expr = expr
@@ -175,9 +291,11 @@ class SliceExpression(Expression):
 
     def __repr__(self):
         # type: () -> str
-        return '&' + repr(self.expr) + '[' + repr(self.start_index) + ']'
+        return "&{0}[{1}]".format(repr(self.expr), repr(self.start_index))
 
 class DirectExpression(Expression):
+    __slots__ = ('expr', '__weakref__')
+
     def __init__(self, expr):
         # type: (str) -> None
         self.expr = expr
@@ -186,6 +304,26 @@ class DirectExpression(Expression):
         # type: () -> str
         return self.expr
 
+# The table of leaf expressions and variable references by their class and
+# arguments, see leaf(). Entries vanish with the last reference to them
+leaf_expressions = weakref.WeakValueDictionary() # type: weakref.WeakValueDictionary
+
+def leaf(cls, *args):
+    # type: (Callable[..., Expression], *Any) -> Any
+    """
+    Return the expression of the given class that is constructed from the
+    given arguments, sharing an identical one if it exists, i.e., the
+    expression must not be modified afterwards. Expressions are compared by
+    their class and arguments, the latter by identity if they are
+    expressions themselves.
+    """
+    key = (cls,) + args
+    expr = leaf_expressions.get(key)
+    if expr is None:
+        expr = cls(*args)
+        leaf_expressions[key] = expr
+    return expr
+
 def make_expr(expr):
     # type: (Union[str, int, Expression]) -> Expression
     if expr is None:
@@ -193,9 +331,11 @@ def make_expr(expr):
     if isinstance(expr, Expression):
         return expr
     else:
-        return DirectExpression(str(expr))
+        return leaf(DirectExpression, str(expr))
 
 class AccessMemberExpression(Expression):
+    __slots__ = ('obj', 'member', '__weakref__')
+
     def __init__(self, obj, member):
         # type: (Expression, str) -> None
         self.obj = obj
@@ -203,22 +343,26 @@ class AccessMemberExpression(Expression):
 
     def __repr__(self):
         # type: () -> str
-        return repr(self.obj) + "->" + self.member
+        return "{0}->{1}".format(repr(self.obj), self.member)
 
 def AccessMember(obj, member):
     # type: (Union[str, Expression], str) -> AccessMemberExpression
-    return AccessMemberExpression(make_expr(obj), member)
+    return leaf(AccessMemberExpression, make_expr(obj), member)
 
 class IsFalseExpression(Expression):
+    __slots__ = ('expr',)
+
     def __init__(self, expr):
         # type: (Expression) -> None
         self.expr = expr
 
     def __repr__(self):
         # type: () -> str
-        return "!"  + repr(self.expr)
+        return "!{0}".format(repr(self.expr))
 
 class EqualsStrExpression(Expression):
+    __slots__ = ('arg1', 'arg2')
+
     def __init__(self, arg1, arg2):
         # type: (Expression, Expression) -> None
         self.arg1 = arg1
@@ -228,11 +372,45 @@ class EqualsStrExpression(Expression):
         # type: () -> str
         return "!strcmp({0}, {1})".format(repr(self.arg1), repr(self.arg2))
 
+class LogicalExpression(Expression):
+    """
+    The conjunction (&&) or disjunction (||) of the operands, which are
+    evaluated from left to right until the result is known.
+    """
+    __slots__ = ('op', 'operands')
+
+    def __init__(self, op, operands):
+        # type: (str, Sequence[Expression]) -> None
+        self.op = op
+        self.operands = operands
+
+    def __repr__(self):
+        # type: () -> str
+        other = '||' if self.op == '&&' else '&&'
+        operands = [] # type: List[str]
+        for o in self.operands:
+            text = repr(o)
+            operands.append("(" + text + ")" if other in text else text)
+        return " {0} ".format(self.op).join(operands)
+
+def Or(*exprs):
+    # type: (*Expression) -> LogicalExpression
+    """Return the disjunction of the given expressions, merging nested ones"""
+    operands = [] # type: List[Expression]
+    for e in exprs:
+        if isinstance(e, LogicalExpression) and e.op == '||':
+            operands.extend(e.operands)
+        else:
+            operands.append(e)
+    return LogicalExpression('||', operands)
+
 def IsFalse(expr):
     # type: (Union[str, Expression]) -> IsFalseExpression
     return IsFalseExpression(make_expr(expr))
 
 class Variable(Expression):
+    __slots__ = ('name', 'vtype', 'init', '__weakref__')
+
     def __init__(self, name, vtype, init = None):
         # type: (str, str, Union[Expression,str]) -> None
         self.name = name
@@ -247,6 +425,8 @@ class Variable(Expression):
 V = Variable
 
 class VectorElementExpression(Expression):
+    __slots__ = ('expr', 'element')
+
     def __init__(self, expr, element):
         # type: (Expression, Expression) -> None
         self.expr = expr
@@ -254,29 +434,35 @@ class VectorElementExpression(Expression):
 
     def __repr__(self):
         # type: () -> str
-        return repr(self.expr) + "[" + repr(self.element) + "]"
+        return "{0}[{1}]".format(repr(self.expr), repr(self.element))
 
 class PostIncrementExpression(Expression):
+    __slots__ = ('expr',)
+
     def __init__(self, expr):
         # type: (Expression) ->None
         self.expr = expr
 
     def __repr__(self):
         # type: () -> str
-        return repr(self.expr) + "++"
+        return "{0}++".format(repr(self.expr))
 
 class PostDecrementExpression(Expression):
+    __slots__ = ('expr',)
+
     def __init__(self, expr):
         # type: (Expression) ->None
         self.expr = expr
 
     def __repr__(self):
         # type: () -> str
-        return repr(self.expr) + "--"
+        return "{0}--".format(repr(self.expr))
 
 
-class Variables:
+class Variables(object):
     """An abstraction of run time variabels needed during parsing."""
+    __slots__ = ('variables', 'name')
+
     def __init__(self, name = None):
         # type: (str) -> None
         self.variables = dict() # type: Dict[str, Variable]
@@ -297,12 +483,32 @@ class Variables:
         return self.variables[key]
 
 class Block(object):
+    __slots__ = ('level', 'generated_code', '_locals')
+
     def __init__(self):
         # type: ()->None
         # Stores the indendation level
         self.level = 0 # type: int
         self.generated_code = [] # type: List[Union[Function, Block, Statement]]
-        self.locals = Variables()
+        # Most blocks have no local variables, see locals
+        self._locals = None # type: Variables
+
+    @property
+    def locals(self):
+        # type: () -> Variables
+        """The local variables of the block, which are created on demand"""
+        if self._locals is None:
+            self._locals = Variables()
+        return self._locals
+
+    @locals.setter
+    def locals(self, locals):
+        # type: (Variables) -> None
+        self._locals = locals
+
+    def has_locals(self):
+        # type: () -> bool
+        return self._locals is not None and len(self._locals.variables) > 0
 
     def add(self, node):
         # type: (T, Union[str, Function, Block, Statement, Expression]) -> T
@@ -346,11 +552,24 @@ class Block(object):
         self.add(if_then_else)
         return if_then_else
 
+    def loop(self, init, cond, step):
+        # type: (Union[str,Expression], Union[str,Expression], Union[str,Expression]) -> Block
+        """Add a loop like the for loop of C and return its body"""
+        body = Block()
+        self.add(LoopStatement(make_expr(init), make_expr(cond), make_expr(step), body))
+        return body
+
     def brk(self):
         # type: () -> None
         self.add(BreakStatement())
 
+    def cont(self):
+        # type: () -> None
+        self.add(ContinueStatement())
+
 class ThenBlock(Block):
+    __slots__ = ('otherwise_block',)
+
     def __init__(self, otherwise_block):
         # type: (Block) -> None
         super(ThenBlock, self).__init__()
@@ -361,6 +580,8 @@ class ThenBlock(Block):
         return self.otherwise_block
 
 class Function(Block):
+    __slots__ = ('name', 'output', 'input', 'description', 'result')
+
     def __init__(self, name, output , input):
         # type: (str, str, List[Variable]) -> None
         super(Function, self).__init__()
@@ -369,31 +590,136 @@ class Function(Block):
         self.input = input
         self.description = None # type: str
 
+        # If set, errors are stored in this variable rather than printed
+        self.result = None # type: Variable
+
+    def reentrant(self, result):
+        # type: (Variable) -> Function
+        """
+        Return a variant of this function that shares the code but stores
+        errors into the given result rather than printing them.
+        """
+        f = Function(self.name + "_r", self.output, self.input + [result])
+        f.generated_code = self.generated_code
+        f.locals = self.locals
+        f.result = result
+        return f
+
+class ConstArray(object):
+    """
+    A constant array that is defined at file scope. If columns is given, the
+    array is two-dimensional and each row must initialize that many columns.
+    """
+    def __init__(self, name, vtype, rows, columns=None):
+        # type: (str, str, List[str], int) -> None
+        self.name = name
+        self.vtype = vtype
+        self.rows = rows
+        self.columns = columns
+
+class Enum(object):
+    """An enumeration of named integer constants that is defined at file scope"""
+    def __init__(self, name, fields):
+        # type: (str, List[Tuple[str,int]]) -> None
+        self.name = name
+        self.fields = fields
+
+class Macro(object):
+    """A preprocessor macro that is defined at file scope"""
+    def __init__(self, name, body):
+        # type: (str, str) -> None
+        self.name = name
+        self.body = body
+
 ################################################################################
 
+# The number of lines that GenFile collects before writing them at once
+GENFILE_BUFFER_LINES = 1024
+
 class GenFile(object):
-    def __init__(self, f=sys.stdout):
-        # type: (IO[str])->None
+    """
+    A file to which the generated code is written line by line. Lines are
+    written to the underlying file in bulk, so only the lines of the current
+    buffer are kept in memory. Call flush() to write the remaining ones.
+    """
+    def __init__(self, f=None):
+        # type: (Union[IO[str], AtomicFile])->None
+        if f is None:
+            f = sys.stdout
         self.f = f
         # Stores the indendation level
         self.level = 0 # type: int
-        self.generated_code = [] # type: List[str]
+        self.buffer = [] # type: List[str]
+        # The number of lines that have been written
+        self.lines = 0 # type: int
 
     def writeline(self, str=""):
         # type: (str)->None
+        self.lines += 1
         if len(str) == 0:
-            self.generated_code.append('')
-            return
-        if str.startswith('}'):
-            self.level = self.level - 1;
-        self.generated_code.append('\t' * self.level + str)
-        if str == '{':
-            self.level = self.level + 1
+            self.buffer.append('\n')
+        else:
+            if str.startswith('}'):
+                self.level = self.level - 1;
+            self.buffer.append('\t' * self.level + str + '\n')
+            if str == '{':
+                self.level = self.level + 1
+        if len(self.buffer) >= GENFILE_BUFFER_LINES:
+            self.write_buffer()
+
+    def write_buffer(self):
+        # type: () -> None
+        """Write the buffered lines to the file"""
+        self.f.write(''.join(self.buffer))
+        self.buffer = []
 
     def flush(self):
         # type: () -> None
-        for l in self.generated_code:
-            print(l, file=self.f)
+        self.write_buffer()
+        self.f.flush()
+
+class AtomicFile(object):
+    """
+    A file that replaces the file at the given path only once it is
+    committed, i.e., readers see either the previous or the complete new
+    contents. The contents are written to a temporary file in the same
+    directory, which is renamed on commit and removed on discard. If the
+    file already has the same contents, it is not touched at all, so tools
+    like make don't consider it as modified.
+    """
+    def __init__(self, path, mode='w'):
+        # type: (str, str) -> None
+        self.path = path
+        fd, self.tmp_path = tempfile.mkstemp(prefix="." + os.path.basename(path) + ".",
+            dir=os.path.dirname(os.path.abspath(path)))
+        self.f = os.fdopen(fd, mode)
+
+    def write(self, str):
+        # type: (str) -> None
+        self.f.write(str)
+
+    def flush(self):
+        # type: () -> None
+        self.f.flush()
+
+    def commit(self):
+        # type: () -> bool
+        """Replace the file, returns whether it has been modified"""
+        self.f.close()
+        if os.path.isfile(self.path) and filecmp.cmp(self.tmp_path, self.path, shallow=False):
+            os.remove(self.tmp_path)
+            return False
+        # mkstemp() creates the file only accessible by the owner
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(self.tmp_path, 0o666 & ~umask)
+        os.rename(self.tmp_path, self.path)
+        return True
+
+    def discard(self):
+        # type: () -> None
+        self.f.close()
+        os.remove(self.tmp_path)
 
 ################################################################################
 
@@ -427,49 +753,112 @@ class Visitor:
         # type: (Arg)->None
         pass
 
+class CompositeVisitor(Visitor):
+    """
+    Visitor that forwards each call to all of the given visitors in turn, so
+    that they can share a single navigation through the hierarchy. Calls are
+    only forwarded to the visitors that override the respective method.
+    """
+    def __init__(self, visitors):
+        # type: (List[Visitor]) -> None
+        for name in ['enter_template', 'leave_template', 'enter_pattern', 'leave_pattern',
+                'enter_optional', 'leave_optional', 'visit_command', 'visit_option_with_arg', 'visit_arg']:
+            default = getattr(Visitor, name)
+            methods = [getattr(v, name) for v in visitors if name in v.__dict__ or getattr(v.__class__, name) != default]
+            setattr(self, name, composite_method(methods))
+
+def composite_method(methods):
+    # type: (List[Callable[[Any], None]]) -> Callable[[Any], None]
+    """Return a function that calls all of the given methods with its argument"""
+    if len(methods) == 1:
+        return methods[0]
+    def call_all(n):
+        # type: (Any) -> None
+        for m in methods:
+            m(n)
+    return call_all
+
+def navigate_template(n, visitor):
+    # type: (Template, Visitor) -> None
+    visitor.enter_template(n)
+    for t in n.list:
+        navigate(t, visitor)
+    visitor.leave_template(n)
+
+def navigate_pattern(n, visitor):
+    # type: (Pattern, Visitor) -> None
+    visitor.enter_pattern(n)
+    for c in n.list:
+        navigate(c, visitor)
+    visitor.leave_pattern(n)
+
+def navigate_optional(n, visitor):
+    # type: (Optional, Visitor) -> None
+    visitor.enter_optional(n)
+    for a in n.list:
+        navigate(a, visitor)
+    visitor.leave_optional(n)
+
+def navigate_command(n, visitor):
+    # type: (Command, Visitor) -> None
+    visitor.visit_command(n)
+    for o in n.options:
+        navigate(o, visitor)
+    if n.subcommand is not None:
+        navigate(n.subcommand, visitor)
+
+def navigate_option_with_arg(n, visitor):
+    # type: (OptionWithArg, Visitor) -> None
+    visitor.visit_option_with_arg(n)
+
+def navigate_arg(n, visitor):
+    # type: (Arg, Visitor) -> None
+    visitor.visit_arg(n)
+
+# Maps the classes of the hierarchy to the function that navigates them
+NAVIGATORS = {
+    Template: navigate_template,
+    Pattern: navigate_pattern,
+    Optional: navigate_optional,
+    Command: navigate_command,
+    OptionWithArg: navigate_option_with_arg,
+    Arg: navigate_arg
+    } # type: Dict[Any, Callable[[Any, Visitor], None]]
+
 # Similar to accept() but does implement the naviation
 # in a monolitic fashion
 def navigate(n, visitor):
     # type: (Union[Template, Pattern, Command, Optional, Arg, OptionWithArg], Visitor) -> None
     """
-    Navigate through the hierarchy starting at n and call the visitor
-    """
-    if isinstance(n, Template):
-        visitor.enter_template(n)
-        for t in n.list:
-            navigate(t, visitor)
-        visitor.leave_template(n)
-    if isinstance(n, Pattern):
-        visitor.enter_pattern(n)
-        for c in n.list:
-            navigate(c, visitor)
-        visitor.leave_pattern(n)
-    elif isinstance(n, Optional):
-        visitor.enter_optional(n)
-        for a in n.list:
-            navigate(a, visitor)
-        visitor.leave_optional(n)
-    elif isinstance(n, Command):
-        visitor.visit_command(n)
-        for o in n.options:
-            navigate(o, visitor)
-        if n.subcommand is not None:
-            navigate(n.subcommand, visitor)
-    elif isinstance(n, OptionWithArg):
-        visitor.visit_option_with_arg(n)
-    elif isinstance(n, Arg):
-        visitor.visit_arg(n)
+    Navigate through the hierarchy starting at n and call the visitor. Pass
+    a CompositeVisitor to call several visitors during one navigation.
+    """
+    nav = NAVIGATORS.get(n.__class__)
+    if nav is None:
+        # A subclass is navigated like its nearest base, which is remembered
+        # for further nodes of the same class
+        for base in n.__class__.__mro__[1:]:
+            if base in NAVIGATORS:
+                nav = NAVIGATORS[n.__class__] = NAVIGATORS[base]
+                break
+    if nav is not None:
+        nav(n, visitor)
 
 ################################################################################
 
 class GenerateMXValidatorVisitor(Visitor):
     """
-    Visitor to generate code for validation of multual exclusions.
+    Visitor to generate code for validation of multual exclusions. If no
+    block is given, the groups of mutual exclusive options are only recorded
+    and the code is generated by a later call to write(), e.g., if the
+    visitor shares the navigation with visitors that the code depends on.
     """
-    def __init__(self, b):
-        # type: (Block) -> None
+    def __init__(self, b, context=None):
+        # type: (Block, GeneratorContext) -> None
         self.cmds = [] # type: List[OptionWithArg]
+        self.groups = [] # type: List[List[OptionWithArg]]
         self.b = b
+        self.context = context
 
     def enter_optional(self, n):
         # type: (Optional) -> None
@@ -480,11 +869,43 @@ class GenerateMXValidatorVisitor(Visitor):
         if len(self.cmds) < 2:
             return
 
-        conds = DirectExpression(" + ".join("!!cli->{0}".format(makename(cmd)) for cmd in self.cmds))
-        opts = [cmd.command for cmd in self.cmds]
-        self.b.iff(conds > 1).then. \
-            printerr("Only one of {0} may be given\\n".format(join_enum(opts, "or"))). \
-            ret(0)
+        self.groups.append(self.cmds)
+        if self.b is not None:
+            self.write_group(self.b, self.cmds)
+
+    def write(self, b):
+        # type: (Block) -> None
+        """Write the validation of all recorded groups to the given block"""
+        for cmds in self.groups:
+            self.write_group(b, cmds)
+
+    def write_group(self, b, cmds):
+        # type: (Block, List[OptionWithArg]) -> None
+        names = [makename(cmd) for cmd in cmds]
+        if self.context is not None and self.context.packed_flags:
+            mask = self.context.flags_mask(names)
+            if mask is not None:
+                # More than one bit is set if clearing the lowest one leaves some
+                masked = "(cli->flags[{0}] & 0x{1:x}UL)".format(mask[0], mask[1])
+                conds = DirectExpression("{0} & ({0} - 1)".format(masked)) # type: Expression
+            else:
+                conds = DirectExpression(" + ".join("!!{0}".format(self.context.cli_field(name)) for name in names)) > 1
+        else:
+            conds = DirectExpression(" + ".join("!!cli->{0}".format(name) for name in names)) > 1
+        opts = [cmd.command for cmd in cmds]
+        msg = "Only one of {0} may be given\\n".format(join_enum(opts, "or"))
+        if self.context is not None:
+            option = str(self.context.option_id(cmds[0].command))
+            b.iff(conds).then. \
+                add(self.context.error('CLI_ERR_EXCLUSIVE', msg, option=option)). \
+                ret(0)
+        else:
+            b.iff(conds).then.printerr(msg).ret(0)
+
+    def group_names(self):
+        # type: () -> List[List[str]]
+        """Return the field names of the options of each recorded group"""
+        return [[makename(cmd) for cmd in cmds] for cmds in self.groups]
 
     def visit_option_with_arg(self, n):
         # type: (OptionWithArg) -> None
@@ -520,23 +941,172 @@ def join_enum(list, conjunction):
 
     return ", ".join(list[:-1]) + ", " + conjunction + " " + list[-1]
 
-def write_command_validation(b, command_index_map, parent_map, option_with_args):
-    # type: (Block, CommandIndexMap, ParentMap, List[OptionWithArg]) -> None
+def write_command_tracking(context, option_with_args):
+    # type: (GeneratorContext, List[OptionWithArg]) -> None
+    """
+    Record the current command when one of the given options is parsed, so
+    validate_cli() can check that it was given for a proper command.
+    """
+    cur_command_var = context.cur_command_var
+    for n in option_with_args:
+        if context.validation == 'table':
+            context.token_action_map.add(n.command, context.option_cmd_access(n.command) << cur_command_var)
+        else:
+            cur_command_name = makename(n) + "_cmd"
+            context.cmd_fields.append(cur_command_name)
+            context.token_action_map.add(n.command, context.aux_access(cur_command_name, "int") << cur_command_var)
+
+def write_global_option_tracking(context, option_with_args):
+    # type: (GeneratorContext, List[OptionWithArg]) -> None
+    """
+    Record the given options, which every command accepts, only if they are
+    given before any command. Instead of a field for each option, they share
+    one that holds the id of such an option plus one. The name of the option
+    is looked up by its id in cli_global_option_names.
+    """
+    if len(option_with_args) == 0:
+        return
+
+    ids = [context.option_id(n.command) for n in option_with_args]
+    names = ['NULL'] * (max(ids) + 1)
+    for id, n in zip(ids, option_with_args):
+        names[id] = '"{0}"'.format(n.command)
+        context.token_action_map.add(n.command).iff("{0} < 0".format(context.cur_command_var.name)).then. \
+            add(context.aux_access("global_option", "int") << id + 1)
+    context.helpers.append(ConstArray("cli_global_option_names", "char * const", names))
+
+def write_positional_resolution(b, context, args, optional_args):
+    # type: (Block, GeneratorContext, List[Arg], Set[str]) -> None
+    """
+    Write the assignment of the given positional arguments, some of which
+    are optional, by a switch on the number of arguments that were given.
+    The required arguments are assigned first, the remaining given ones are
+    assigned to the optional arguments from left to right.
+    """
+    given = IsFalse(IsFalse(context.aux_access("positional0"))) # type: Expression
+    for pos in range(1, len(args)):
+        given = given + IsFalse(IsFalse(context.aux_access("positional{0}".format(pos))))
+    b.add(SwitchStatement(given))
+    b.add("{")
+    required = len([a for a in args if a.command not in optional_args])
+    for count in range(1, len(args)):
+        case = Block()
+        # The number of optional arguments that were given
+        optional = count - required
+        pos = 0
+        for a in args:
+            if a.command in optional_args:
+                if optional <= 0:
+                    continue
+                optional -= 1
+            if pos < count:
+                case.add(context.cli_access(makecname(a.command)) << context.aux_access("positional{0}".format(pos)))
+                pos += 1
+        case.brk()
+        b.add("case {0}:".format(count))
+        b.add(case)
+    # All or none of the arguments were given
+    case = Block()
+    for pos, a in enumerate(args):
+        case.add(context.cli_access(makecname(a.command)) << context.aux_access("positional{0}".format(pos)))
+    case.brk()
+    b.add("default:")
+    b.add(case)
+    b.add("}")
+
+def write_command_validation(b, context, option_with_args):
+    # type: (Block, GeneratorContext, List[OptionWithArg]) -> None
+    command_index_map = context.command_index_map
+    parent_map = context.parent_map
     for n in option_with_args:
         name = makename(n)
         cur_command_name = name + "_cmd"
         parents = parent_map.parents_of_option(n)
-        parent_names = [p.command for p in parents if p is not None]
         parent_indices = [command_index_map.map(p) for p in parents]
 
         # Make list of conditions
-        conds = ["aux->{0} != {1}".format(cur_command_name, pi) for pi in set(parent_indices)]
+        cur_command = context.aux_access(cur_command_name)
+        conds = [cur_command.ne(0)]
+        conds += [cur_command.ne(pi) for pi in set(parent_indices)]
+        b.iff(LogicalExpression('&&', conds)).then. \
+            add(context.wrong_command_error(n.command)). \
+            ret(0)
+
+def write_global_option_validation(b, context, option_with_args):
+    # type: (Block, GeneratorContext, List[OptionWithArg]) -> None
+    """
+    Write the check that none of the given options, which every command
+    accepts, was given before the first command.
+    """
+    if len(option_with_args) == 0:
+        return
+
+    # All of the options share the same commands
+    msg = "Option %s may be given only for the {0}\\n".format(context.valid_commands_text(option_with_args[0].command))
+    option = b.locals.add('option', 'int', context.aux_access("global_option"))
+    b.iff("option != 0").then. \
+        add(context.error('CLI_ERR_WRONG_COMMAND', msg, option="option - 1",
+            arg_templates=["cli_global_option_names[{option}]"])). \
+        ret(0)
+
+def write_command_validation_table(b, context, option_with_args):
+    # type: (Block, GeneratorContext, List[OptionWithArg]) -> None
+    """
+    Write the validation of the commands under which the options were given
+    as a loop over tables. For each option, a bitmask of the indices of the
+    valid commands and the text for the error message is emitted.
+    """
+    if len(option_with_args) == 0:
+        return
+
+    command_index_map = context.command_index_map
+    parent_map = context.parent_map
+
+    # The number of words that are needed to store a bit for each command index
+    words = (command_index_map.cur_num - 1) // 32 + 1
+
+    masks = [''] * len(option_with_args)
+    names = [''] * len(option_with_args)
+    text_ids = [''] * len(option_with_args)
+    texts = collections.OrderedDict() # type: Dict[str, int]
+
+    for n in option_with_args:
+        id = context.option_id(n.command)
+        parents = parent_map.parents_of_option(n)
+        parent_names = [p.command for p in parents if p is not None]
+        parent_indices = [command_index_map.map(p) for p in parents]
+
+        mask = [0] * words
+        for pi in parent_indices:
+            mask[pi // 32] |= 1 << (pi % 32)
+        masks[id] = "{{ {0} }}".format(", ".join("0x{0:x}UL".format(m) for m in mask))
+
         valid_commands = ['\\"' + vc + '\\"' for vc in parent_names]
         valid_commands_text = join_enum(sorted(set(valid_commands)), "and") + " command"
+        if valid_commands_text not in texts:
+            texts[valid_commands_text] = len(texts)
 
-        b.iff(cond="aux->{0} != 0 && {1}".format(cur_command_name, " && ".join(conds))).then. \
-            printerr("Option {0} may be given only for the {1}\\n".format(n.command, valid_commands_text)). \
-            ret(0)
+        names[id] = '"{0}"'.format(n.command)
+        text_ids[id] = str(texts[valid_commands_text])
+
+    context.helpers.append(ConstArray("cli_option_commands", "unsigned long", masks, words))
+    context.helpers.append(ConstArray("cli_option_names", "char * const", names))
+    context.helpers.append(ConstArray("cli_option_texts", "int", text_ids))
+    context.helpers.append(ConstArray("cli_command_texts", "char * const", ['"{0}"'.format(t) for t in texts]))
+
+    k = b.locals.add('k', 'int')
+    c = b.locals.add('c', 'int')
+    body = b.loop("k=0", "k < {0}".format(len(option_with_args)), "k++")
+    body.add(c << context.aux_arg_var.access(V('option_cmd', 'int'))[k])
+    body.iff("c == 0").then.cont()
+
+    # Options that were given before any command are recorded with -1
+    body.iff("c < 0").then.add("c = 1;")
+
+    body.iff("!(cli_option_commands[k][c >> 5] & (1UL << (c & 31)))").then. \
+        add(context.error('CLI_ERR_WRONG_COMMAND', "Option %s may be given only for the %s\\n", option="k",
+            arg_templates=["cli_option_names[{option}]", "cli_command_texts[cli_option_texts[{option}]]"])). \
+        ret(0)
 
 ################################################################################
 
@@ -585,6 +1155,20 @@ def makecname(str):
     str = str.replace("-", "_")
     return str.lstrip("_")
 
+def flag_const(name):
+    # type: (str)->str
+    """Return the name of the constant that identifies the given packed flag"""
+    return "CLI_FLAG_" + name
+
+def smallest_int_type(min_value, max_value):
+    # type: (int, int)->str
+    """Return the smallest signed C integer type that holds the given range"""
+    if min_value >= -128 and max_value <= 127:
+        return "signed char"
+    if min_value >= -32768 and max_value <= 32767:
+        return "short"
+    return "int"
+
 def makename(o):
     # type: (Union[Command,OptionWithArg])->str
     """
@@ -638,6 +1222,16 @@ class ParentMap:
             return self.parents[name]
         return []
 
+    def is_global(self, option_with_arg, commands):
+        # type: (OptionWithArg, Iterable[str]) -> bool
+        """
+        Return whether the given option may be given for each of the given
+        commands, so its command need not be tracked. It still must not
+        precede the first command.
+        """
+        names = set(p.command for p in self.parents_of_option(option_with_arg) if p is not None)
+        return all(c in names for c in commands)
+
 class CommandIndexMap:
     """Instances of this class provide a numeric index to a given command"""
     def __init__(self):
@@ -688,9 +1282,97 @@ class TokenActionMap:
         return self.token_action_map[token]
 
     def write(self, b):
-        # type: (Block) -> None
+        # type: (Block) -> bool
+        """
+        Write the dispatching of all tokens to the given block. Returns True if
+        the block does not end with an open if/else if chain, i.e., if the
+        caller must start a new chain.
+        """
         sorted_tokens = sorted([t for t in self.token_action_map])
 
+        if self.context.scoped:
+            self.write_scoped(b, sorted_tokens)
+            return True
+
+        if self.context.dispatch == 'chain':
+            self.write_chain(b, sorted_tokens)
+            return False
+
+        self.write_tokens(b, sorted_tokens)
+        return True
+
+    def write_tokens(self, b, sorted_tokens, suffix=""):
+        # type: (Block, List[str], str) -> None
+        """
+        Write the given tokens using the dispatch mode of the context. Each
+        matched token continues the argument loop. The suffix is appended to
+        the names of helpers that are needed for the dispatching.
+        """
+        if self.context.dispatch == 'hash':
+            self.write_perfect_hash(b, sorted_tokens, suffix)
+        elif self.context.dispatch == 'trie':
+            self.write_trie(b, sorted_tokens, 0)
+        else:
+            self.write_chain(b, sorted_tokens, True)
+
+    def scopes_of_token(self, token):
+        # type: (str) -> Set[int]
+        """
+        Return the indices of the commands under which the given token may
+        appear. An empty set means that the token is valid everywhere.
+        """
+        if token not in self.context.parent_map.parents:
+            return set()
+        return set(self.context.command_index_map.map_list(self.context.parent_map.parents[token]))
+
+    def write_scoped(self, b, sorted_tokens):
+        # type: (Block, List[str]) -> None
+        """
+        Write the tokens such that only those that are valid for the current
+        command are tested, i.e., a dispatcher for the global tokens followed
+        by a switch on the current command that selects the dispatcher of
+        that command.
+        """
+        global_tokens = [] # type: List[str]
+        scoped_tokens = collections.defaultdict(list) # type: Dict[int, List[str]]
+        for token in sorted_tokens:
+            scopes = self.scopes_of_token(token)
+            if len(scopes) == 0:
+                global_tokens.append(token)
+            for scope in scopes:
+                scoped_tokens[scope].append(token)
+
+        if len(global_tokens) != 0:
+            self.write_tokens(b, global_tokens)
+
+        b.add(SwitchStatement(self.context.cur_command_var))
+        b.add("{")
+        for scope in sorted(scoped_tokens):
+            case = Block()
+            self.write_tokens(case, scoped_tokens[scope], "_{0}".format(scope))
+            case.brk()
+            b.add("case {0}:".format(scope))
+            b.add(case)
+        b.add("}")
+
+        # Options of other commands are reported instead of being taken as
+        # positional arguments. Other arguments that start with '-', e.g.,
+        # "-" for stdin, are left to the positional arguments as without scopes
+        misplaced_tokens = [token for token in sorted_tokens if token.startswith('-') and len(self.scopes_of_token(token)) != 0]
+        if len(misplaced_tokens) == 0:
+            return
+        misplaced = b.iff(make_expr("argv[i][0] == '-'")).then
+        for token in misplaced_tokens:
+            misplaced.iff(self.context.backend.argv(self.context.i_var).eq_str(token)).then. \
+                add(self.context.wrong_command_error(token)). \
+                ret(0)
+
+    def write_chain(self, b, sorted_tokens, cont=False):
+        # type: (Block, List[str], bool) -> None
+        """
+        Write the tokens as a chain of if/else if string comparisons. If cont
+        is set, each matched token continues the argument loop.
+        """
         then = None # type: ThenBlock
         first = True
         argv = self.context.backend.argv
@@ -704,13 +1386,240 @@ class TokenActionMap:
 
             if token in self.token_requires_arg:
                 token_len = len(token)
-                then = parent_b.iff(make_expr('!strncmp("{0}", argv[i], {1}) && (argv[i][{1}]==\'=\' || !argv[i][{1}])'.format(token, token_len - 1 ))).then
+                then = parent_b.iff(make_expr('!strncmp("{0}", argv[i], {1}) && (argv[i][{1}]==\'=\' || !argv[i][{1}])'.format(token, token_len))).then
             else:
                 then = parent_b.iff(argv(i).eq_str(token)).then
 
             for s in self.token_action_map[token].generated_code:
                 then.add(s)
+            if cont:
+                then.cont()
+
+    def write_perfect_hash(self, b, sorted_tokens, suffix=""):
+        # type: (Block, List[str], str) -> None
+        """
+        Write the tokens as a single lookup in a perfect hash table followed by
+        a switch on the token id. Each case continues the argument loop, the
+        positional arguments are to be handled after the switch.
+        """
+        seeds, slots = perfect_hash(sorted_tokens)
+
+        rows = [] # type: List[str]
+        for id in slots:
+            if id == -1:
+                rows.append("{ -1, NULL, 0 }")
+            else:
+                token = sorted_tokens[id]
+                rows.append('{{ {0}, "{1}", {2} }}'.format(id, token, 1 if token in self.token_requires_arg else 0))
+
+        self.context.add_token_type()
+        table_name = "cli_tokens" + suffix
+        seeds_name = "cli_token_seeds" + suffix
+        self.context.helpers.append(ConstArray(seeds_name, "unsigned long", ["{0}UL".format(seed) for seed in seeds]))
+        self.context.helpers.append(ConstArray(table_name, "struct cli_token", rows))
+
+        arg_var = V('arg', 'const char *')
+        lookup = Function(
+            output="static int",
+            name="lookup_cli_token" + suffix,
+            input=[arg_var])
+        lookup.description = """
+            Lookup the given argument in the perfect hash table of the tokens.
+
+            @return the id of the token or -1 if the argument is not a token.
+            """
+        lookup.locals.add('h', 'unsigned long', '{0}UL'.format(FNV_OFFSET_BASIS))
+        lookup.locals.add('n', 'int', '0')
+        lookup.locals.add('k', 'int')
+        lookup.locals.add('t', 'const struct cli_token *')
+
+        # First hash determines the bucket and thus the seed of the second one
+        lookup.add("while (arg[n] && arg[n] != '=')")
+        lookup.add("{")
+        lookup.add("h = ((h ^ (unsigned char)arg[n]) * {0}UL) & 0xffffffffUL;".format(FNV_PRIME))
+        lookup.add("n++;")
+        lookup.add("}")
+        write_mix_hash(lookup)
+        lookup.add("h = {0}[h & {1}];".format(seeds_name, len(seeds) - 1))
+        lookup.add("for (k=0; k < n; k++)")
+        lookup.add("{")
+        lookup.add("h = ((h ^ (unsigned char)arg[k]) * {0}UL) & 0xffffffffUL;".format(FNV_PRIME))
+        lookup.add("}")
+        write_mix_hash(lookup)
+        lookup.add("t = &{0}[h & {1}];".format(table_name, len(slots) - 1))
+        lookup.iff("!t->name || strncmp(t->name, arg, n) || t->name[n]").then.ret(-1)
+        lookup.iff("arg[n] == '=' && !t->requires_arg").then.ret(-1)
+        lookup.ret("t->id")
+        self.context.helpers.append(lookup)
+
+        argv = self.context.backend.argv
+        i = self.context.i_var
+        b.add("switch ({0}({1}))".format(lookup.name, argv(i)))
+        b.add("{")
+        for id, token in enumerate(sorted_tokens):
+            case = Block()
+            for s in self.token_action_map[token].generated_code:
+                case.add(s)
+            case.cont()
+            b.add("case {0}:".format(id))
+            b.add(case)
+        b.add("}")
+
+    def write_trie(self, b, sorted_tokens, depth):
+        # type: (Block, List[str], int) -> None
+        """
+        Write the tokens, which all share the first depth characters, as
+        nested switch statements on the successive characters of the argument.
+        As soon as only a single token is left, the remaining characters are
+        compared at once. A matched token continues the argument loop, so the
+        positional arguments are to be handled after the outermost switch.
+        """
+        argv = self.context.backend.argv
+        i = self.context.i_var
+
+        if len(sorted_tokens) == 1:
+            token = sorted_tokens[0]
+            suffix = token[depth:]
+            arg = argv(i).slice(make_expr(depth))
+            if token in self.token_requires_arg:
+                then = b.iff(make_expr('!strncmp({0}, "{1}", {2}) && (argv[i][{3}]==\'=\' || !argv[i][{3}])'.format(arg, suffix, len(suffix), len(token)))).then
+            else:
+                then = b.iff(arg.eq_str(suffix)).then
+            for s in self.token_action_map[token].generated_code:
+                then.add(s)
+            then.cont()
+            return
 
+        # Group the tokens by the character at the current depth
+        children = collections.OrderedDict() # type: Dict[str, List[str]]
+        for token in sorted_tokens:
+            if len(token) == depth:
+                children[''] = [token]
+            else:
+                children.setdefault(token[depth], []).append(token)
+
+        b.add(SwitchStatement(argv(i)[depth]))
+        b.add("{")
+        for c in children:
+            case = Block()
+            if c == '':
+                token = children[c][0]
+                b.add("case '\\0':")
+                if token in self.token_requires_arg:
+                    b.add("case '=':")
+                for s in self.token_action_map[token].generated_code:
+                    case.add(s)
+                case.cont()
+            else:
+                b.add("case {0}:".format(c_char_literal(c)))
+                self.write_trie(case, children[c], depth + 1)
+                case.brk()
+            b.add(case)
+        b.add("}")
+
+def c_char_literal(c):
+    # type: (str) -> str
+    """Return the C character literal for the given character"""
+    if c in "\\'":
+        return "'\\{0}'".format(c)
+    return "'{0}'".format(c)
+
+FNV_OFFSET_BASIS = 2166136261
+FNV_PRIME = 16777619
+
+def fnv1a(token, seed=FNV_OFFSET_BASIS):
+    # type: (str, int) -> int
+    """Compute the 32-bit FNV-1a hash of the given token, starting with seed"""
+    h = seed
+    for c in token:
+        h = ((h ^ ord(c)) * FNV_PRIME) & 0xffffffff
+    return h
+
+# The shifts and multipliers of the finalizer of MurmurHash3, see mix_hash()
+MIX_STEPS = [(16, 0x85ebca6b), (13, 0xc2b2ae35)]
+
+def mix_hash(h):
+    # type: (int) -> int
+    """
+    Mix the bits of the given 32-bit hash so that each of them affects all
+    bits of the result. Tokens that differ only in their last character,
+    e.g., -f and -n, would get correlated slots otherwise.
+    """
+    for shift, m in MIX_STEPS:
+        h = h ^ (h >> shift)
+        h = (h * m) & 0xffffffff
+    return h ^ (h >> 16)
+
+def write_mix_hash(b):
+    # type: (Block) -> None
+    """Write the code that mixes the bits of the hash h, see mix_hash()"""
+    for shift, m in MIX_STEPS:
+        b.add("h ^= h >> {0};".format(shift))
+        b.add("h = (h * 0x{0:x}UL) & 0xffffffffUL;".format(m))
+    b.add("h ^= h >> 16;")
+
+def hash_slot(token, seed, size):
+    # type: (str, int, int) -> int
+    """Determine the slot of the token in a hash table of the given size"""
+    return mix_hash(fnv1a(token, seed)) & (size - 1)
+
+# The number of seeds that are tried for a bucket before the table is enlarged
+MAX_SEEDS = 1024
+
+def displace(tokens, size):
+    # type: (List[str], int) -> Tuple[List[int], List[int]]
+    """
+    Place the given tokens into a table of the given size following the hash
+    and displace scheme, see perfect_hash(). Returns None if no seed places
+    the tokens of some bucket.
+    """
+    num_buckets = max(1, size // 4)
+    buckets = [[] for b in range(num_buckets)] # type: List[List[int]]
+    for id, token in enumerate(tokens):
+        buckets[hash_slot(token, FNV_OFFSET_BASIS, num_buckets)].append(id)
+
+    seeds = [0] * num_buckets
+    slots = [-1] * size
+
+    # Place large buckets first while there are still many free slots
+    for b in sorted(range(num_buckets), key=lambda b: -len(buckets[b])):
+        if len(buckets[b]) == 0:
+            break
+        for seed in range(1, MAX_SEEDS + 1):
+            bucket_slots = [hash_slot(tokens[id], seed, size) for id in buckets[b]]
+            if len(set(bucket_slots)) == len(bucket_slots) and all(slots[bs] == -1 for bs in bucket_slots):
+                break
+        else:
+            return None
+        seeds[b] = seed
+        for id, bs in zip(buckets[b], bucket_slots):
+            slots[bs] = id
+    return seeds, slots
+
+def perfect_hash(tokens):
+    # type: (List[str]) -> Tuple[List[int], List[int]]
+    """
+    Construct a perfect hash over the given tokens following the hash and
+    displace scheme. A first hash distributes the tokens over some buckets.
+    For each bucket, a seed is then searched that places all tokens of the
+    bucket into so far free slots of the table when hashed with this seed.
+    If no seed is found, the size of the table is doubled.
+
+    Returns
+    -------
+    seeds, slots
+        the seed for each bucket and the index of the token for each slot
+        (-1 for an empty slot). The number of buckets and slots are powers of
+        two.
+    """
+    size = 1
+    while size < len(tokens):
+        size = size * 2
+    while True:
+        table = displace(tokens, size)
+        if table is not None:
+            return table
+        size = size * 2
 
 class PositionalActionMap:
     """
@@ -742,34 +1651,101 @@ class PositionalActionMap:
         return self.action_map[pos][cmd_idx]
 
     def write(self, b, first=False):
-        # type: (Block, bool) -> None
-        for pos, cmd_maps in enumerate(self.action_map):
-            for cmd_idx in cmd_maps:
-                if first:
-                    el = ''
-                    first = False
-                else:
-                    el = 'else '
-                b.add('{0}if (cur_position == {1} && cur_command == {2})'.format(el, pos, cmd_idx))
-
-                b.add(cmd_maps[cmd_idx])
+        # type: (Block, bool) -> bool
+        """
+        Write the dispatching of the positional arguments to the given block
+        as a switch on a key that combines the index of the current command
+        and the current position, which takes constant time. Each case
+        continues the argument loop, cases with the same actions share them.
+        Unless first is set, the switch is written to the else case of the
+        if/else if chain that ends the block. Returns True if the block does
+        not end with an open chain as TokenActionMap.write().
+        """
+        if len(self.action_map) == 0:
+            return first
+        # The position is advanced past the last one of the map once that is
+        # filled, so keys of commands must not overlap that one either
+        positions = len(self.action_map) + 1
+        slots = sorted((cmd_idx * positions + pos, actions) for pos, cmd_maps in enumerate(self.action_map) for cmd_idx, actions in cmd_maps.items())
+        cases = collections.OrderedDict() # type: Dict[Tuple[str, ...], Tuple[List[int], Block]]
+        for key, actions in slots:
+            code = tuple(repr(s) for s in actions.generated_code)
+            if code not in cases:
+                cases[code] = ([], actions)
+            cases[code][0].append(key)
+
+        tail = b if first else open_chain(b)
+        tail.add("switch (cur_command * {0} + cur_position)".format(positions))
+        tail.add("{")
+        for keys, actions in cases.values():
+            case = Block()
+            for s in actions.generated_code:
+                case.add(s)
+            if not terminates(case):
+                case.cont()
+            for key in keys:
+                tail.add("case {0}:".format(key))
+            tail.add(case)
+        tail.add("}")
+        return first
+
+def open_chain(b):
+    # type: (Block) -> Block
+    """
+    Return the block that is the else case of the if/else if chain that
+    ends the given block, i.e., the block to which further cases are added.
+    """
+    iff = b.generated_code[-1]
+    while isinstance(iff, IfStatement):
+        code = iff.otherwise.generated_code
+        if len(code) != 1 or not isinstance(code[0], IfStatement):
+            return iff.otherwise
+        iff = code[0]
+    raise RuntimeError("The block does not end with an if statement")
 
 class GeneratorContext:
     """
     The context of the parser generator
     """
-    def __init__(self, backend):
-        # type: (Backend) -> None
+    def __init__(self, backend, dispatch='chain', scoped=False, validation='inline', packed_flags=False):
+        # type: (Backend, str, bool, str, bool) -> None
         self.backend = backend
+        self.dispatch = dispatch
+        self.scoped = scoped
+        self.validation = validation
+        self.packed_flags = packed_flags
         self.cli_vars = Variables("cli")
         self.aux_vars = Variables("cli_aux")
-        self.cur_command_var = Variable("cur_command", "int", "-1")
+        if scoped:
+            # Tokens are dispatched by the index of the current command, so
+            # start with the index that CommandIndexMap assigns to no command
+            self.cur_command_var = Variable("cur_command", "int", "1")
+        else:
+            self.cur_command_var = Variable("cur_command", "int", "-1")
         self.cur_position_var = Variable('cur_position', 'int', '0')
         self.parent_map = ParentMap()
         self.command_index_map = CommandIndexMap()
         self.token_action_map = TokenActionMap(self)
         self.positional_action_map = PositionalActionMap()
 
+        # Types, tables and functions that the generated functions depend on
+        self.helpers = [] # type: List[Union[Variables, ConstArray, Enum, Macro, Function]]
+
+        # Maps options to their id, which is, e.g., the index in the
+        # option_cmd array of the aux struct if commands are validated via
+        # tables
+        self.option_ids = collections.OrderedDict() # type: Dict[str, int]
+
+        # All errors that may be reported by the generated functions
+        self.errors = [] # type: List[ErrorStatement]
+
+        # Maps the names of flags to their bit, used if flags are packed. The
+        # bits are assigned by pack_flags(), until then they are -1
+        self.flags = collections.OrderedDict() # type: Dict[str, int]
+
+        # Names of the aux fields that record the command of an option
+        self.cmd_fields = [] # type: List[str]
+
         # Variables/Parameters used in some functions
         self.cli_arg_var = V('cli', 'struct cli *')
         self.aux_arg_var = V('aux', 'struct cli_aux *')
@@ -796,6 +1772,117 @@ class GeneratorContext:
         # type: (str, str) -> Expression
         return self.aux_arg_var.access(self.aux_var(name, type))
 
+    def cli_flag(self, name):
+        # type: (str) -> Expression
+        """Return an expression that tests the flag of the given name"""
+        if not self.packed_flags:
+            return self.cli_access(name, "int")
+        if name not in self.flags:
+            self.flags[name] = -1
+        return DirectExpression("cli_flag(cli, {0})".format(flag_const(name)))
+
+    def set_cli_flag(self, name):
+        # type: (str) -> Expression
+        """Return an expression that sets the flag of the given name"""
+        if not self.packed_flags:
+            return self.cli_access(name, "int") << 1
+        self.cli_flag(name)
+        return DirectExpression("cli_set_flag(cli, {0})".format(flag_const(name)))
+
+    def cli_field(self, name):
+        # type: (str) -> Expression
+        """Return an expression for the field of the given name, which may be a flag"""
+        if name in self.flags:
+            return self.cli_flag(name)
+        return self.cli_access(name)
+
+    def pack_flags(self, groups):
+        # type: (List[List[str]]) -> int
+        """
+        Assign a bit to each flag. Flags of a group of mutual exclusive
+        options are placed into the same word if possible, so that they can be
+        tested with a single mask. Returns the number of words.
+        """
+        bit = 0
+        for group in groups:
+            names = [name for name in group if name in self.flags and self.flags[name] == -1]
+            if len(names) <= 32 and bit % 32 + len(names) > 32:
+                bit = (bit // 32 + 1) * 32
+            for name in names:
+                self.flags[name] = bit
+                bit = bit + 1
+        for name in self.flags:
+            if self.flags[name] == -1:
+                self.flags[name] = bit
+                bit = bit + 1
+        return max(1, (bit + 31) // 32)
+
+    def flags_mask(self, names):
+        # type: (List[str]) -> Tuple[int, int]
+        """
+        Return the word and the mask of the given flags, or None if they are
+        not all packed flags of the same word.
+        """
+        if not all(name in self.flags for name in names):
+            return None
+        words = set(self.flags[name] // 32 for name in names)
+        if len(words) != 1:
+            return None
+        mask = 0
+        for name in names:
+            mask = mask | (1 << (self.flags[name] % 32))
+        return words.pop(), mask
+
+    def option_cmd_access(self, option):
+        # type: (str) -> Expression
+        """
+        Return an expression to access the element of the option_cmd array
+        that records the command for the given option.
+        """
+        return self.aux_arg_var.access(V('option_cmd', 'int'))[self.option_id(option)]
+
+    def option_id(self, option):
+        # type: (str) -> int
+        """Return the id of the given option"""
+        if option not in self.option_ids:
+            self.option_ids[option] = len(self.option_ids)
+        return self.option_ids[option]
+
+    def error(self, code, msg, index=None, option=None, arg_templates=None):
+        # type: (str, str, str, str, List[str]) -> ErrorStatement
+        """
+        Create a statement that reports an error with the given code and
+        message. The index of the offending argument and the id of the
+        option are C expressions, if given.
+        """
+        e = ErrorStatement(len(self.errors), code, msg, index, option, arg_templates)
+        self.errors.append(e)
+        return e
+
+    def valid_commands_text(self, option):
+        # type: (str) -> str
+        """Return the text that names the commands for which the given option may be given"""
+        parent_names = [p.command for p in self.parent_map.parents.get(option, []) if p is not None]
+        valid_commands = ['\\"' + vc + '\\"' for vc in parent_names]
+        return join_enum(sorted(set(valid_commands)), "and") + " command"
+
+    def wrong_command_error(self, option):
+        # type: (str) -> ErrorStatement
+        """Create a statement that reports that the given option was given for a wrong command"""
+        msg = "Option {0} may be given only for the {1}\\n".format(option, self.valid_commands_text(option))
+        return self.error('CLI_ERR_WRONG_COMMAND', msg, option=str(self.option_id(option)))
+
+    def add_token_type(self):
+        # type: () -> None
+        """Add the type of a token table entry to the helpers, if not done yet"""
+        if any(isinstance(h, Variables) and h.name == "cli_token" for h in self.helpers):
+            return
+        token_type = Variables("cli_token")
+        token_type.add("id", "int")
+        token_type.add("name", "const char *")
+        token_type.add("requires_arg", "int")
+        self.helpers.append(token_type)
+
 class GenerateParserVisitor(Visitor):
     """
     Vistor that generates the parsing of the command line arguments
@@ -825,13 +1912,6 @@ class GenerateParserVisitor(Visitor):
         # Number of current positional argument
         self.cur_position = 0
 
-    def remember_pos(self, token, field_name):
-        # type: (str, str) -> None
-        cur_command_name = field_name + "_cmd"
-        aux_access = self.context.aux_access
-        cur_command_var = self.context.cur_command_var
-        self.token_action_map.add(token, aux_access(cur_command_name, "int") << cur_command_var)
-
     def visit_command(self, n):
         # type: (Command) -> None
         cmd = n.command
@@ -843,7 +1923,6 @@ class GenerateParserVisitor(Visitor):
         field_name = makename(n)
         pos_name = field_name + "_pos"
 
-        field_var = self.context.cli_var(field_name, "int")
         pos_var = self.context.aux_var(pos_name, "int")
         cur_command_var = self.context.cur_command_var
         arg_var = None # type: Variable
@@ -863,20 +1942,20 @@ class GenerateParserVisitor(Visitor):
         argc = self.context.backend.argc()
 
         if cmd not in self.token_action_map:
-            self.token_action_map.add(cmd, cli_access(field_var) << 1, cmd_requires_arg)
+            self.token_action_map.add(cmd, self.context.set_cli_flag(field_name), cmd_requires_arg)
             self.token_action_map.add(cmd, aux_access(pos_var) << i, cmd_requires_arg)
             self.token_action_map.add(cmd, cur_command_var << cur_command_idx, cmd_requires_arg)
 
             if cmd_requires_arg:
                 self.token_action_map.add(cmd, "")
-                if_no_direct_arg = self.token_action_map.add(cmd).iff(cond="!argv[i][{0}]".format(len(cmd) - 1)).then
+                if_no_direct_arg = self.token_action_map.add(cmd).iff(cond="!argv[i][{0}]".format(len(cmd))).then
                 if_no_direct_arg.iff(i + 1 < argc).then. \
                     add(cli_access(arg_var) << argv(i + 1)). \
                     inc(i).\
                     otherwise(). \
-                    printerr("Argument \\\"{0}\\\" requires a value\\n".format(cmd)). \
+                    add(self.context.error('CLI_ERR_MISSING_VALUE', "Argument \\\"{0}\\\" requires a value\\n".format(cmd), index="i")). \
                     ret(0)
-                if_no_direct_arg.otherwise().add(cli_access(arg_var) << argv(i).slice(make_expr(len(cmd))))
+                if_no_direct_arg.otherwise().add(cli_access(arg_var) << argv(i).slice(make_expr(len(cmd) + 1)))
 
     def visit_option_with_arg(self, n):
         # type: (OptionWithArg) -> None
@@ -894,13 +1973,13 @@ class GenerateParserVisitor(Visitor):
         if option not in self.token_action_map:
             field_name = makename(n)
             if n.arg == None:
-                self.token_action_map.add(option, cli(field_name, "int") << 1)
+                self.token_action_map.add(option, self.context.set_cli_flag(field_name))
             else:
-                self.token_action_map.add(option, "if (++i == argc) break;")
+                # Leaving the loop would just return 1, but a return is also
+                # correct if the token is dispatched within a switch
+                self.token_action_map.add(option, "if (++i == argc) return 1;")
                 self.token_action_map.add(option, cli(field_name, "char *") << argv(i))
 
-            self.remember_pos(option, field_name)
-
     def visit_arg(self, n):
         # type: (Arg) -> None
         field_name = makecname(n.command)
@@ -922,10 +2001,12 @@ class GenerateParserVisitor(Visitor):
 
             self.context.aux_var(variadic_field_name, "char **")
 
+            # Leaving the loop would just return 1, but a return is also
+            # correct within the switch that dispatches positional arguments
             self.positional_action_map.add(self.cur_position, cur_command_idx). \
                 add(aux(variadic_field_name) << argv().slice(i)). \
                 add(aux("variadic_argc", "int") << argc - i). \
-                brk()
+                ret(1)
         else:
             self.context.cli_var(field_name, "char *")
 
@@ -941,6 +2022,7 @@ class GenerateParserVisitor(Visitor):
     def leave_pattern(self, n):
         # type: (Pattern) -> None
         self.cur_position = 0
+        self.cur_command = None
 
 class CommandArgPairs():
     def __init__(self):
@@ -970,8 +2052,8 @@ class Backend(object):
         # type: (GenFile, Variables) -> None
         pass
 
-    def write_header(self, gf):
-        # type: (GenFile) -> None
+    def write_header(self, gf, includes=None):
+        # type: (GenFile, List[str]) -> None
         pass
 
     def write_footer(self, gf):
@@ -987,6 +2069,34 @@ class Backend(object):
         # type: (GenFile, str) -> None
         pass
 
+    def write_const_array(self, gf, array):
+        # type: (GenFile, ConstArray) -> None
+        """Write the given constant array at file scope"""
+        pass
+
+    def write_macro(self, gf, macro):
+        # type: (GenFile, Macro) -> None
+        """Write the given macro definition"""
+        pass
+
+    def write_helper(self, gf, helper):
+        # type: (GenFile, Union[Variables, ConstArray, Enum, Macro, Function]) -> None
+        """Write a type, table, macro or function that is needed by the parser"""
+        if isinstance(helper, Enum):
+            # Already followed by an empty line
+            self.write_enum(gf, helper.name, helper.fields)
+            return
+
+        if isinstance(helper, Variables):
+            self.write_variables(gf, helper)
+        elif isinstance(helper, ConstArray):
+            self.write_const_array(gf, helper)
+        elif isinstance(helper, Macro):
+            self.write_macro(gf, helper)
+        else:
+            self.write_block(gf, helper)
+        gf.writeline()
+
     def write_print_statement(self, gf, msg, args):
         # type: (GenFile, str, List[str]) -> None
         pass
@@ -1004,13 +2114,15 @@ class Backend(object):
 ################################################################################
 
 class AddressOfExpression(Expression):
+    __slots__ = ('expr',)
+
     def __init__(self, expr):
         # type: (Expression) -> None
         self.expr = expr
 
     def __repr__(self):
         # type: () -> str
-        return "&" + repr(self.expr)
+        return "&{0}".format(repr(self.expr))
 
 ################################################################################
 
@@ -1049,12 +2161,24 @@ class CBackend(CLikeMultilineCommentsBackend):
         # type: () -> None
         super(CBackend, self).__init__()
 
-    def write_header(self, gf):
-        # type: (GenFile) -> None
+        # The variable that receives errors of the function that is
+        # currently written, if any
+        self.result = None # type: Variable
+
+    def write_header(self, gf, includes=None):
+        # type: (GenFile, List[str]) -> None
         gf.writeline("#include <stdio.h>")
         gf.writeline("#include <string.h>")
+        if includes is not None:
+            for k, i in enumerate(includes):
+                if i not in includes[:k]:
+                    gf.writeline("#include <{0}>".format(i))
         gf.writeline()
 
+    def write_macro(self, gf, macro):
+        # type: (GenFile, Macro) -> None
+        gf.writeline("#define {0} {1}".format(macro.name, macro.body))
+
     def write_enum(self, gf, name, fields):
         # type: (GenFile, str, List[Tuple[str,int]]) -> None
         gf.writeline("typedef enum")
@@ -1074,22 +2198,66 @@ class CBackend(CLikeMultilineCommentsBackend):
             gf.writeline("{0};".format(expand_var(variables.variables[k])))
         gf.writeline("};")
 
+    def write_const_array(self, gf, array):
+        # type: (GenFile, ConstArray) -> None
+        columns = "[{0}]".format(array.columns) if array.columns is not None else ""
+        gf.writeline("static const {0} {1}[{2}]{3} =".format(array.vtype, array.name, len(array.rows), columns))
+        gf.writeline("{")
+        for r in array.rows:
+            gf.writeline("{0},".format(r))
+        gf.writeline("};")
+
     def write_if(self, gf, iff, otherwise=False):
         # type: (GenFile, IfStatement, bool) -> None
         """Write a if statement, possibly connecting it with a previous else case"""
-        gf.writeline('{0}if ({1})'.format("else " if otherwise else "", iff.cond)) # FIXME: This should involve the backend
-        self.write_block(gf, iff.then)
-        if iff.otherwise is not None and len(iff.otherwise.generated_code) != 0:
-            if len(iff.otherwise.generated_code) == 1 and isinstance(iff.otherwise.generated_code[0], IfStatement):
-                self.write_if(gf, iff.otherwise.generated_code[0], True)
-            else:
-                gf.writeline('else')
-                self.write_block(gf, iff.otherwise)
+        self.write_nodes(gf, [(iff, otherwise)])
 
     def write_block(self, gf, block):
         # type: (GenFile, Block) -> None
         """Write the given block and its possible descendents to the file"""
+        self.write_nodes(gf, [block])
 
+    def write_nodes(self, gf, stack):
+        # type: (GenFile, List[Any]) -> None
+        """
+        Write the nodes of the given stack, starting with the last one, until
+        the stack is empty. A node is either a block, an if statement paired
+        with the flag whether it continues an else case, a statement or a
+        line. The descendents of a block or an if statement are pushed onto
+        the stack rather than written recursively, so neither deeply nested
+        blocks nor long else if chains are limited by the recursion limit.
+        """
+        while len(stack) != 0:
+            node = stack.pop()
+            if isinstance(node, str):
+                gf.writeline(node)
+            elif isinstance(node, tuple):
+                iff, otherwise = node
+                gf.writeline('{0}if ({1})'.format("else " if otherwise else "", iff.cond)) # FIXME: This should involve the backend
+                if iff.otherwise is not None and len(iff.otherwise.generated_code) != 0:
+                    if len(iff.otherwise.generated_code) == 1 and isinstance(iff.otherwise.generated_code[0], IfStatement):
+                        stack.append((iff.otherwise.generated_code[0], True))
+                    else:
+                        stack.append(iff.otherwise)
+                        stack.append('else')
+                stack.append(iff.then)
+            elif isinstance(node, LoopStatement):
+                gf.writeline('for ({0}; {1}; {2})'.format(self.translate(node.init), self.translate(node.cond), self.translate(node.step)))
+                stack.append(node.body)
+            elif isinstance(node, Block):
+                self.write_block_start(gf, node)
+                stack.append('}')
+                for l in reversed(node.generated_code):
+                    if isinstance(l, IfStatement):
+                        stack.append((l, False))
+                    elif isinstance(l, (Statement, Block)):
+                        stack.append(l)
+            else:
+                self.write_statement(gf, node)
+
+    def write_block_start(self, gf, block):
+        # type: (GenFile, Block) -> None
+        """Write the opening of the given block including its local variables"""
         if isinstance(block, Function):
             inputs = [] # type: List[str]
             if block.description is not None:
@@ -1098,7 +2266,10 @@ class CBackend(CLikeMultilineCommentsBackend):
             for i in block.input:
                 inputs.append(self.expand_var(i))
             gf.writeline("{0} {1}({2})".format(block.output, block.name, ", ".join(inputs)))
+            self.result = block.result
         gf.writeline('{')
+        if not block.has_locals():
+            return
 
         for vname in block.locals.variables:
             v = block.locals[vname]
@@ -1110,25 +2281,21 @@ class CBackend(CLikeMultilineCommentsBackend):
             else:
                 gf.writeline("{0}{1};".format(vtype, vname))
 
-        for l in block.generated_code:
-            if isinstance(l, IfStatement):
-                self.write_if(gf, l)
-            elif isinstance(l, DirectStatement):
-                gf.writeline(l.st)
-            elif isinstance(l, ReturnStatement):
-                gf.writeline("return {0};".format(self.translate(l.expr)))
-            elif isinstance(l, PrintErrorStatement):
-                self.write_print_statement(gf, l.msg, [repr(e) for e in l.args])
-            elif isinstance(l, ExpressionStatement):
-                gf.writeline("{0};".format(self.translate(l.expr)))
-            elif isinstance(l, Statement):
-                gf.writeline(repr(l)) # FIXME: This should involve the backend
-            elif isinstance(l, Block):
-                self.write_block(gf, l)
-            elif isinstance(l, Function):
-                self.write_block(gf, l)
-
-        gf.writeline('}')
+    def write_statement(self, gf, l):
+        # type: (GenFile, Statement) -> None
+        """Write the given statement, which is neither a block nor an if statement"""
+        if isinstance(l, DirectStatement):
+            gf.writeline(l.st)
+        elif isinstance(l, ReturnStatement):
+            gf.writeline("return {0};".format(self.translate(l.expr)))
+        elif isinstance(l, ErrorStatement) and self.result is not None:
+            self.write_error_statement(gf, l)
+        elif isinstance(l, PrintErrorStatement):
+            self.write_print_statement(gf, l.msg, [repr(e) for e in l.args])
+        elif isinstance(l, ExpressionStatement):
+            gf.writeline("{0};".format(self.translate(l.expr)))
+        else:
+            gf.writeline(repr(l)) # FIXME: This should involve the backend
 
     def write_print_statement(self, gf, msg, args):
         # type: (GenFile, str, List[str]) -> None
@@ -1137,6 +2304,17 @@ class CBackend(CLikeMultilineCommentsBackend):
             cargs = ", " + ", ".join(args)
         gf.writeline("fprintf(stderr, \"{0}\"{1});".format(msg, cargs))
 
+    def write_error_statement(self, gf, error):
+        # type: (GenFile, ErrorStatement) -> None
+        """Store the given error into the result of the current function"""
+        res = self.result
+        gf.writeline("{0};".format(self.translate(AccessMember(res, "code") << error.code)))
+        gf.writeline("{0};".format(self.translate(AccessMember(res, "message") << error.id)))
+        if error.index is not None:
+            gf.writeline("{0};".format(self.translate(AccessMember(res, "index") << error.index)))
+        if error.option is not None:
+            gf.writeline("{0};".format(self.translate(AccessMember(res, "option") << error.option)))
+
     def translate(self, expr):
         # type: (Expression) -> str
         """Translates the given expresison to the langauage"""
@@ -1145,11 +2323,11 @@ class CBackend(CLikeMultilineCommentsBackend):
 
     def argc(self):
         # type: () -> Expression
-        return V('argc', 'int')
+        return leaf(Variable, 'argc', 'int')
 
     def argv(self, index = None):
         # type: (Union[int, Expression]) -> Expression
-        v = V('argv', 'char **')
+        v = leaf(Variable, 'argv', 'char **')
         if index is None:
             return v
         return v[index]
@@ -1180,8 +2358,8 @@ class JavaBackend(CBackend):
         # type: (Variable) -> str
         return expand_java_var(var)
 
-    def write_header(self, gf):
-        # type: (GenFile) -> None
+    def write_header(self, gf, includes=None):
+        # type: (GenFile, List[str]) -> None
         gf.writeline("public class CliParser")
         gf.writeline("{")
 
@@ -1215,6 +2393,15 @@ class JavaBackend(CBackend):
             gf.writeline("{0};".format(expand_java_var(variables.variables[k])))
         gf.writeline("};")
 
+    def write_const_array(self, gf, array):
+        # type: (GenFile, ConstArray) -> None
+        vtype = 'String' if array.vtype == 'char * const' else array.vtype
+        gf.writeline("static final {0}[] {1} =".format(vtype, array.name))
+        gf.writeline("{")
+        for r in array.rows:
+            gf.writeline("{0},".format(r))
+        gf.writeline("};")
+
     def write_print_statement(self, gf, msg, args):
         # type: (GenFile, str, List[str]) -> None
         cargs = ""
@@ -1234,61 +2421,1302 @@ class JavaBackend(CBackend):
 
 ################################################################################
 
-def genopts(patterns, backend, dont_skip_first_arg):
-    # type: (List[str], Backend, bool)->None
-    parse_trees = [parse_pattern(p.strip()) for p in patterns]
-    template = Template(parse_trees)
-    #print(template)
+# The functions that are called in conditions without side effects
+PURE_FUNCTIONS = frozenset(['strcmp', 'strncmp', 'cli_flag'])
+
+def subexpressions(expr):
+    # type: (Expression) -> List[Expression]
+    """Return the direct operands of the given expression"""
+    operands = [] # type: List[Expression]
+    for cls in type(expr).__mro__:
+        for name in getattr(cls, '__slots__', ()):
+            value = getattr(expr, name, None)
+            if isinstance(value, Expression):
+                operands.append(value)
+            elif isinstance(value, (list, tuple)):
+                operands.extend(v for v in value if isinstance(v, Expression))
+    return operands
+
+def is_pure_text(text, pure_texts):
+    # type: (str, Dict[str, bool]) -> bool
+    """
+    Return whether the given C expression has no side effects. The result
+    is remembered in pure_texts, which optimize() keeps for one run.
+    """
+    pure = pure_texts.get(text)
+    if pure is None:
+        pure = '++' not in text and '--' not in text and not re.search(r'[^=!<>]=[^=]', text) and \
+            all(name in PURE_FUNCTIONS for name in re.findall(r'(\w+)\s*\(', text))
+        pure_texts[text] = pure
+    return pure
+
+def is_pure(expr, pure_texts):
+    # type: (Expression, Dict[str, bool]) -> bool
+    """
+    Return whether the given expression has no side effects, which is
+    decided conservatively for expressions that are given as text, see
+    is_pure_text().
+    """
+    stack = [expr]
+    while len(stack) != 0:
+        e = stack.pop()
+        if isinstance(e, (AssignmentExpression, PostIncrementExpression, PostDecrementExpression)):
+            return False
+        if isinstance(e, DirectExpression):
+            if not is_pure_text(e.expr, pure_texts):
+                return False
+        elif not isinstance(e, Variable):
+            stack.extend(subexpressions(e))
+    return True
+
+def constant_value(expr):
+    # type: (Expression) -> int
+    """Return the value of the given expression if it is constant, else None"""
+    if isinstance(expr, DirectExpression):
+        try:
+            return int(expr.expr.strip())
+        except ValueError:
+            return None
+    if isinstance(expr, IsFalseExpression):
+        value = constant_value(expr.expr)
+        return None if value is None else int(not value)
+    if isinstance(expr, BinaryExpression):
+        left = constant_value(expr.left)
+        right = constant_value(expr.right)
+        if left is None or right is None:
+            return None
+        if expr.rel == '==':
+            return int(left == right)
+        if expr.rel == '!=':
+            return int(left != right)
+        if expr.rel == '<':
+            return int(left < right)
+        if expr.rel == '>':
+            return int(left > right)
+        if expr.rel == '+':
+            return left + right
+        if expr.rel == '-':
+            return left - right
+    return None
+
+def simplify_condition(expr, pure_texts):
+    # type: (Expression, Dict[str, bool]) -> Expression
+    """
+    Return the given condition without the operands of conjunctions and
+    disjunctions that do not affect the result, which may turn it into a
+    constant.
+    """
+    if not isinstance(expr, LogicalExpression):
+        return expr
+    # The value that decides the result, i.e., false for a conjunction
+    decisive = int(expr.op == '||')
+    operands = [] # type: List[Expression]
+    for o in expr.operands:
+        o = simplify_condition(o, pure_texts)
+        value = constant_value(o)
+        if value is None:
+            operands.append(o)
+        elif bool(value) == bool(decisive):
+            # The remaining operands are not evaluated
+            if all(is_pure(p, pure_texts) for p in operands):
+                return make_expr(decisive)
+            operands.append(o)
+            break
+    if len(operands) == 0:
+        return make_expr(1 - decisive)
+    if len(operands) == 1:
+        return operands[0]
+    if len(operands) == len(expr.operands) and all(a is b for a, b in zip(operands, expr.operands)):
+        return expr
+    return LogicalExpression(expr.op, operands)
+
+def child_blocks(st):
+    # type: (Union[Block, Statement]) -> List[Block]
+    """Return the blocks that are part of the given statement"""
+    if isinstance(st, IfStatement):
+        return [b for b in [st.then, st.otherwise] if b is not None]
+    if isinstance(st, LoopStatement):
+        return [st.body]
+    if isinstance(st, Block):
+        return [st]
+    return []
+
+def walk_blocks(roots):
+    # type: (Sequence[Block]) -> List[Block]
+    """
+    Return the given blocks and those that are nested within them, parents
+    before children. Blocks that share the list of their code, e.g., the
+    variants of reentrant functions, are returned only once.
+    """
+    blocks = [] # type: List[Block]
+    seen = set() # type: Set[int]
+    stack = list(reversed(roots))
+    while len(stack) != 0:
+        b = stack.pop()
+        key = id(b.generated_code)
+        if key in seen:
+            continue
+        seen.add(key)
+        blocks.append(b)
+        for st in reversed(b.generated_code):
+            if isinstance(st, (IfStatement, LoopStatement, Block)):
+                stack.extend(reversed(child_blocks(st)))
+    return blocks
+
+def is_empty(b):
+    # type: (Block) -> bool
+    return b is None or (len(b.generated_code) == 0 and not b.has_locals())
+
+def terminates(b):
+    # type: (Block) -> bool
+    """Return whether the given block always leaves the enclosing code"""
+    return len(b.generated_code) != 0 and isinstance(b.generated_code[-1], (ReturnStatement, BreakStatement, ContinueStatement))
+
+# The nesting depth up to which blocks are compared by block_key()
+BLOCK_KEY_DEPTH = 4
+
+def block_key(b, depth=0):
+    # type: (Block, int) -> Tuple
+    """
+    Return a key that is equal for blocks with the same effect, or None if
+    the block is too complex to compare. Errors are compared by their
+    contents, as their ids only select the same message.
+    """
+    if b is None:
+        return ()
+    if b.has_locals() or depth > BLOCK_KEY_DEPTH:
+        return None
+    key = [] # type: List[Tuple]
+    for st in b.generated_code:
+        if isinstance(st, ErrorStatement):
+            key.append(('error', st.code, st.msg, st.index, st.option, tuple(st.arg_templates)))
+        elif isinstance(st, IfStatement):
+            then = block_key(st.then, depth + 1)
+            otherwise = block_key(st.otherwise, depth + 1)
+            if then is None or otherwise is None:
+                return None
+            key.append(('if', repr(st.cond), then, otherwise))
+        elif isinstance(st, (LoopStatement, Block)):
+            return None
+        else:
+            key.append((st.__class__.__name__, repr(st)))
+    return tuple(key)
+
+def branch_code(b):
+    # type: (Block) -> List[Union[Block, Statement]]
+    """Return the code that replaces an if statement that always takes the given branch"""
+    if b is None:
+        return []
+    if b.has_locals():
+        return [b]
+    return b.generated_code
 
-    context = GeneratorContext(backend)
+def fold_constant_branches(functions, context, pure_texts):
+    # type: (List[Function], GeneratorContext, Dict[str, bool]) -> None
+    """
+    Replace the if statements whose condition is constant by the branch
+    that is taken and remove those without any code whose condition has no
+    side effects.
+    """
+    # Children first, so the code that is moved into a parent is folded
+    for b in reversed(walk_blocks(functions)):
+        if not any(isinstance(st, IfStatement) for st in b.generated_code):
+            continue
+        code = [] # type: List[Union[Block, Statement]]
+        pending = list(reversed(b.generated_code))
+        while len(pending) != 0:
+            st = pending.pop()
+            if isinstance(st, IfStatement):
+                st.cond = simplify_condition(st.cond, pure_texts)
+                value = constant_value(st.cond)
+                if value is not None:
+                    pending.extend(reversed(branch_code(st.then if value else st.otherwise)))
+                    continue
+                if is_empty(st.then) and is_empty(st.otherwise) and is_pure(st.cond, pure_texts):
+                    continue
+            code.append(st)
+        b.generated_code[:] = code
+
+def merge_chain(iff, merged, pure_texts):
+    # type: (IfStatement, Set[IfStatement], Dict[str, bool]) -> None
+    """
+    Merge the cases of the else if chain that starts with the given if
+    statement, dropping those whose condition equals one of a previous case,
+    as they are never taken, and combining adjacent ones with the same code.
+    The cases are added to merged, a chain that continues one of them has
+    been merged already.
+    """
+    if iff in merged:
+        return
+    # The conditions of the previous cases, which are false at this point
+    previous = set() # type: Set[str]
+    if is_pure(iff.cond, pure_texts):
+        previous.add(repr(iff.cond))
+    key = block_key(iff.then)
+    operands = [iff.cond]
+    while True:
+        merged.add(iff)
+        nxt = None # type: IfStatement
+        if iff.otherwise is not None and len(iff.otherwise.generated_code) == 1 and isinstance(iff.otherwise.generated_code[0], IfStatement):
+            nxt = iff.otherwise.generated_code[0]
+        if nxt is not None:
+            merged.add(nxt)
+            pure = is_pure(nxt.cond, pure_texts)
+            cond = repr(nxt.cond)
+            if pure and cond in previous:
+                iff.otherwise = iff.then.otherwise_block = nxt.otherwise
+                continue
+            nxt_key = block_key(nxt.then)
+        if nxt is not None and key is not None and key == nxt_key:
+            operands.append(nxt.cond)
+            iff.otherwise = iff.then.otherwise_block = nxt.otherwise
+        else:
+            if len(operands) > 1:
+                iff.cond = Or(*operands)
+            if nxt is None:
+                return
+            iff, key, operands = nxt, nxt_key, [nxt.cond]
+        if pure:
+            previous.add(cond)
+        else:
+            previous.clear()
+
+def merge_conditions(functions, context, pure_texts):
+    # type: (List[Function], GeneratorContext, Dict[str, bool]) -> None
+    """
+    Merge the if statements with identical conditions or identical code,
+    e.g., validations that several patterns share. An if statement whose
+    code leaves the function makes the statements that follow it up to the
+    next side effect know that its condition is false.
+    """
+    merged = set() # type: Set[IfStatement]
+    for b in walk_blocks(functions):
+        # The conditions that are known to be false at the current statement
+        known = set() # type: Set[str]
+        code = [] # type: List[Union[Block, Statement]]
+        # The last if statement that further ones may be merged with and the
+        # key of its code, and the conditions of the merged if statements
+        last = None # type: IfStatement
+        last_key = None # type: Tuple
+        disjunctions = [] # type: List[Tuple[IfStatement, List[Expression]]]
+        pending = list(reversed(b.generated_code))
+        while len(pending) != 0:
+            st = pending.pop()
+            if not isinstance(st, IfStatement):
+                code.append(st)
+                known.clear()
+                last = None
+                continue
+            pure = is_pure(st.cond, pure_texts)
+            cond = repr(st.cond)
+            if pure and cond in known:
+                pending.extend(reversed(branch_code(st.otherwise)))
+                continue
+            merge_chain(st, merged, pure_texts)
+            if not terminates(st.then) or not is_empty(st.otherwise):
+                code.append(st)
+                known.clear()
+                last = None
+                continue
+            key = block_key(st.then)
+            if last is not None and key is not None and key == last_key:
+                disjunctions[-1][1].append(st.cond)
+            else:
+                code.append(st)
+                last, last_key = st, key
+                disjunctions.append((st, [st.cond]))
+            if pure:
+                known.add(cond)
+            else:
+                known.clear()
+        for iff, operands in disjunctions:
+            if len(operands) > 1:
+                iff.cond = Or(*operands)
+        b.generated_code[:] = code
+
+def stored_aux_field(st, aux, pure_texts):
+    # type: (Union[Block, Statement], Variable, Dict[str, bool]) -> str
+    """
+    Return the field of the aux struct that the given statement assigns a
+    value without side effects to, if it is such an assignment.
+    """
+    if not isinstance(st, ExpressionStatement) or not isinstance(st.expr, AssignmentExpression):
+        return None
+    left = st.expr.left
+    if not isinstance(left, AccessMemberExpression) or left.obj is not aux or not is_pure(st.expr.right, pure_texts):
+        return None
+    return left.member
+
+def statement_expressions(st):
+    # type: (Union[Block, Statement]) -> List[Expression]
+    """Return the expressions of the given statement without its nested blocks"""
+    if isinstance(st, (ExpressionStatement, ReturnStatement, SwitchStatement)):
+        return [st.expr]
+    if isinstance(st, PrintErrorStatement):
+        return list(st.args)
+    if isinstance(st, IfStatement):
+        return [st.cond]
+    if isinstance(st, LoopStatement):
+        return [st.init, st.cond, st.step]
+    return []
+
+def accesses_members(text, var):
+    # type: (str, Variable) -> bool
+    """Return whether the given C code accesses a member of the given variable"""
+    return re.search(r'\b{0}\s*(->|\.)'.format(re.escape(var.name)), text) is not None
+
+def read_aux_fields(exprs, aux):
+    # type: (List[Expression], Variable) -> Set[str]
+    """
+    Return the fields of the aux struct that the given expressions refer
+    to, or None if the text of some expression accesses its members, so the
+    fields cannot be told.
+    """
+    fields = set() # type: Set[str]
+    stack = [e for e in exprs if e is not None]
+    while len(stack) != 0:
+        e = stack.pop()
+        if isinstance(e, AccessMemberExpression) and e.obj is aux:
+            fields.add(e.member)
+        elif isinstance(e, DirectExpression):
+            if accesses_members(e.expr, aux):
+                return None
+        elif not isinstance(e, Variable):
+            stack.extend(subexpressions(e))
+    return fields
+
+def remove_dead_stores(functions, context, pure_texts):
+    # type: (List[Function], GeneratorContext, Dict[str, bool]) -> None
+    """
+    Remove the assignments to fields of the aux struct that are never read,
+    e.g., the position of a command that nothing refers to, as well as the
+    fields themselves. Any access to a field in the expressions other than
+    the target of such an assignment counts as a read. Nothing is removed if
+    code that is given as text accesses the struct.
+    """
+    aux = context.aux_arg_var
+    blocks = walk_blocks(functions)
+    stored = set() # type: Set[str]
+    exprs = [] # type: List[Expression]
+    for b in blocks:
+        if b.has_locals():
+            exprs.extend(v.init for v in b.locals.variables.values())
+        for st in b.generated_code:
+            field = stored_aux_field(st, aux, pure_texts)
+            if field is not None and isinstance(st, ExpressionStatement) and isinstance(st.expr, AssignmentExpression):
+                stored.add(field)
+                exprs.append(st.expr.right)
+            elif isinstance(st, DirectStatement) and not isinstance(st, SwitchStatement) and accesses_members(st.st, aux):
+                return
+            else:
+                exprs.extend(statement_expressions(st))
+    read = read_aux_fields(exprs, aux)
+    if read is None:
+        return
+    dead = stored - read
+    if len(dead) == 0:
+        return
+
+    for b in blocks:
+        b.generated_code[:] = [st for st in b.generated_code if stored_aux_field(st, aux, pure_texts) not in dead]
+
+    # Keep the struct, which is passed to the functions, not empty
+    variables = context.aux_vars.variables
+    if len([name for name in variables if name not in dead]) != 0:
+        for name in dead:
+            variables.pop(name, None)
+
+# The passes that optimize the generated functions, which are run in this
+# order if the optimization level is at least the given one
+OPTIMIZATION_PASSES = [
+    (1, fold_constant_branches),
+    (2, merge_conditions),
+    (1, remove_dead_stores),
+    (1, fold_constant_branches)
+    ] # type: List[Tuple[int, Callable[[List[Function], GeneratorContext, Dict[str, bool]], None]]]
+
+# The optimization levels that can be selected with -O
+OPTIMIZATION_LEVELS = [0, 1, 2]
+
+def optimize(functions, context, level):
+    # type: (List[Function], GeneratorContext, int) -> None
+    """Run the passes of the given optimization level on the given functions"""
+    # The texts of expressions by whether they have no side effects, which
+    # the passes share, see is_pure_text()
+    pure_texts = {} # type: Dict[str, bool]
+    for pass_level, run in OPTIMIZATION_PASSES:
+        if level >= pass_level:
+            run(functions, context, pure_texts)
+
+################################################################################
+
+# The possible strategies to dispatch tokens in parse_cli_simple()
+DISPATCH_MODES = ['chain', 'hash', 'trie']
+
+# The possible strategies to validate the commands of options in validate_cli()
+VALIDATION_MODES = ['inline', 'table']
+
+# The error codes that are stored by the reentrant functions
+ERROR_CODES = [
+    ('CLI_OK', 0),
+    ('CLI_ERR_UNKNOWN', 1),
+    ('CLI_ERR_MISSING_VALUE', 2),
+    ('CLI_ERR_WRONG_COMMAND', 3),
+    ('CLI_ERR_EXCLUSIVE', 4),
+    ('CLI_ERR_MISSING_ARGUMENT', 5),
+    ('CLI_ERR_NO_COMMAND', 6)
+    ]
+
+def write_error_formatter(b, context):
+    # type: (Block, GeneratorContext) -> None
+    """
+    Write the body of format_cli_error(), which formats the message of the
+    error that has been stored in res.
+    """
+    b.add("switch (res->message)")
+    b.add("{")
+    for e in context.errors:
+        args = [a.format(index="res->index", option="res->option") for a in e.arg_templates]
+        b.add("case {0}: return snprintf(buf, size, \"{1}\"{2});".format(e.id, e.msg, "".join(", " + a for a in args)))
+    b.add("}")
+    b.add("if (size) buf[0] = 0;")
+    b.ret(0)
+
+def write_line_tokenizer(b):
+    # type: (Block) -> None
+    """
+    Write the body of tokenize_cli_line(), which splits line into argv in
+    place. Arguments are separated by white space. Single quotes preserve all
+    characters, double quotes all but escaped double quotes and backslashes,
+    and outside of quotes a backslash escapes the next character. If argv is
+    NULL, the arguments are only counted and line is not modified.
+    """
+    b.locals.add('argc', 'int', '0')
+    b.locals.add('s', 'char *', 'line')
+    b.locals.add('d', 'char *')
+    b.locals.add('quote', 'char')
+
+    b.add("for (;;)")
+    b.add("{")
+    b.add("while (*s == ' ' || *s == '\\t' || *s == '\\r' || *s == '\\n')")
+    b.add("{")
+    b.add("s++;")
+    b.add("}")
+    b.iff("!*s").then.brk()
+    then = b.iff("argv").then
+    then.iff("argc == max_argc").then.ret(-1)
+    then.add("argv[argc] = s;")
+    b.add("argc++;")
+    b.add("d = s;")
+    b.add("quote = 0;")
+
+    # As escapes and quotes are dropped, d never overtakes s
+    b.add("while (*s)")
+    b.add("{")
+    b.add("if (quote)")
+    b.add("{")
+    b.iff("*s == quote").then.add("quote = 0;").add("s++;").cont()
+    b.iff("quote == '\"' && *s == '\\\\' && (s[1] == '\"' || s[1] == '\\\\')").then.add("s++;")
+    b.add("}")
+    b.add("else if (*s == '\\'' || *s == '\"')")
+    b.add("{")
+    b.add("quote = *s++;")
+    b.cont()
+    b.add("}")
+    b.add("else if (*s == ' ' || *s == '\\t' || *s == '\\r' || *s == '\\n')")
+    b.add("{")
+    b.brk()
+    b.add("}")
+    b.add("else if (*s == '\\\\' && s[1])")
+    b.add("{")
+    b.add("s++;")
+    b.add("}")
+    b.iff("argv").then.add("*d++ = *s;")
+    b.add("s++;")
+    b.add("}")
+    b.iff("quote").then.ret(-2)
+
+    # Skip the separator before terminating the argument as both may coincide
+    b.iff("*s").then.add("s++;")
+    b.iff("argv").then.add("*d = 0;")
+    b.add("}")
+    b.ret("argc")
+
+def write_response_file_expander(b):
+    # type: (Block) -> None
+    """
+    Write the body of expand_cli_response_files(). Each file is mapped
+    privately and followed by an anonymous page, so the tokenizer can modify
+    it in place and finds a terminating zero byte even if the size of the
+    file is a multiple of the page size. Only the arrays of the mappings and
+    of the pointers to the arguments are allocated. The arguments of all
+    files are counted before any of them is tokenized.
+    """
+    b.locals.add('argc', 'int', '*argc_ptr')
+    b.locals.add('argv', 'char **', '*argv_ptr')
+    b.locals.add('new_argc', 'int')
+    b.locals.add('new_argv', 'char **')
+    b.locals.add('st', 'struct stat')
+    b.locals.add('map', 'char *')
+    b.locals.add('fd', 'int')
+    b.locals.add('i', 'int')
+    b.locals.add('k', 'int')
+    b.locals.add('n', 'int')
+    b.locals.add('files', 'int', '0')
+
+    # Release the files of a previous call
+    b.add("cleanup_cli(cli);")
+
+    b.add("for (i=0; i < argc; i++)")
+    b.add("{")
+    b.iff("argv[i][0] == '@'").then.add("files++;")
+    b.add("}")
+    b.iff("files == 0").then.ret(1)
+
+    b.add("cli->response_file_maps = malloc(files * sizeof(*cli->response_file_maps));")
+    b.add("cli->response_file_sizes = malloc(files * sizeof(*cli->response_file_sizes));")
+    b.iff("!cli->response_file_maps || !cli->response_file_sizes").then. \
+        printerr("Not enough memory for the response files\\n"). \
+        ret(0)
+
+    b.add("n = 0;")
+    b.add("for (i=0; i < argc; i++)")
+    b.add("{")
+    b.iff("argv[i][0] != '@'").then.cont()
+    b.add("fd = open(&argv[i][1], O_RDONLY);")
+    then = b.iff("fd < 0 || fstat(fd, &st) < 0").then
+    then.printerr("Cannot read response file \\\"%s\\\"\\n", DirectExpression("&argv[i][1]"))
+    then.iff("fd >= 0").then.add("close(fd);")
+    then.ret(0)
+    b.add("map = mmap(NULL, st.st_size + 1, PROT_READ | PROT_WRITE, MAP_PRIVATE | MAP_ANONYMOUS, -1, 0);")
+    b.iff("map != MAP_FAILED && st.st_size && mmap(map, st.st_size, PROT_READ | PROT_WRITE, MAP_PRIVATE | MAP_FIXED, fd, 0) == MAP_FAILED").then. \
+        add("munmap(map, st.st_size + 1);"). \
+        add("map = MAP_FAILED;")
+    b.add("close(fd);")
+    b.iff("map == MAP_FAILED").then. \
+        printerr("Cannot map response file \\\"%s\\\"\\n", DirectExpression("&argv[i][1]")). \
+        ret(0)
+    b.add("cli->response_file_maps[cli->response_file_count] = map;")
+    b.add("cli->response_file_sizes[cli->response_file_count++] = st.st_size + 1;")
+
+    b.add("k = tokenize_cli_line(map, NULL, 0);")
+    b.iff("k < 0").then. \
+        printerr("Unterminated quote in response file \\\"%s\\\"\\n", DirectExpression("&argv[i][1]")). \
+        ret(0)
+    b.add("n += k;")
+    b.add("}")
+
+    b.add("new_argc = argc - files + n;")
+    b.add("new_argv = malloc((new_argc + 1) * sizeof(*new_argv));")
+    b.iff("!new_argv").then. \
+        printerr("Not enough memory for the arguments of the response files\\n"). \
+        ret(0)
+    b.add("cli->response_file_argv = new_argv;")
+
+    # Replace each @path by the arguments of its file in place
+    b.add("n = 0;")
+    b.add("k = 0;")
+    b.add("for (i=0; i < argc; i++)")
+    b.add("{")
+    b.iff("argv[i][0] == '@'").then. \
+        add("n += tokenize_cli_line(cli->response_file_maps[k++], new_argv + n, new_argc - n);"). \
+        cont()
+    b.add("new_argv[n++] = argv[i];")
+    b.add("}")
+    b.add("new_argv[n] = NULL;")
+    b.add("*argc_ptr = n;")
+    b.add("*argv_ptr = new_argv;")
+    b.ret(1)
+
+def c_string_literal(s):
+    # type: (str) -> str
+    """Return the C string literal for the given string"""
+    return '"{0}"'.format(s.replace('\\', '\\\\').replace('"', '\\"'))
+
+def pattern_corpus(pattern):
+    # type: (Pattern) -> List[Tuple[str, List[str]]]
+    """
+    Return the argument vectors that the benchmark replays for the given
+    pattern as a list of kinds and arguments, not including the program
+    name. A valid vector with the first option of each group and values for
+    all arguments, one with an unknown option and, if applicable, one with
+    mutually exclusive options and one without the required arguments are
+    created. All but the valid one are rejected by the parser.
+    """
+    corpus = [] # type: List[Tuple[str, List[str]]]
+    valid = [] # type: List[str]
+    exclusive = [] # type: List[str]
+
+    # The indices of the values of positional arguments in valid
+    positional = set() # type: Set[int]
+    variadic = False
+    required = False
+
+    # Where the exclusive option is inserted, which is before any argument
+    # that might be variadic
+    exclusive_pos = 0
+    for command in pattern.list:
+        while command is not None:
+            valid.append(command.command if command.arg is None else command.command + "=value")
+            for o in command.options:
+                alternatives = o.list if isinstance(o, Optional) else [o]
+                for a in alternatives[:2] if len(exclusive) == 0 and len(alternatives) > 1 else alternatives[:1]:
+                    if isinstance(a, Arg):
+                        args = ["file1", "file2", "file3"] if a.variadic else ["value"]
+                        positional.update(range(len(valid), len(valid) + len(args)))
+                        variadic = variadic or a.variadic
+                        required = required or not isinstance(o, Optional)
+                    elif a.arg is not None:
+                        args = [a.command, "value"]
+                    else:
+                        args = [a.command]
+                    if a is alternatives[0]:
+                        valid.extend(args)
+                    else:
+                        exclusive = args
+                        exclusive_pos = len(valid)
+            command = command.subcommand
+    corpus.append(("valid", valid))
+    # Behind the values of all arguments, an unknown option would be taken
+    # as a value of a variadic argument, in front of the command it cannot
+    if variadic:
+        corpus.append(("unknown", ["--unknown-option"] + valid))
+    else:
+        corpus.append(("unknown", valid + ["--unknown-option"]))
+    if len(exclusive) != 0:
+        corpus.append(("mx", valid[:exclusive_pos] + exclusive + valid[exclusive_pos:]))
+    if required:
+        corpus.append(("missing", [a for k, a in enumerate(valid) if k not in positional]))
+    return corpus
+
+def bench_corpus(template):
+    # type: (Template) -> List[Tuple[str, List[str]]]
+    """
+    Return the argument vectors that the benchmark replays for all patterns
+    of the given template, see pattern_corpus(), and one that asks for help.
+    """
+    corpus = [] # type: List[Tuple[str, List[str]]]
+    for pattern in template.list:
+        corpus.extend(pattern_corpus(pattern))
+    corpus.append(("help", ["--help"]))
+    return corpus
+
+def write_bench_main(b, cases):
+    # type: (Block, str) -> None
+    """
+    Write the body of the main() function of the benchmark, which replays
+    all cases of the given table and reports the time and, if available,
+    the number of branches per parse.
+    """
+    b.locals.add('iterations', 'long', '1000000')
+    b.locals.add('rest', 'char *')
+    b.locals.add('n', 'long')
+    b.locals.add('k', 'int')
+    b.locals.add('ok', 'long')
+    b.locals.add('fd', 'int')
+    b.locals.add('branches', 'long long')
+    b.locals.add('start', 'struct timespec')
+    b.locals.add('end', 'struct timespec')
+    b.locals.add('ns', 'double')
+    b.locals.add('attr', 'struct perf_event_attr')
+
+    then = b.iff("argc > 1").then
+    then.add("iterations = strtol(argv[1], &rest, 10);")
+    then.iff("rest == argv[1] || *rest || iterations <= 0").then. \
+        add('fprintf(stderr, "usage: %s [<iterations>]\\nThe number of iterations must be positive\\n", argv[0]);'). \
+        ret(1)
+
+    # Branches are counted via perf events, which may be unavailable
+    b.add("memset(&attr, 0, sizeof(attr));")
+    b.add("attr.type = PERF_TYPE_HARDWARE;")
+    b.add("attr.size = sizeof(attr);")
+    b.add("attr.config = PERF_COUNT_HW_BRANCH_INSTRUCTIONS;")
+    b.add("attr.disabled = 1;")
+    b.add("attr.exclude_kernel = 1;")
+    b.add("attr.exclude_hv = 1;")
+    b.add("fd = syscall(__NR_perf_event_open, &attr, 0, -1, -1, 0);")
+
+    b.add('printf("%-8s %12s %12s %16s %8s  %s\\n", "kind", "ns/parse", "ns/token", "branches/parse", "ok", "arguments");')
+    b.add("for (k=0; k < (int)(sizeof({0}) / sizeof({0}[0])); k++)".format(cases))
+    b.add("{")
+    b.add("ok = 0;")
+    b.add("branches = -1;")
+    b.iff("fd >= 0").then.add("ioctl(fd, PERF_EVENT_IOC_RESET, 0);").add("ioctl(fd, PERF_EVENT_IOC_ENABLE, 0);")
+    b.add("clock_gettime(CLOCK_MONOTONIC, &start);")
+    b.add("for (n=0; n < iterations; n++)")
+    b.add("{")
+    b.add("struct cli cli = {0};")
+    b.add("struct cli_result res;")
+    b.add("ok += parse_cli_r({0}[k].argc, (char **){0}[k].argv, &cli, &res);".format(cases))
+    b.add("}")
+    b.add("clock_gettime(CLOCK_MONOTONIC, &end);")
+    then = b.iff("fd >= 0").then
+    then.add("ioctl(fd, PERF_EVENT_IOC_DISABLE, 0);")
+    then.iff("read(fd, &branches, sizeof(branches)) != sizeof(branches)").then.add("branches = -1;")
+    b.add("ns = ((end.tv_sec - start.tv_sec) * 1e9 + (end.tv_nsec - start.tv_nsec)) / iterations;")
+    b.add('printf("%-8s %12.1f %12.1f %16.1f %8.2f  %s\\n", {0}[k].kind, ns, ns / {0}[k].tokens, branches < 0 ? -1.0 : (double)branches / iterations, (double)ok / iterations, {0}[k].text);'.format(cases))
+    b.add("}")
+    b.ret(0)
+
+class PhaseTimings(object):
+    """
+    Records the time that is spent in the phases of genopts() and in the
+    steps within them, as well as counts that characterize the template and
+    the output.
+    """
+    def __init__(self):
+        # type: () -> None
+        self.phases = collections.OrderedDict() # type: Dict[str, float]
+        self.steps = collections.OrderedDict() # type: Dict[str, Dict[str, float]]
+        self.counts = collections.OrderedDict() # type: Dict[str, int]
+        self.pending = [] # type: List[Tuple[str, float]]
+        self.last = self.last_step = time.time()
+
+    def mark(self, phase):
+        # type: (str) -> None
+        """Mark the end of the given phase, which started with the previous mark"""
+        now = time.time()
+        self.phases[phase] = self.phases.get(phase, 0.0) + now - self.last
+        self.last = self.last_step = now
+        if len(self.pending) > 0:
+            steps = self.steps.setdefault(phase, collections.OrderedDict())
+            for step, duration in self.pending:
+                steps[step] = steps.get(step, 0.0) + duration
+            self.pending = []
+
+    def step(self, step):
+        # type: (str) -> None
+        """
+        Mark the end of the given step of the current phase, which started
+        with the previous step or the beginning of the phase
+        """
+        now = time.time()
+        self.pending.append((step, now - self.last_step))
+        self.last_step = now
+
+    def count(self, name, n):
+        # type: (str, int) -> None
+        """Add n to the count of the given name"""
+        self.counts[name] = self.counts.get(name, 0) + n
+
+    def report(self):
+        # type: () -> str
+        """Return a human readable report of the phases, steps and counts"""
+        lines = [] # type: List[str]
+        for phase, duration in self.phases.items():
+            lines.append("{0:<24}{1:10.3f} ms".format(phase, duration * 1000))
+            for step, step_duration in self.steps.get(phase, {}).items():
+                lines.append("  {0:<22}{1:10.3f} ms".format(step, step_duration * 1000))
+        lines.append("{0:<24}{1:10.3f} ms".format("total", sum(self.phases.values()) * 1000))
+        for name, n in self.counts.items():
+            lines.append("{0:<24}{1:10d}".format(name, n))
+        return "\n".join(lines) + "\n"
+
+    def as_dict(self):
+        # type: () -> Dict[str, Any]
+        """Return the phases, steps and counts, e.g., to dump them as JSON"""
+        return collections.OrderedDict([
+            ('phases', self.phases),
+            ('steps', self.steps),
+            ('counts', self.counts)])
+
+def generator_digest():
+    # type: () -> str
+    """
+    Return a digest of the sources of the generator, which identifies its
+    version for the purpose of caching.
+    """
+    h = hashlib.sha1()
+    base = os.path.dirname(os.path.abspath(__file__))
+    for name in ["genopts.py", os.path.join("lib", "parser.py")]:
+        with open(os.path.join(base, name), 'rb') as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+# The number of entries of each kind that a GeneratorCache keeps in memory
+MEMORY_CACHE_ENTRIES = {'patterns': 20000, 'outputs': 64}
+
+class GeneratorCache(object):
+    """
+    A cache of the parse trees of single patterns and of complete outputs.
+    Entries are addressed by a hash of their input and the version of the
+    generator, so they never need to be invalidated explicitly. The most
+    recently used ones are kept in memory and, unless directory is None,
+    all of them also on disk.
+    """
+    def __init__(self, directory=None, limits=MEMORY_CACHE_ENTRIES):
+        # type: (str, Dict[str, int]) -> None
+        self.directory = directory
+        self.version = generator_digest()
+        # Entries that were recently loaded or stored by this process, which
+        # stay warm as long as the cache object lives, e.g., in the server.
+        # The least recently used ones are dropped beyond the given limits
+        self.limits = limits
+        self.memory = collections.defaultdict(collections.OrderedDict) # type: DefaultDict[str, collections.OrderedDict[str, Any]]
+        if directory is None:
+            return
+        for sub in ["patterns", "outputs"]:
+            path = os.path.join(directory, sub)
+            if not os.path.isdir(path):
+                try:
+                    os.makedirs(path)
+                except OSError:
+                    # Possibly created by a concurrent run
+                    if not os.path.isdir(path):
+                        raise
+
+    def __getstate__(self):
+        # type: () -> Dict[str, Any]
+        # Don't copy the entries in memory to the processes of a pool
+        state = self.__dict__.copy()
+        state['memory'] = collections.defaultdict(collections.OrderedDict)
+        return state
+
+    def remember(self, kind, key, value):
+        # type: (str, str, Any) -> None
+        """Keep the given entry in memory as the most recently used one"""
+        entries = self.memory[kind]
+        entries.pop(key, None)
+        entries[key] = value
+        if len(entries) > self.limits.get(kind, 0):
+            entries.popitem(last=False)
+
+    def key(self, *parts):
+        # type: (str) -> str
+        """Return the key for the given parts of an input"""
+        h = hashlib.sha1(self.version.encode('utf-8'))
+        for part in parts:
+            h.update(b"\0")
+            h.update(part.encode('utf-8'))
+        return h.hexdigest()
+
+    def load(self, kind, key):
+        # type: (str, str) -> Any
+        """Return the entry of the given kind and key, or None if there is none"""
+        value = self.memory[kind].get(key)
+        if value is None and self.directory is not None:
+            try:
+                with open(os.path.join(self.directory, kind, key), 'rb') as f:
+                    value = pickle.load(f)
+            except Exception:
+                # Missing or damaged entries are just recreated
+                return None
+        if value is not None:
+            self.remember(kind, key, value)
+        return value
+
+    def store(self, kind, key, value):
+        # type: (str, str, Any) -> None
+        """Store the given entry, which becomes visible atomically"""
+        self.remember(kind, key, value)
+        if self.directory is None:
+            return
+        af = AtomicFile(os.path.join(self.directory, kind, key), 'wb')
+        try:
+            pickle.dump(value, af.f, pickle.HIGHEST_PROTOCOL)
+        except BaseException:
+            af.discard()
+            raise
+        af.commit()
+
+    def parse_pattern(self, pattern):
+        # type: (str) -> Pattern
+        """Parse the given normalized pattern unless its parse tree is cached"""
+        key = self.key(pattern)
+        tree = self.load("patterns", key)
+        if tree is None:
+            tree = parse_pattern(pattern)
+            if tree is not None:
+                self.store("patterns", key, tree)
+        return tree
+
+class GeneratorError(Exception):
+    """Raised if a template or the given options cannot be processed"""
+    pass
+
+# Below this number of patterns, parsing is not worth starting processes
+PARALLEL_MIN_PATTERNS = 256
+
+def parse_pattern_job(job):
+    # type: (Tuple[List[str], GeneratorCache]) -> List[Pattern]
+    """
+    Parse the given normalized patterns, possibly via the cache, in a
+    process of the pool. A pattern that cannot be parsed yields None.
+    """
+    patterns, cache = job
+    trees = [] # type: List[Pattern]
+    for p in patterns:
+        try:
+            if cache is not None:
+                trees.append(cache.parse_pattern(p))
+            else:
+                trees.append(parse_pattern(p))
+        except IndexError:
+            # Raised by the parser for some incomplete patterns
+            trees.append(None)
+    return trees
+
+# The number of patterns that a process of the pool parses at once
+PARALLEL_CHUNK_PATTERNS = 64
+
+def iter_parse_patterns(entries, jobs=1, cache=None):
+    # type: (Iterable[Tuple[str, str]], int, GeneratorCache) -> Iterator[Tuple[str, Pattern]]
+    """
+    Parse the patterns of the given pairs of text and location lazily and
+    yield the normalized text and the parse tree of each in the same order.
+    If jobs is larger than one and there are enough patterns, they are
+    parsed in chunks by a pool of that many processes, of which only a few
+    are in flight at any time. Raises a GeneratorError with a message that
+    refers to the location of the first pattern that cannot be parsed.
+    """
+    entries = iter(entries)
+    # Look ahead only if the patterns may be parsed in parallel
+    head = list(itertools.islice(entries, PARALLEL_MIN_PATTERNS)) if jobs > 1 else []
+    if len(head) >= PARALLEL_MIN_PATTERNS:
+        chunks = chunked(itertools.chain(head, entries), PARALLEL_CHUNK_PATTERNS)
+        pool = multiprocessing.Pool(jobs)
+        try:
+            pending = collections.deque() # type: Deque[Tuple[List[Tuple[str, str]], Any]]
+            for chunk in chunks:
+                pending.append((chunk, pool.apply_async(parse_pattern_job, (([t.strip() for t, _ in chunk], cache),))))
+                if len(pending) > jobs * 2:
+                    chunk, job = pending.popleft()
+                    for parsed in check_parsed(chunk, job.get()):
+                        yield parsed
+            while len(pending) > 0:
+                chunk, job = pending.popleft()
+                for parsed in check_parsed(chunk, job.get()):
+                    yield parsed
+        finally:
+            pool.terminate()
+            pool.join()
+    else:
+        for entry in itertools.chain(head, entries):
+            for parsed in check_parsed([entry], parse_pattern_job(([entry[0].strip()], cache))):
+                yield parsed
+
+def chunked(iterable, size):
+    # type: (Iterable[Any], int) -> Iterator[List[Any]]
+    """Yield the elements of the given iterable in lists of the given size"""
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if len(chunk) == 0:
+            return
+        yield chunk
+
+def check_parsed(chunk, trees):
+    # type: (List[Tuple[str, str]], List[Pattern]) -> Iterator[Tuple[str, Pattern]]
+    """Pair the given parsed chunk with its trees, failing at the first missing one"""
+    for (text, location), tree in zip(chunk, trees):
+        if tree is None:
+            raise GeneratorError("{0}: Cannot parse pattern \"{1}\"".format(location, text.strip()))
+        yield text.strip(), tree
+
+def default_locations():
+    # type: () -> Iterator[str]
+    """Yield the locations of the lines of stdin"""
+    for k in itertools.count():
+        yield "<stdin>:{0}".format(k + 1)
+
+def parse_patterns(patterns, locations=None, jobs=1, cache=None):
+    # type: (Iterable[str], Iterable[str], int, GeneratorCache) -> List[Pattern]
+    """
+    Parse the given patterns and return their parse trees in the same order,
+    see iter_parse_patterns().
+    """
+    if locations is None:
+        locations = default_locations()
+    return [tree for _, tree in iter_parse_patterns(itertools.izip(patterns, locations), jobs, cache)]
+
+def input_files(args):
+    # type: (List[str]) -> List[str]
+    """
+    Return the files that are denoted by the given arguments, which are
+    files, directories, whose *.genopts files are taken, or glob patterns.
+    The files of a directory or a glob pattern are sorted by name.
+    """
+    files = [] # type: List[str]
+    for arg in args:
+        if os.path.isdir(arg):
+            matches = sorted(glob.glob(os.path.join(arg, "*.genopts")))
+        elif glob.has_magic(arg):
+            matches = sorted(glob.glob(arg))
+        else:
+            matches = [arg]
+        if len(matches) == 0:
+            sys.exit("No input files match \"{0}\"".format(arg))
+        files.extend(matches)
+    return files
+
+def read_patterns(f, name):
+    # type: (IO[str], str) -> Iterator[Tuple[str, str]]
+    """
+    Read the patterns of the given file line by line and yield each along
+    with its location, i.e., the given name and the number of its first
+    line. Blank lines and comments, i.e., lines starting with #, are
+    skipped. A backslash at the end of a line continues the pattern on the
+    next line.
+    """
+    parts = [] # type: List[str]
+    start = 0
+    for k, line in enumerate(iter(f.readline, '')):
+        text = line.strip()
+        if len(parts) == 0:
+            if len(text) == 0 or text.startswith('#'):
+                continue
+            start = k + 1
+        if text.endswith('\\'):
+            parts.append(text[:-1].strip())
+            continue
+        parts.append(text)
+        yield " ".join(p for p in parts if len(p) > 0), "{0}:{1}".format(name, start)
+        parts = []
+    if len(parts) > 0:
+        # The last line was continued
+        yield " ".join(p for p in parts if len(p) > 0), "{0}:{1}".format(name, start)
+
+def iter_inputs(files):
+    # type: (List[str]) -> Iterator[Tuple[str, str]]
+    """
+    Yield the patterns of the given files, or of stdin if no file is given,
+    and the location of each one, see read_patterns(). Files are opened one
+    after another once the patterns of the previous one have been consumed.
+    """
+    if len(files) == 0:
+        for entry in read_patterns(sys.stdin, "<stdin>"):
+            yield entry
+        return
+
+    for name in files:
+        try:
+            f = open(name)
+        except IOError as e:
+            sys.exit("Cannot read input file \"{0}\": {1}".format(name, e.strerror))
+        with f:
+            for entry in read_patterns(f, name):
+                yield entry
+
+def read_inputs(files):
+    # type: (List[str]) -> Tuple[List[str], List[str]]
+    """
+    Read the patterns of the given files, or of stdin if no file is given.
+    Returns the patterns and the location of each one as file:line.
+    """
+    entries = list(iter_inputs(files))
+    return [text for text, _ in entries], [location for _, location in entries]
+
+def split_entries(entries):
+    # type: (Iterable[Tuple[str, str]]) -> Tuple[Iterator[str], Iterator[str]]
+    """
+    Split the given pairs of text and location lazily into the texts and the
+    locations, which must be consumed in lockstep, e.g., by analyze().
+    """
+    texts, locations = itertools.tee(entries)
+    return (text for text, _ in texts), (location for _, location in locations)
+
+class GeneratorResult(object):
+    """
+    The outcome of the analysis of a template, i.e., the variables, helpers
+    and functions of the parser, from which each backend emits its code.
+    """
+    def __init__(self, context, includes, functions):
+        # type: (GeneratorContext, List[str], List[Function]) -> None
+        self.context = context
+        self.includes = includes
+        self.functions = functions
+
+def analyze(patterns, backend, dont_skip_first_arg, dispatch='chain', scoped=False, validation='inline', packed_flags=False, reentrant=False, line=False, response_files=False, bench=False, optimization=1, timings=None, cache=None, jobs=1, locations=None):
+    # type: (Iterable[str], Backend, bool, str, bool, str, bool, bool, bool, bool, bool, int, PhaseTimings, GeneratorCache, int, Iterable[str])->GeneratorResult
+    """
+    Parse and analyze the given patterns and build the functions of the
+    parser, which are optimized according to the given level. The result
+    does not depend on the backend that is given here apart from the way
+    argc and argv are accessed, which all backends share, so it can be
+    emitted with any backend by emit().
+    """
+    if timings is None:
+        timings = PhaseTimings()
+
+    # The benchmark uses parse_cli_r() to avoid measuring the costs of
+    # printing errors
+    if bench:
+        reentrant = True
+
+    context = GeneratorContext(backend, dispatch, scoped, validation, packed_flags)
     cli_var = context.cli_arg_var
     cli_access = context.cli_access
     aux_var = context.aux_arg_var
     aux_access = context.aux_access
-    navigate(template, GenerateParserVisitor(context))
-
-    cur_command = context.cur_command_var
-    cur_position = context.cur_position_var
-
-    if "--help" not in context.token_action_map:
-        help = cli_access("help", "int")
-        help_cmd = aux_access("help_cmd", "int")
-
-        # << means assignment
-        context.token_action_map.add("--help").\
-            add(help << 1).\
-            add(help_cmd << cur_command)
 
+    # Navigate the template only once for all visitors that gather
+    # information, the mutual exclusions are validated only after the
+    # validation of commands, which depends on the complete information
     option_with_args = [] # type: List[OptionWithArg]
     all_commands = [] # type: List[Tuple[List[Command], List[Arg], Set[str]]]
-    navigate(template, OptionWithArgExtractorVisitor(True, option_with_args))
-    navigate(template, CommandListExtractorVisitor(all_commands))
+    mx_validator = GenerateMXValidatorVisitor(None, context)
+    visitors = [
+        GenerateParserVisitor(context),
+        OptionWithArgExtractorVisitor(True, option_with_args),
+        CommandListExtractorVisitor(all_commands),
+        mx_validator] # type: List[Visitor]
+    composite = CompositeVisitor(visitors)
+
+    # Each pattern is navigated as soon as it has been parsed and its parse
+    # tree is dropped afterwards, the benchmark keeps only its vectors. The
+    # texts have to be kept, they are all listed by usage_cli()
+    if locations is None:
+        locations = default_locations()
+    texts = [] # type: List[str]
+    corpus = [] # type: List[Tuple[str, List[str]]]
+    template = Template([])
+    composite.enter_template(template)
+    for text, tree in iter_parse_patterns(itertools.izip(patterns, locations), jobs, cache):
+        timings.mark('parse')
+        texts.append(text)
+        navigate(tree, composite)
+        if bench:
+            corpus.extend(pattern_corpus(tree))
+        timings.step('navigate')
+        timings.mark('analyze')
+    composite.leave_template(template)
+    if len(texts) == 0:
+        raise GeneratorError("Input must contain at least one pattern")
 
-    gf = GenFile()
-
-    backend.write_multiline_comment(gf, "Automatically generated file, please don't edit!")
+    cur_command = context.cur_command_var
+    cur_position = context.cur_position_var
 
-    backend.write_header(gf)
+    if "--help" not in context.token_action_map:
+        context.token_action_map.add("--help").add(context.set_cli_flag("help"))
+
+    # The commands of options that every command accepts need not be
+    # checked, they must only be rejected before the first command. With
+    # scoped dispatch, the dispatcher accepts the options only for proper
+    # commands
+    checked_options = [] # type: List[OptionWithArg]
+    global_options = [] # type: List[OptionWithArg]
+    if not scoped:
+        command_names = context.command_index_map.index.keys()
+        for n in option_with_args:
+            if context.parent_map.is_global(n, command_names):
+                global_options.append(n)
+            else:
+                checked_options.append(n)
+    write_command_tracking(context, checked_options)
+    write_global_option_tracking(context, global_options)
+
+    if validation == 'table' and len(checked_options) != 0:
+        context.aux_var("option_cmd[{0}]".format(len(checked_options)), "int")
+        context.cmd_fields.append("option_cmd[{0}]".format(len(checked_options)))
+
+    includes = [] # type: List[str]
+    if packed_flags:
+        words = context.pack_flags(mx_validator.group_names())
+        context.cli_var("flags[{0}]".format(words), "uint32_t")
+        includes.append("stdint.h")
+
+        context.helpers.append(Enum("cli_flag_t", sorted([(flag_const(name), bit) for name, bit in context.flags.items()], key=lambda f: f[1])))
+        context.helpers.append(Macro("cli_flag(cli, f)", "(((cli)->flags[(f) >> 5] >> ((f) & 31)) & 1)"))
+        context.helpers.append(Macro("cli_set_flag(cli, f)", "((cli)->flags[(f) >> 5] |= (uint32_t)1 << ((f) & 31))"))
+
+        # Fields that record commands need to hold only the command indices
+        # and -1, which is the initial value of cur_command
+        cmd_type = smallest_int_type(-1, context.command_index_map.cur_num - 1)
+        for name in context.cmd_fields:
+            context.aux_vars[name].vtype = cmd_type
 
-    backend.write_variables(gf, context.cli_vars)
-    gf.writeline()
-    backend.write_variables(gf, context.aux_vars)
-    gf.writeline()
+    argc_var = V('argc', 'int')
+    argv_var = V('argv', 'char **')
 
-    backend.write_enum(gf, 'parse_cli_options_t',
-            [
-            ('POF_VALIDATE', 1<<0),
-            ('POF_USAGE', 1<<1)
-            ])
+    if line or response_files:
+        line_var = V('line', 'char *')
+        max_argc_var = V('max_argc', 'int')
+
+        tcl = Function(
+            output="static int",
+            name="tokenize_cli_line",
+            input=[line_var, argv_var, max_argc_var])
+        tcl.description = """
+            Split the given line into arguments in place, i.e., the elements
+            of argv point into line, which is modified accordingly.
+
+            @param line the line to split
+            @param argv receives the arguments, or NULL to count them only
+            @param max_argc the number of elements argv can hold
+            @return the number of arguments, -1 if there are more than
+                    max_argc ones, or -2 if a quote is not terminated.
+            """
+        write_line_tokenizer(tcl)
+        context.helpers.append(tcl)
+
+    if response_files:
+        context.cli_var("response_file_maps", "char **")
+        context.cli_var("response_file_sizes", "size_t *")
+        context.cli_var("response_file_count", "int")
+        context.cli_var("response_file_argv", "char **")
+        includes += ["stdlib.h", "fcntl.h", "unistd.h", "sys/mman.h", "sys/stat.h"]
+
+        # Precedes the expansion, which releases the files of a previous call
+        cc = Function(
+            output="static void",
+            name="cleanup_cli",
+            input=[cli_var])
+        cc.description = """
+            Release the resources of the given cli that have been allocated
+            by parse_cli() for response files.
+            """
+        cc.locals.add('i', 'int')
+        cc.add("for (i=0; i < cli->response_file_count; i++)")
+        cc.add("{")
+        cc.add("munmap(cli->response_file_maps[i], cli->response_file_sizes[i]);")
+        cc.add("}")
+        cc.add("free(cli->response_file_maps);")
+        cc.add("free(cli->response_file_sizes);")
+        cc.add("free(cli->response_file_argv);")
+        cc.add("cli->response_file_maps = NULL;")
+        cc.add("cli->response_file_sizes = NULL;")
+        cc.add("cli->response_file_count = 0;")
+        cc.add("cli->response_file_argv = NULL;")
+        context.helpers.append(cc)
+
+        ercf = Function(
+            output="static int",
+            name="expand_cli_response_files",
+            input=[V('argc_ptr', 'int *'), V('argv_ptr', 'char ***'), cli_var])
+        ercf.description = """
+            Replace each argument of the form @path by the arguments that
+            are contained in the file at path. The files are mapped into
+            memory and tokenized in place, the arguments point into the
+            mappings. The files of a previous call are released first, use
+            cleanup_cli() to release them once cli is no longer used.
+
+            @return 1 if successful, 0 otherwise.
+            """
+        write_response_file_expander(ercf)
+        context.helpers.append(ercf)
+
+    if bench:
+        includes += ["stdlib.h", "time.h", "unistd.h", "sys/ioctl.h", "sys/syscall.h", "linux/perf_event.h"]
+
+    timings.count('patterns', len(texts))
+    timings.count('tokens', len(context.token_action_map.token_action_map))
+    timings.count('commands', len(context.command_index_map.index))
+    timings.count('positional_slots', sum(len(slot) for slot in context.positional_action_map.action_map))
+    timings.count('mx_groups', len(mx_validator.groups))
+    timings.mark('analyze')
 
     # Generates the validation function
     vc = Function(
         output="static int",
         name="validate_cli",
         input=[cli_var, aux_var])
-    vc.iff(cli_access("help")).then.ret(1)
-    write_command_validation(vc, context.command_index_map, context.parent_map, option_with_args)
-    navigate(template, GenerateMXValidatorVisitor(vc))
+    vc.iff(context.cli_flag("help")).then.ret(1)
+    write_global_option_validation(vc, context, global_options)
+    if validation == 'table':
+        write_command_validation_table(vc, context, checked_options)
+    else:
+        write_command_validation(vc, context, checked_options)
+    mx_validator.write(vc)
 
     # Determine the maximal number of commands for all patterns
     max_commands = max(len(context.command_index_map.map_list(key[0])) for key in all_commands)
@@ -1305,64 +3733,44 @@ def genopts(patterns, backend, dont_skip_first_arg):
     all_commands = sorted(all_commands, key=all_commands_key)
 
     # Add a check for proper command specificiation
-    first = True
+    chain = vc # type: Block
     for commands in all_commands:
-        conds = [] # type: List[str]
-        for command in commands[0]:
-            conds.append("cli->{0}".format(makename(command)))
-        vc.add("{0} ({1})".format("if" if first else "else if", " && ".join(conds)))
-        vc.add("{")
+        conds = [context.cli_flag(makename(command)) for command in commands[0]]
+        arm = chain.iff(LogicalExpression('&&', conds)).then
 
         all_args = commands[1] # type: List[Arg]
         optional_args = commands[2] # type: Set[str]
 
-        # FIXME: Generalize
-        if not any(a.variadic for a in all_args) and len(all_args) == 2 and len(optional_args) == 1 and all_args[0].command in optional_args:
-            # Resolve cases with optional first positional arguments, for now
-            # only in case of two arguments, e.g., [optional] required
-
-            # Check if second positional arg has been set
-            then = vc.iff(aux_access("positional1")).then
-
-            # In this case, we can assign them as indented, i.e., subsequently
-            for pos, arg in enumerate(commands[1]):
-                cmd_name = makecname(arg.command)
-
-                then.add(cli_access(cmd_name) << aux_access("positional{0}".format(pos)))
-
-            # But if the second positional arg is not set, the actual first given
-            # positional arg is meant to be the second positional one in the template
-            then.otherwise().add(cli_access(makecname(all_args[1].command)) << aux_access("positional0"))
+        required = [pos for pos, a in enumerate(all_args) if a.command not in optional_args]
+        if not any(a.variadic for a in all_args) and len(required) != 0 and any(a.command in optional_args for a in all_args[:required[-1]]):
+            # Optional positional arguments precede required ones, e.g.,
+            # [optional] required, so which ones were given depends on
+            # their number
+            write_positional_resolution(arm, context, all_args, optional_args)
         else:
             # Resolve positional arguments
             for pos, arg in enumerate(commands[1]):
                 cmd_name = makecname(arg.command)
 
                 if arg.variadic:
-                    vc.add(cli_access(cmd_name + "_count") << aux_access("variadic_argc"))
-                    vc.add(cli_access(cmd_name) << aux_access("variadic_argv"))
+                    arm.add(cli_access(cmd_name + "_count") << aux_access("variadic_argc"))
+                    arm.add(cli_access(cmd_name) << aux_access("variadic_argv"))
                 else:
-                    vc.add(cli_access(cmd_name) << aux_access("positional{0}".format(pos)))
+                    arm.add(cli_access(cmd_name) << aux_access("positional{0}".format(pos)))
 
         for a in all_args:
             if a.command not in optional_args:
-                vc.iff(IsFalse(cli_access(makecname(a.command)))).then. \
-                    printerr("Required argument \\\"{0}\\\" is missing. Use --help for usage\\n".format(a.command)). \
+                arm.iff(IsFalse(cli_access(makecname(a.command)))).then. \
+                    add(context.error('CLI_ERR_MISSING_ARGUMENT', "Required argument \\\"{0}\\\" is missing. Use --help for usage\\n".format(a.command))). \
                     ret(0)
 
-        vc.add("}")
-        first = False
-    if not first:
-        vc.add("else")
-        vc.add("{")
-        vc.printerr('Please specify a proper command. Use --help for usage.\\n')
-        vc.ret(0)
-        vc.add("}")
+        chain = arm.otherwise()
+    if chain is not vc:
+        chain.add(context.error('CLI_ERR_NO_COMMAND', 'Please specify a proper command. Use --help for usage.\\n'))
+        chain.ret(0)
 
     vc.ret(1)
-    backend.write_block(gf, vc)
-
-    gf.writeline()
+    timings.step('validate_cli')
 
     cmd_var = V('cmd', 'char *')
     uc = Function(
@@ -1375,19 +3783,15 @@ def genopts(patterns, backend, dont_skip_first_arg):
         @return 1 if usage has been printed, 0 otherwise.
         """
 
-    uc.iff(IsFalse(cli_access("help", "int"))).then.ret(0)
+    uc.iff(IsFalse(context.cli_flag("help"))).then.ret(0)
     uc.printerr("usage: %s <command> [<options>]\\n", cmd_var)
-    for pattern in sorted(patterns):
-        uc.printerr("{0}\\n".format(pattern.strip()))
+    for text in sorted(texts):
+        uc.printerr("{0}\\n".format(text))
     uc.ret(1)
-    backend.write_block(gf, uc)
+    timings.step('usage_cli')
 
     # Generate a function that parses the command line and populates
     # the struct cli. It does not yet make verification
-    gf.writeline()
-
-    argc_var = V('argc', 'int')
-    argv_var = V('argv', 'char **')
 
     # Construct parse_cli_simple() function
     pcs = Function(
@@ -1400,22 +3804,17 @@ def genopts(patterns, backend, dont_skip_first_arg):
     pcs.locals.add_var(cur_command)
     pcs.locals.add_var(cur_position)
 
-    pcs.add("for (i=0; i < argc; i++)")
-    pcs.add("{")
+    body = pcs.loop("i=0", "i < argc", "i++")
+    first = context.token_action_map.write(body)
+    first = context.positional_action_map.write(body, first)
 
-    context.token_action_map.write(pcs)
-    context.positional_action_map.write(pcs)
-
-    pcs.add("else")
-    pcs.add("{")
-    pcs.printerr('Unknown command or option \\"%s\\"\\n', backend.argv(i_var))
-    pcs.ret(0)
-    pcs.add("}")
-    pcs.add("}")
+    # Anything else is unknown, either as the else case of the chain or
+    # after the dispatchers that continue the loop
+    unknown = body if first else open_chain(body)
+    unknown.add(context.error('CLI_ERR_UNKNOWN', 'Unknown command or option \\"%s\\"\\n', index="i", arg_templates=["argv[{index}]"]))
+    unknown.ret(0)
     pcs.ret(1)
-    backend.write_block(gf, pcs)
-
-    gf.writeline()
+    timings.step('parse_cli_simple')
 
     opts_var = V('opts', 'parse_cli_options_t')
     pc = Function(
@@ -1439,36 +3838,686 @@ def genopts(patterns, backend, dont_skip_first_arg):
         pc.dec(argc_var)
         pc.inc(argv_var)
 
+    if response_files:
+        pc.iff(cond="!expand_cli_response_files(&argc, &argv, cli)").then.ret(0)
     pc.iff(cond="!parse_cli_simple(argc, argv, cli, &aux)").then.ret(0)
     pc.iff(cond="opts & POF_VALIDATE").then. \
         iff(cond="!validate_cli(cli, &aux)").then.ret(0)
     pc.iff(cond="opts & POF_USAGE").then.ret("!usage_cli(cmd, cli)")
     pc.ret(1)
-    backend.write_block(gf, pc)
+    timings.step('parse_cli')
+
+    functions = [vc, uc, pcs, pc]
+
+    if reentrant:
+        context.helpers.append(Enum("cli_error_t", ERROR_CODES))
+        result = Variables("cli_result")
+        for field in ["code", "index", "message", "option"]:
+            result.add_var(V(field, "int"))
+        context.helpers.append(result)
+
+        res_var = V('res', 'struct cli_result *')
+        vcr = vc.reentrant(res_var)
+        pcsr = pcs.reentrant(res_var)
+
+        pcr = Function(
+            output="static int",
+            name="parse_cli_r",
+            input=[argc_var, argv_var, cli_var, res_var])
+        pcr.description = """
+            Parse and validate the given arguments and fill the struct cli
+            accordingly. Errors are not printed but stored in res.
+
+            @param argc as in main()
+            @param argv as in main()
+            @param cli the filled struct
+            @param res receives the error code, the index of the offending
+                   element of argv and the id of the option, or -1 if not
+                   applicable.
+            @return 1 if parsing was successful, 0 otherwise.
+            """
+        pcr.locals.add("aux", "struct cli_aux", "{0}")
+        pcr.add(AccessMember(res_var, "code") << "CLI_OK")
+        for field in ["index", "message", "option"]:
+            pcr.add(AccessMember(res_var, field) << -1)
+        if not dont_skip_first_arg:
+            # Report indices that refer to the unshifted argv
+            then = pcr.iff(cond="!parse_cli_simple_r(argc - 1, argv + 1, cli, &aux, res)").then
+            then.iff(cond="res->index >= 0").then.inc(AccessMember(res_var, "index"))
+            then.ret(0)
+        else:
+            pcr.iff(cond="!parse_cli_simple_r(argc, argv, cli, &aux, res)").then.ret(0)
+        pcr.ret("validate_cli_r(cli, &aux, res)")
+
+        fce = Function(
+            output="static int",
+            name="format_cli_error",
+            input=[V('res', 'const struct cli_result *'), argv_var, V('buf', 'char *'), V('size', 'size_t')])
+        fce.description = """
+            Format the message of the error that has been stored by
+            parse_cli_r().
+
+            @param res the result of parse_cli_r()
+            @param argv as in main()
+            @param buf the buffer that receives the message
+            @param size the size of the buffer
+            @return the number of characters as snprintf()
+            """
+        write_error_formatter(fce, context)
+
+        functions += [vcr, pcsr, pcr, fce]
+        timings.step('reentrant')
+
+    if line:
+        aux_ptr_var = V('aux', 'struct cli_aux *')
+        pcrs = Function(
+            output="static void",
+            name="parse_cli_reset",
+            input=[cli_var, aux_ptr_var])
+        pcrs.description = """
+            Reset the given structs so that they can be used to parse
+            another command line.
+            """
+        if response_files:
+            # The struct may have been filled by parse_cli() before
+            pcrs.add("cleanup_cli(cli);")
+        pcrs.add("memset(cli, 0, sizeof(*cli));")
+        pcrs.add("memset(aux, 0, sizeof(*aux));")
+
+        pcl = Function(
+            output="static int",
+            name="parse_cli_line",
+            input=[line_var, argv_var, max_argc_var, cli_var, aux_ptr_var, opts_var])
+        pcl.description = """
+            Parse the given line, which does not start with the name of the
+            program, and fill the struct cli accordingly. No memory is
+            allocated: the line is tokenized in place and the elements of
+            the caller supplied argv refer to it, as do the strings of cli.
+            Both need to be kept as long as cli is used.
+
+            @param line the line to parse, which is modified
+            @param argv receives the arguments of the line
+            @param max_argc the number of elements argv can hold
+            @param cli the filled struct
+            @param aux auxiliary state, which is reset together with cli
+            @param opts some options to modify the behaviour of the function.
+                   POF_USAGE is ignored, use usage_cli() instead.
+            @return 1 if parsing was successful, 0 otherwise.
+            """
+        argc_local = pcl.locals.add("argc", "int")
+        pcl.add("parse_cli_reset(cli, aux);")
+        pcl.add(argc_local << "tokenize_cli_line(line, argv, max_argc)")
+        pcl.iff(argc_local < 0).then. \
+            printerr("%s\\n", DirectExpression('argc == -1 ? "Too many arguments" : "Unterminated quote"')). \
+            ret(0)
+        pcl.iff(cond="!parse_cli_simple(argc, argv, cli, aux)").then.ret(0)
+        pcl.iff(cond="opts & POF_VALIDATE").then. \
+            iff(cond="!validate_cli(cli, aux)").then.ret(0)
+        pcl.ret(1)
+
+        functions += [pcrs, pcl]
+        timings.step('line')
+
+    if bench:
+        case = Variables("bench_cli_case")
+        case.add_var(V("kind", "const char *"))
+        case.add_var(V("text", "const char *"))
+        case.add_var(V("argc", "int"))
+        case.add_var(V("tokens", "int"))
+        case.add_var(V("argv", "const char * const *"))
+        context.helpers.append(case)
+
+        rows = [] # type: List[str]
+        for k, (kind, args) in enumerate(corpus + [("help", ["--help"])]):
+            argv = args if dont_skip_first_arg else ["prog"] + args
+            name = "bench_cli_argv_{0}".format(k)
+            context.helpers.append(ConstArray(name, "char * const", [c_string_literal(a) for a in argv] + ["NULL"]))
+            rows.append("{{.kind = \"{0}\", .text = {1}, .argc = {2}, .tokens = {3}, .argv = {4}}}".format(
+                kind, c_string_literal(" ".join(args)), len(argv), max(len(args), 1), name))
+        context.helpers.append(ConstArray("bench_cli_cases", "struct bench_cli_case", rows))
+
+        bm = Function(
+            output="int",
+            name="main",
+            input=[argc_var, argv_var])
+        bm.description = """
+            Replay all cases of bench_cli_cases the number of times given by
+            the first argument, one million by default, and report the time
+            and the number of branches per parse.
+            """
+        write_bench_main(bm, "bench_cli_cases")
+        functions.append(bm)
+        timings.step('bench')
+
+    optimize(functions + [h for h in context.helpers if isinstance(h, Function)], context, optimization)
+    timings.step('optimize')
+
+    timings.mark('build')
+    return GeneratorResult(context, includes, functions)
+
+def emit(result, backend, out=None, timings=None):
+    # type: (GeneratorResult, Backend, Union[IO[str], AtomicFile], PhaseTimings)->None
+    """Write the code of the given analysis result with the given backend"""
+    if timings is None:
+        timings = PhaseTimings()
+    context = result.context
+
+    gf = GenFile(out)
 
+    backend.write_multiline_comment(gf, "Automatically generated file, please don't edit!")
+
+    backend.write_header(gf, result.includes)
+
+    backend.write_variables(gf, context.cli_vars)
     gf.writeline()
+    backend.write_variables(gf, context.aux_vars)
+    gf.writeline()
+
+    backend.write_enum(gf, 'parse_cli_options_t',
+            [
+            ('POF_VALIDATE', 1<<0),
+            ('POF_USAGE', 1<<1)
+            ])
+    timings.step('header')
+
+    for h in context.helpers:
+        backend.write_helper(gf, h)
+    timings.step('helpers')
+
+    for f in result.functions:
+        backend.write_block(gf, f)
+        gf.writeline()
     backend.write_footer(gf)
+    timings.step('functions')
+    timings.count('lines', gf.lines)
+    timings.mark('emit')
+
     gf.flush()
+    timings.mark('flush')
+
+def genopts(patterns, backend, dont_skip_first_arg, dispatch='chain', scoped=False, validation='inline', packed_flags=False, reentrant=False, line=False, response_files=False, bench=False, optimization=1, out=None, timings=None, cache=None, jobs=1, locations=None):
+    # type: (Iterable[str], Backend, bool, str, bool, str, bool, bool, bool, bool, bool, int, IO[str], PhaseTimings, GeneratorCache, int, Iterable[str])->None
+    if timings is None:
+        timings = PhaseTimings()
+    result = analyze(patterns, backend, dont_skip_first_arg, dispatch, scoped, validation, packed_flags, reentrant, line, response_files, bench, optimization, timings, cache, jobs, locations)
+    emit(result, backend, out, timings)
+
+# The backends that can be selected with --backend
+BACKENDS = collections.OrderedDict([('c', CBackend), ('java', JavaBackend)])
+
+# The options of genopts() that determine the generated code and their
+# defaults, in the order of its parameters
+GENERATOR_OPTIONS = collections.OrderedDict([
+    ('dont_skip_first_arg', False),
+    ('dispatch', 'chain'),
+    ('scoped', False),
+    ('validation', 'inline'),
+    ('packed_flags', False),
+    ('reentrant', False),
+    ('line', False),
+    ('response_files', False),
+    ('bench', False),
+    ('optimization', 1)])
+
+def generator_options(**options):
+    # type: (**Any) -> Dict[str, Any]
+    """
+    Return the given options of genopts() that determine the generated code
+    together with the defaults of the others in the order of
+    GENERATOR_OPTIONS. Raises a TypeError if an option is unknown.
+    """
+    unknown = sorted(set(options) - set(GENERATOR_OPTIONS))
+    if len(unknown) > 0:
+        raise TypeError("Unknown option \"{0}\"".format(unknown[0]))
+    return collections.OrderedDict((name, options.get(name, default)) for name, default in GENERATOR_OPTIONS.items())
 
-def main():
-    # type: ()->None
-    lines = sys.stdin.readlines()
-    if len(lines) < 1:
-        sys.exit("Input must contain at least one line")
+def check_options(backends, dont_skip_first_arg=False, dispatch='chain', scoped=False, validation='inline', packed_flags=False, reentrant=False, line=False, response_files=False, bench=False, optimization=1):
+    # type: (List[str], bool, str, bool, str, bool, bool, bool, bool, bool, int) -> None
+    """
+    Raise a GeneratorError if one of the given backends is unknown or does
+    not support the given options.
+    """
+    for name in backends:
+        if name not in BACKENDS:
+            raise GeneratorError("Unknown backend \"{0}\", use one of {1}".format(name, join_enum(list(BACKENDS), "or")))
 
-    backend = None # type: Backend
-    dont_skip_first_arg = False
+    if dispatch not in DISPATCH_MODES:
+        raise GeneratorError("Unknown dispatch mode \"{0}\", use one of {1}".format(dispatch, join_enum(DISPATCH_MODES, "or")))
+
+    if validation not in VALIDATION_MODES:
+        raise GeneratorError("Unknown validation mode \"{0}\", use one of {1}".format(validation, join_enum(VALIDATION_MODES, "or")))
+
+    if optimization not in OPTIMIZATION_LEVELS:
+        raise GeneratorError("Unknown optimization level \"{0}\", use one of {1}".format(optimization, join_enum([str(l) for l in OPTIMIZATION_LEVELS], "or")))
+
+    if 'java' not in backends:
+        return
+
+    if dispatch != 'chain':
+        raise GeneratorError("Dispatch mode \"{0}\" is supported only for the C backend".format(dispatch))
+
+    if validation != 'inline':
+        raise GeneratorError("Validation mode \"{0}\" is supported only for the C backend".format(validation))
+
+    if packed_flags:
+        raise GeneratorError("Packed flags are supported only for the C backend")
+
+    if reentrant:
+        raise GeneratorError("Reentrant functions are supported only for the C backend")
+
+    if line:
+        raise GeneratorError("Parsing of lines is supported only for the C backend")
 
-    for o in sys.argv[1:]:
+    if response_files:
+        raise GeneratorError("Response files are supported only for the C backend")
+
+    if bench:
+        raise GeneratorError("The benchmark is supported only for the C backend")
+
+class Generator(object):
+    """
+    Generates parsers within the calling process, e.g., for build systems
+    that generate many of them. Parse trees of patterns and complete outputs
+    are memoised across calls, so patterns that several templates share are
+    parsed only once. If cache_dir is given, they are also kept on disk as
+    with --cache-dir.
+    """
+    def __init__(self, cache_dir=None, jobs=1):
+        # type: (str, int) -> None
+        self.cache = GeneratorCache(cache_dir)
+        self.jobs = jobs
+
+    def generate(self, patterns, backend='c', **options):
+        # type: (Union[str, List[str]], str, **Any) -> str
+        """
+        Return the code of the given backend, 'c' or 'java', for the given
+        template, which is either a string in the format of the input files
+        or a list of patterns. The
+        options are the keyword arguments of genopts() that determine the
+        generated code, e.g., dispatch='hash'.
+        """
+        return self.generate_all(patterns, [backend], **options)[0]
+
+    def generate_all(self, patterns, backends, **options):
+        # type: (Union[str, List[str]], List[str], **Any) -> List[str]
+        """
+        Like generate(), but return the code of each of the given backends,
+        which share the analysis of the template.
+        """
+        options = generator_options(**options)
+        check_options(backends, **options)
+
+        locations = None # type: List[str]
+        if isinstance(patterns, basestring):
+            entries = list(read_patterns(StringIO(patterns), "<string>"))
+            patterns = [text for text, _ in entries]
+            locations = [location for _, location in entries]
+
+        instances = [BACKENDS[name]() for name in backends]
+        keys = [self.cache.key(b.__class__.__name__, repr(options), "\n".join(patterns)) for b in instances]
+        sources = [self.cache.load("outputs", key) for key in keys]
+        missing = [k for k, source in enumerate(sources) if source is None]
+        if len(missing) > 0:
+            result = analyze(patterns, instances[missing[0]], cache=self.cache, jobs=self.jobs, locations=locations, **options)
+            for k in missing:
+                buf = StringIO()
+                emit(result, instances[k], buf)
+                sources[k] = buf.getvalue()
+                self.cache.store("outputs", keys[k], sources[k])
+        return sources
+
+def generate(patterns, backend='c', **options):
+    # type: (Union[str, List[str]], str, **Any) -> str
+    """
+    Return the code of the given backend for the given template, see
+    Generator.generate(). Use a Generator to generate several parsers.
+    """
+    return Generator().generate(patterns, backend, **options)
+
+# The result and the backends that are shared with the workers of
+# emit_parallel(). The workers are forked, so they inherit it instead of
+# receiving a pickled copy, which would exceed the recursion limit for
+# deeply nested blocks
+emit_parallel_state = None # type: Tuple[GeneratorResult, List[Backend]]
+
+def emit_parallel_job(index):
+    # type: (int) -> str
+    result, backends = emit_parallel_state
+    buf = StringIO()
+    emit(result, backends[index], buf)
+    return buf.getvalue()
+
+def emit_parallel(result, backends, jobs):
+    # type: (GeneratorResult, List[Backend], int) -> List[str]
+    """
+    Emit the given result with each of the given backends in a pool of at
+    most jobs processes and return the code in the same order. Requires
+    fork().
+    """
+    global emit_parallel_state
+    emit_parallel_state = (result, backends)
+    pool = multiprocessing.Pool(min(jobs, len(backends)))
+    try:
+        return pool.map(emit_parallel_job, range(len(backends)))
+    finally:
+        pool.close()
+        pool.join()
+        emit_parallel_state = None
+
+# The formats of the report of --profile
+PROFILE_FORMATS = ['text', 'json']
+
+# The maximal time a client may take to send a request to the server
+SERVE_REQUEST_TIMEOUT = 60.0
+
+def serve_request(request, caches):
+    # type: (Dict[str, Any], Dict[str, GeneratorCache]) -> Dict[str, Any]
+    """
+    Run the generator for the given request of a client, which consists of
+    the arguments, the working directory and the text of stdin, and return
+    the exit status and the text that was written to stdout and stderr.
+    """
+    saved = (os.getcwd(), sys.stdin, sys.stdout, sys.stderr)
+    stdout = StringIO()
+    stderr = StringIO()
+    status = 0
+    try:
+        os.chdir(request['cwd'])
+        sys.stdin = StringIO((request.get('stdin') or u"").encode('utf-8'))
+        sys.stdout = stdout
+        sys.stderr = stderr
+        main([a.encode('utf-8') for a in request['args']], caches)
+    except SystemExit as e:
+        if isinstance(e.code, int):
+            status = e.code
+        elif e.code is not None:
+            stderr.write("{0}\n".format(e.code))
+            status = 1
+    except Exception:
+        traceback.print_exc(file=stderr)
+        status = 1
+    finally:
+        os.chdir(saved[0])
+        sys.stdin, sys.stdout, sys.stderr = saved[1:]
+    return {'status': status, 'stdout': stdout.getvalue(), 'stderr': stderr.getvalue()}
+
+def serve(path, idle_timeout=None):
+    # type: (str, float) -> None
+    """
+    Serve requests of genopts_client.py on the Unix domain socket at the
+    given path one after another until no request arrives within
+    idle_timeout seconds, or the sources of the generator change. The most
+    recently used parse trees and outputs stay cached in memory in the
+    meantime, see MEMORY_CACHE_ENTRIES.
+    """
+    if os.path.exists(path):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(path)
+        except socket.error:
+            # Left behind by a server that was killed
+            os.remove(path)
+        else:
+            sys.exit("A server is already listening on \"{0}\"".format(path))
+        finally:
+            probe.close()
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    # Only the current user may connect
+    umask = os.umask(0o077)
+    try:
+        server.bind(path)
+    finally:
+        os.umask(umask)
+    server.listen(16)
+    server.settimeout(idle_timeout)
+
+    version = generator_digest()
+    caches = {} # type: Dict[str, GeneratorCache]
+    try:
+        while True:
+            try:
+                conn, _ = server.accept()
+            except socket.timeout:
+                return
+            try:
+                conn.settimeout(SERVE_REQUEST_TIMEOUT)
+                data = []
+                while True:
+                    chunk = conn.recv(65536)
+                    if not chunk:
+                        break
+                    data.append(chunk)
+                if generator_digest() != version:
+                    # Let the client run the new version itself
+                    conn.sendall(json.dumps({'restart': True}).encode('utf-8'))
+                    return
+                response = serve_request(json.loads(b"".join(data).decode('utf-8')), caches)
+                conn.sendall(json.dumps(response).encode('utf-8'))
+            except (socket.error, ValueError):
+                # The client went away or sent garbage, it has to retry
+                pass
+            finally:
+                conn.close()
+    finally:
+        server.close()
+        os.remove(path)
+
+def main(argv=None, caches=None):
+    # type: (List[str], Dict[str, GeneratorCache])->None
+    """
+    Run the generator with the given arguments, sys.argv by default. A
+    server passes the caches that it keeps across requests, one per cache
+    directory plus one in memory only under the key None.
+    """
+    serve_path = None # type: str
+    idle_timeout = None # type: float
+    profile = None # type: str
+    profile_dump = None # type: str
+    backend = 'c'
+    targets = [] # type: List[Tuple[str, str]]
+    inputs = [] # type: List[str]
+    jobs = None # type: int
+    output = None # type: str
+    cache_dir = None # type: str
+    dont_skip_first_arg = False
+    dispatch = 'chain'
+    scoped = False
+    validation = 'inline'
+    packed_flags = False
+    reentrant = False
+    line = False
+    response_files = False
+    bench = False
+    optimization = 1
+
+    args = iter(sys.argv[1:] if argv is None else argv)
+    for o in args:
         if o == '--java':
-            backend = JavaBackend()
+            backend = 'java'
+        elif o == '--backend' or o.startswith('--backend='):
+            spec = next(args, None) if o == '--backend' else o[len('--backend='):]
+            if spec is None:
+                sys.exit("Option --backend requires a backend name")
+            name, _, path = spec.partition(':')
+            if name not in BACKENDS:
+                sys.exit("Unknown backend \"{0}\", use one of {1}".format(name, join_enum(list(BACKENDS), "or")))
+            targets.append((name, path if len(path) > 0 else None))
         elif o == '--dont-skip-first-arg':
             dont_skip_first_arg = True
-
-    if backend is None:
-        backend = CBackend()
-
-    genopts(lines, backend, dont_skip_first_arg)
+        elif o == '--scoped':
+            scoped = True
+        elif o == '--packed-flags':
+            packed_flags = True
+        elif o == '--reentrant':
+            reentrant = True
+        elif o == '--line':
+            line = True
+        elif o == '--response-files':
+            response_files = True
+        elif o == '--bench':
+            bench = True
+        elif o.startswith('-O'):
+            level = o[len('-O'):] if o != '-O' else '1'
+            if level not in [str(l) for l in OPTIMIZATION_LEVELS]:
+                sys.exit("Unknown optimization level \"{0}\", use one of {1}".format(level, join_enum([str(l) for l in OPTIMIZATION_LEVELS], "or")))
+            optimization = int(level)
+        elif o.startswith('--jobs='):
+            try:
+                jobs = int(o[len('--jobs='):])
+            except ValueError:
+                jobs = 0
+            if jobs < 1:
+                sys.exit("The number of jobs must be a positive integer")
+        elif o.startswith('--serve='):
+            serve_path = o[len('--serve='):]
+        elif o.startswith('--serve-idle-timeout='):
+            try:
+                idle_timeout = float(o[len('--serve-idle-timeout='):])
+            except ValueError:
+                idle_timeout = 0
+            if idle_timeout <= 0:
+                sys.exit("The idle timeout must be a positive number of seconds")
+        elif o == '--profile' or o.startswith('--profile='):
+            profile = o[len('--profile='):] if o != '--profile' else 'text'
+            if profile not in PROFILE_FORMATS:
+                sys.exit("Unknown profile format \"{0}\", use one of {1}".format(profile, join_enum(PROFILE_FORMATS, "or")))
+        elif o.startswith('--profile-dump='):
+            profile_dump = o[len('--profile-dump='):]
+        elif o.startswith('--cache-dir='):
+            cache_dir = o[len('--cache-dir='):]
+        elif o == '-o':
+            output = next(args, None)
+            if output is None:
+                sys.exit("Option -o requires a file name")
+        elif o.startswith('--validation='):
+            validation = o[len('--validation='):]
+            if validation not in VALIDATION_MODES:
+                sys.exit("Unknown validation mode \"{0}\", use one of {1}".format(validation, join_enum(VALIDATION_MODES, "or")))
+        elif o.startswith('--dispatch='):
+            dispatch = o[len('--dispatch='):]
+            if dispatch not in DISPATCH_MODES:
+                sys.exit("Unknown dispatch mode \"{0}\", use one of {1}".format(dispatch, join_enum(DISPATCH_MODES, "or")))
+        elif not o.startswith('-'):
+            inputs.append(o)
+
+    if serve_path is not None:
+        if caches is not None:
+            sys.exit("Option --serve cannot be passed to a server")
+        # Clean up the socket if terminated
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        serve(serve_path, idle_timeout)
+        return
+
+    profiler = None # type: cProfile.Profile
+    if profile_dump is not None:
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    timings = PhaseTimings()
+    files = input_files(inputs)
+    lines = None # type: List[str]
+    locations = None # type: Iterable[str]
+    if cache_dir is not None or caches is not None:
+        # The key of the output depends on the complete input, otherwise
+        # the input is read while it is parsed
+        lines, locations = read_inputs(files)
+        timings.mark('read')
+
+    if jobs is None:
+        # Input that is spread over several files is likely to be large
+        jobs = multiprocessing.cpu_count() if len(inputs) > 0 else 1
+
+    if len(targets) == 0:
+        targets.append((backend, output))
+    elif output is not None or backend != 'c':
+        sys.exit("Options -o and --java cannot be combined with --backend, use --backend <name>:<file> instead")
+
+    if len([path for name, path in targets if path is None]) > 1:
+        sys.exit("Only one backend may write to stdout")
+
+    paths = [path for name, path in targets if path is not None]
+    if len(set(paths)) != len(paths):
+        sys.exit("Each backend must write to a different file")
+
+    options = generator_options(dont_skip_first_arg=dont_skip_first_arg, dispatch=dispatch, scoped=scoped, validation=validation, packed_flags=packed_flags, reentrant=reentrant, line=line, response_files=response_files, bench=bench, optimization=optimization)
+    try:
+        check_options([name for name, path in targets], **options)
+    except GeneratorError as e:
+        sys.exit(str(e))
+
+    backends = [BACKENDS[name]() for name, path in targets]
+    outs = [AtomicFile(path) if path is not None else None for name, path in targets] # type: List[AtomicFile]
+    try:
+        cache = None # type: GeneratorCache
+        sources = [None] * len(targets) # type: List[str]
+        if caches is not None:
+            directory = os.path.abspath(cache_dir) if cache_dir is not None else None
+            if directory not in caches:
+                caches[directory] = GeneratorCache(directory)
+            cache = caches[directory]
+        elif cache_dir is not None:
+            cache = GeneratorCache(cache_dir)
+        if cache is not None:
+            # Reuse the previous output if neither the input nor the options
+            # have been changed
+            keys = [cache.key(b.__class__.__name__, repr(options), "\n".join(lines)) for b in backends]
+            sources = [cache.load("outputs", key) for key in keys]
+            timings.mark('cache')
+
+        # The template is parsed and analyzed only once for all backends
+        missing = [k for k, source in enumerate(sources) if source is None]
+        if len(missing) > 0:
+            if lines is not None:
+                patterns = lines # type: Iterable[str]
+            else:
+                patterns, locations = split_entries(iter_inputs(files))
+            result = analyze(patterns, backends[missing[0]], timings=timings, cache=cache, jobs=jobs, locations=locations, **options)
+            if len(missing) > 1 and jobs > 1 and hasattr(os, 'fork'):
+                for k, source in zip(missing, emit_parallel(result, [backends[k] for k in missing], jobs)):
+                    sources[k] = source
+                timings.mark('emit')
+            else:
+                for k in missing:
+                    if cache is None:
+                        emit(result, backends[k], outs[k], timings)
+                    else:
+                        buf = StringIO()
+                        emit(result, backends[k], buf, timings)
+                        sources[k] = buf.getvalue()
+            if cache is not None:
+                for k in missing:
+                    cache.store("outputs", keys[k], sources[k])
+
+        for out, source in zip(outs, sources):
+            if source is None:
+                continue
+            if out is not None:
+                out.write(source)
+            else:
+                sys.stdout.write(source)
+    except BaseException as e:
+        # Keep the previous outputs if the generation fails
+        for out in outs:
+            if out is not None:
+                out.discard()
+        if isinstance(e, GeneratorError):
+            sys.exit(str(e))
+        raise
+    for out in outs:
+        if out is not None:
+            out.commit()
+    timings.mark('commit')
+
+    if profiler is not None:
+        profiler.disable()
+        profiler.dump_stats(profile_dump)
+
+    if profile == 'json':
+        json.dump(timings.as_dict(), sys.stderr, indent=2, separators=(',', ': '))
+        sys.stderr.write("\n")
+    elif profile == 'text':
+        sys.stderr.write(timings.report())
 
 if __name__ == "__main__":
     main()
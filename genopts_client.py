@@ -0,0 +1,92 @@
+#!/usr/bin/python
+#
+# A minimal client for a server that was started with genopts.py --serve,
+# which avoids to start the generator for each file. The arguments, the
+# working directory and stdin are passed to the server, and its output and
+# exit status are reproduced. If no server is listening, genopts.py is run
+# directly, so the client can always be used in place of genopts.py.
+#
+# Usage: genopts_client.py --socket=<path> [<options of genopts.py>...]
+#
+
+from __future__ import print_function
+
+import json
+import os
+import socket
+import subprocess
+import sys
+
+if False: # For MyPy
+    from typing import Any, Dict, List
+
+GENOPTS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "genopts.py")
+
+def has_inputs(args):
+    # type: (List[str]) -> bool
+    """Return whether the given arguments of genopts.py name input files"""
+    args_iter = iter(args)
+    for o in args_iter:
+        if o in ['-o', '--backend']:
+            next(args_iter, None)
+        elif not o.startswith('-'):
+            return True
+    return False
+
+def request(path, args, stdin=None):
+    # type: (str, List[str], unicode) -> Dict[str, Any]
+    """
+    Send the given request to the server that listens on the given socket
+    and return its response, or None if there is no server.
+    """
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        try:
+            s.connect(path)
+        except socket.error:
+            return None
+        s.sendall(json.dumps({'args': args, 'cwd': os.getcwd(), 'stdin': stdin}).encode('utf-8'))
+        s.shutdown(socket.SHUT_WR)
+        data = []
+        while True:
+            chunk = s.recv(65536)
+            if not chunk:
+                break
+            data.append(chunk)
+    finally:
+        s.close()
+    if len(data) == 0:
+        # The server failed to handle the request
+        return None
+    return json.loads(b"".join(data).decode('utf-8'))
+
+def run_locally(args, stdin=None):
+    # type: (List[str], unicode) -> None
+    """Run genopts.py with the given arguments and exit with its status"""
+    if stdin is None:
+        os.execv(sys.executable, [sys.executable, GENOPTS] + args)
+    p = subprocess.Popen([sys.executable, GENOPTS] + args, stdin=subprocess.PIPE)
+    p.communicate(stdin.encode('utf-8'))
+    sys.exit(p.returncode)
+
+def main():
+    # type: () -> None
+    if len(sys.argv) < 2 or not sys.argv[1].startswith('--socket='):
+        sys.exit("Usage: {0} --socket=<path> [<options of genopts.py>...]".format(sys.argv[0]))
+    path = sys.argv[1][len('--socket='):]
+    args = sys.argv[2:]
+
+    stdin = None # type: unicode
+    if not has_inputs(args):
+        stdin = sys.stdin.read().decode('utf-8')
+
+    response = request(path, args, stdin)
+    if response is None or response.get('restart'):
+        run_locally(args, stdin)
+
+    sys.stdout.write(response['stdout'].encode('utf-8'))
+    sys.stderr.write(response['stderr'].encode('utf-8'))
+    sys.exit(response['status'])
+
+if __name__ == "__main__":
+    main()
@@ -8,9 +8,53 @@
 from __future__ import print_function
 
 from genopts import *
+from genopts_client import request
 
+import distutils.spawn
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
 import unittest
 
+from StringIO import StringIO
+
+if False: # For MyPy
+    from typing import Dict, List, Tuple
+
+def compile_and_run(source, main, args, files=None, cflags=None):
+    # type: (str, str, List[List[str]], Dict[str, str], List[str]) -> List[Tuple[int, str, str]]
+    """
+    Compile the given generated source with the given main() function
+    appended and run it once for each of the given argument lists. The runs
+    take place in a temporary directory that contains the given files.
+    Return the exit code, stdout and stderr of each run.
+    """
+    tmpdir = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(tmpdir, "cli.c")
+        with open(filename, "w") as f:
+            f.write(source)
+            f.write(main)
+        for name, contents in (files or {}).items():
+            with open(os.path.join(tmpdir, name), "w") as f:
+                f.write(contents)
+        exe = os.path.join(tmpdir, "cli")
+        subprocess.check_call(["gcc"] + (cflags or []) + [filename, "-o", exe])
+        results = [] # type: List[Tuple[int, str, str]]
+        for a in args:
+            p = subprocess.Popen([exe] + a, cwd=tmpdir, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            stdout, stderr = p.communicate()
+            results.append((p.returncode, stdout, stderr))
+        return results
+    finally:
+        shutil.rmtree(tmpdir)
+
+# A main() that parses and validates the command line
+VALIDATING_MAIN = "int main(int argc, char **argv)\n{\n\tstruct cli cli = {0};\n\treturn !parse_cli(argc, argv, &cli, POF_VALIDATE);\n}\n"
+
 class TestParser(unittest.TestCase):
     def test_combine(self):
         # type: () -> None
@@ -29,6 +73,17 @@ class TestParser(unittest.TestCase):
         self.assertEquals('cmd', command_tk)
         self.assertEquals('', rem)
 
+    def test_parse_at(self):
+        # type: () -> None
+        text = "cmd1 [--option] <file>"
+        self.assertEquals((4, 'cmd1'), parse_command_token_at(text, 0))
+        self.assertEquals(5, skip_spaces_at(text, 4))
+        pos, optional = parse_optional_at(text, 5)
+        self.assertEquals(15, pos)
+        self.assertEquals("--option", optional.list[0].command)
+        self.assertEquals((len(text), 'file'), parse_arg_at(text, 16))
+        self.assertEquals((None, None), parse_arg_at(text, 5))
+
     def test_parse_optional_simple(self):
         # type: () -> None
         rem, parse_tree = parse_optional("[--option]")
@@ -152,5 +207,706 @@ class TestParser(unittest.TestCase):
         navigate(template, OptionWithArgExtractorVisitor(True, options))
         self.assertEquals(4, len(options))
 
+    def test_composite_visitor(self):
+        # type: () -> None
+        template = Template([parse_pattern("commit [-a | --interactive] [<file>]"), parse_pattern("sync [-n | --dry-run]")])
+        options = [] # type: List[OptionWithArg]
+        all_commands = [] # type: List[Tuple[List[Command], List[Arg], Set[str]]]
+        mx_validator = GenerateMXValidatorVisitor(None)
+        navigate(template, CompositeVisitor([
+            OptionWithArgExtractorVisitor(True, options),
+            CommandListExtractorVisitor(all_commands),
+            mx_validator]))
+        self.assertEquals(["-a", "--interactive", "-n", "--dry-run"], [o.command for o in options])
+        self.assertEquals([["commit"], ["sync"]], [[c.command for c in cmds[0]] for cmds in all_commands])
+        self.assertEquals([["a", "interactive"], ["n", "dry_run"]], mx_validator.group_names())
+
+        vc = Block()
+        mx_validator.write(vc)
+        self.assertEquals(2, len(vc.generated_code))
+        self.assertEquals(["(!!cli->n + !!cli->dry_run) > (1)"], [repr(s.cond) for s in vc.generated_code[1:] if isinstance(s, IfStatement)])
+
+        # Subclasses of the nodes are navigated like them
+        class SortedOptional(Optional):
+            __slots__ = ()
+        optional = template.list[1].list[0].options[0]
+        assert isinstance(optional, Optional)
+        template.list[1].list[0].options[0] = SortedOptional(optional.list)
+        mx_validator = GenerateMXValidatorVisitor(None)
+        navigate(template, mx_validator)
+        self.assertEquals([["a", "interactive"], ["n", "dry_run"]], mx_validator.group_names())
+
+    def test_perfect_hash(self):
+        # type: () -> None
+        tokens = sorted(["--option{0}".format(i) for i in range(300)] + ["cmd", "--help", "-n"])
+        seeds, slots = perfect_hash(tokens)
+        self.assertEquals(len(slots) - 1 & len(slots), 0)
+        self.assertEquals(len(seeds) - 1 & len(seeds), 0)
+        self.assertEquals(sorted(range(len(tokens))), sorted(id for id in slots if id != -1))
+
+        for id, token in enumerate(tokens):
+            seed = seeds[hash_slot(token, FNV_OFFSET_BASIS, len(seeds))]
+            self.assertEquals(id, slots[hash_slot(token, seed, len(slots))])
+
+        # Tokens that differ only in their last character
+        for tokens in [["-f", "-n", "-v", "cp"], ["-f", "-n", "-v", "add", "remote", "remove", "show", "--help"]]:
+            seeds, slots = perfect_hash(sorted(tokens))
+            self.assertEquals(sorted(range(len(tokens))), sorted(id for id in slots if id != -1))
+        for scoped in [False, True]:
+            source = generate(["cp [-f] [-n] [-v] <a> <b>"], dispatch='hash', scoped=scoped)
+            self.assertIn("lookup_cli_token", source)
+            source = generate(["remote [-v] add [-f] <name> <url>", "remote [-v] remove <name>", "remote [-v] show [-n] [<name>]"], dispatch='hash', scoped=scoped)
+            self.assertIn("lookup_cli_token", source)
+
+    def test_token_action_map_hash_dispatch(self):
+        # type: () -> None
+        context = GeneratorContext(CBackend(), 'hash')
+        navigate(Template([parse_pattern("sync [--fast] [-n | --dry-run]")]), GenerateParserVisitor(context))
+        b = Block()
+        self.assertTrue(context.token_action_map.write(b))
+        self.assertEquals("switch (lookup_cli_token(argv[i]))", repr(b.generated_code[0]))
+        cases = [repr(s) for s in b.generated_code if isinstance(s, DirectStatement) and repr(s).startswith("case ")]
+        self.assertEquals(4, len(cases))
+        self.assertEquals(["cli_token", "cli_token_seeds", "cli_tokens", "lookup_cli_token"],
+            sorted(h.name for h in context.helpers))
+
+    def test_token_action_map_trie_dispatch(self):
+        # type: () -> None
+        context = GeneratorContext(CBackend(), 'trie')
+        navigate(Template([parse_pattern("sync [--fast] [--[no-]force]")]), GenerateParserVisitor(context))
+        b = Block()
+        self.assertTrue(context.token_action_map.write(b))
+        self.assertEquals("switch (argv[i][0])", repr(b.generated_code[0]))
+
+        f = StringIO()
+        gf = GenFile(f)
+        CBackend().write_block(gf, b)
+        gf.flush()
+        code = f.getvalue()
+        self.assertIn("switch (argv[i][2])", code)
+        self.assertIn('if (!strcmp(&argv[i][4], "st"))', code)
+        self.assertIn('if (!strcmp(&argv[i][3], "o-force"))', code)
+        self.assertIn('if (!strcmp(&argv[i][1], "ync"))', code)
+
+    def test_token_action_map_scoped(self):
+        # type: () -> None
+        parse_tree = []
+        parse_tree.append(parse_pattern("cmd1 [--same] [--cmd1-option]"))
+        parse_tree.append(parse_pattern("cmd2 [--same] sub [--sub-option]"))
+        context = GeneratorContext(CBackend(), 'chain', True)
+        navigate(Template(parse_tree), GenerateParserVisitor(context))
+        context.token_action_map.add("--help", "cli->help = 1")
+
+        token_action_map = context.token_action_map
+        self.assertEquals(set(), token_action_map.scopes_of_token("--help"))
+        self.assertEquals(set([1]), token_action_map.scopes_of_token("cmd1"))
+        self.assertEquals(set([1]), token_action_map.scopes_of_token("cmd2"))
+        self.assertEquals(set([2, 3]), token_action_map.scopes_of_token("--same"))
+        self.assertEquals(set([3]), token_action_map.scopes_of_token("sub"))
+        self.assertEquals(set([4]), token_action_map.scopes_of_token("--sub-option"))
+        self.assertNotIn("same_cmd", context.aux_vars.variables)
+
+        b = Block()
+        self.assertTrue(token_action_map.write(b))
+        cases = [repr(s) for s in b.generated_code if isinstance(s, DirectStatement) and repr(s).startswith("case ")]
+        self.assertEquals(["case 1:", "case 2:", "case 3:", "case 4:"], cases)
+
+        # Options of other commands are reported, not taken as positional arguments
+        misplaced = b.generated_code[-1]
+        assert isinstance(misplaced, IfStatement)
+        self.assertEquals("argv[i][0] == '-'", repr(misplaced.cond))
+        checks = misplaced.then.generated_code
+        self.assertEquals(['!strcmp(argv[i], "--cmd1-option")', '!strcmp(argv[i], "--same")', '!strcmp(argv[i], "--sub-option")'],
+            [repr(c.cond) for c in checks if isinstance(c, IfStatement)])
+        self.assertEquals(3, len(checks))
+        same = checks[1]
+        assert isinstance(same, IfStatement)
+        self.assertEquals(['Option --same may be given only for the \\"cmd1\\" and \\"cmd2\\" command\\n'],
+            [e.msg for e in same.then.generated_code[:1] if isinstance(e, ErrorStatement)])
+
+    @unittest.skipIf(distutils.spawn.find_executable("gcc") is None, "requires gcc")
+    def test_scoped_positional_dashes(self):
+        # type: () -> None
+        out = StringIO()
+        genopts(["sync [--fast] [<files>...]", "fetch [--all] <remote>"], CBackend(), False, scoped=True, out=out)
+        # Only options of other commands are rejected, "-" and "--" are
+        # positional arguments
+        cases = [(["sync", "-"], True), (["sync", "--fast", "--", "a"], True), (["fetch", "-"], True),
+            (["sync", "--all"], False), (["fetch", "--fast", "origin"], False)]
+        results = compile_and_run(out.getvalue(), VALIDATING_MAIN, [args for args, _ in cases])
+        for (args, ok), (returncode, stdout, stderr) in zip(cases, results):
+            self.assertEquals(ok, returncode == 0, "{0}: {1}".format(args, stderr))
+            if not ok:
+                self.assertIn("may be given only for the", stderr)
+
+    def test_write_long_chain(self):
+        # type: () -> None
+        # Emitting a chain of this length must not depend on the recursion limit
+        context = GeneratorContext(CBackend())
+        for k in range(50000):
+            context.token_action_map.add("--option{0}".format(k), "cli->option{0} = 1;".format(k))
+        pcs = Function(name="parse_cli_simple", output="static int", input=[])
+        self.assertFalse(context.token_action_map.write(pcs))
+        self.assertEquals(1, len(pcs.generated_code))
+
+        f = StringIO()
+        gf = GenFile(f)
+        CBackend().write_block(gf, pcs)
+        gf.flush()
+        lines = f.getvalue().split("\n")
+        self.assertEquals(4 * 50000 + 3, len(lines) - 1)
+        self.assertEquals('\tif (!strcmp(argv[i], "--option0"))', lines[2])
+        self.assertEquals('\telse if (!strcmp(argv[i], "--option9999"))', lines[-6])
+        self.assertEquals('\t\tcli->option9999 = 1;', lines[-4])
+
+    def test_command_validation_table(self):
+        # type: () -> None
+        template = Template([parse_pattern("submodule [--quiet] update [--init] [--[no-]fetch]")])
+        context = GeneratorContext(CBackend(), validation='table')
+        options = [] # type: List[OptionWithArg]
+        navigate(template, CompositeVisitor([GenerateParserVisitor(context), OptionWithArgExtractorVisitor(True, options)]))
+        write_command_tracking(context, options)
+        self.assertEquals(['--quiet', '--init', '--fetch', '--no-fetch'], list(context.option_ids))
+
+        vc = Function(output="static int", name="validate_cli", input=[])
+        write_command_validation_table(vc, context, options)
+
+        tables = dict((h.name, h.rows) for h in context.helpers if isinstance(h, ConstArray))
+        self.assertEquals(["{ 0x4UL }", "{ 0x8UL }", "{ 0x8UL }", "{ 0x8UL }"], tables["cli_option_commands"])
+        self.assertEquals(['"--quiet"', '"--init"', '"--fetch"', '"--no-fetch"'], tables["cli_option_names"])
+        self.assertEquals(["0", "1", "1", "1"], tables["cli_option_texts"])
+        self.assertEquals(['"\\"submodule\\" command"', '"\\"update\\" command"'], tables["cli_command_texts"])
+
+    def test_global_options(self):
+        # type: () -> None
+        template = Template([parse_pattern("fetch [--quiet] [--all] <remote>"), parse_pattern("pull [--quiet] <remote>")])
+        context = GeneratorContext(CBackend())
+        options = [] # type: List[OptionWithArg]
+        navigate(template, CompositeVisitor([GenerateParserVisitor(context), OptionWithArgExtractorVisitor(True, options)]))
+        commands = context.command_index_map.index.keys()
+        # Every command accepts --quiet, only fetch accepts --all
+        self.assertEquals(["--quiet"], [n.command for n in options if context.parent_map.is_global(n, commands)])
+        quiet = [n for n in options if n.command == "--quiet"][0]
+        self.assertFalse(context.parent_map.is_global(quiet, commands + ["push"]))
+
+        inline = generate(["fetch [--quiet] [--all] <remote>", "pull [--quiet] <remote>"], optimization=0)
+        self.assertIn("aux->all_cmd = cur_command;", inline)
+        self.assertIn("if (aux->all_cmd != 0 && aux->all_cmd != 2)", inline)
+        # --quiet is recorded only before the command, in the shared field
+        self.assertNotIn("quiet_cmd", inline)
+        self.assertIn("\t\t\tif (cur_command < 0)\n\t\t\t{\n\t\t\t\taux->global_option = 1;", inline)
+        self.assertIn('cli_global_option_names[1] =\n{\n\t"--quiet",\n};', inline)
+        self.assertIn('fprintf(stderr, "Option %s may be given only for the \\"fetch\\" and \\"pull\\" command\\n", '
+            'cli_global_option_names[option - 1]);', inline)
+        table = generate(["fetch [--quiet] [--all] <remote>", "pull [--quiet] <remote>"], validation='table', optimization=0)
+        self.assertIn('cli_option_names[1] =\n{\n\t"--all",\n};', table)
+        # The names are indexed by the option id, --all has id 0
+        self.assertIn('cli_global_option_names[2] =\n{\n\tNULL,\n\t"--quiet",\n};', table)
+
+    @unittest.skipIf(distutils.spawn.find_executable("gcc") is None, "requires gcc")
+    def test_command_with_value(self):
+        # type: () -> None
+        main = ("int main(int argc, char **argv)\n{\n\tstruct cli cli = {0};\n\tif (!parse_cli(argc, argv, &cli, POF_VALIDATE)) return 1;\n"
+            "\tprintf(\"%s\", cli.upstream);\n\treturn 0;\n}\n")
+        out = StringIO()
+        genopts(["branch --set-upstream-to=<upstream>"], CBackend(), False, out=out)
+        # The value follows the = or is the next argument
+        results = compile_and_run(out.getvalue(), main, [["branch", "--set-upstream-to=origin"], ["branch", "--set-upstream-to", "origin"],
+            ["branch", "--set-upstream-to"], ["branch", "--set-upstream-toorigin"]])
+        self.assertEquals((0, "origin"), results[0][:2])
+        self.assertEquals((0, "origin"), results[1][:2])
+        self.assertEquals((1, 'Argument "--set-upstream-to" requires a value\n'), (results[2][0], results[2][2]))
+        self.assertEquals((1, 'Unknown command or option "--set-upstream-toorigin"\n'), (results[3][0], results[3][2]))
+
+    @unittest.skipIf(distutils.spawn.find_executable("gcc") is None, "requires gcc")
+    def test_options_before_command(self):
+        # type: () -> None
+        patterns = ["sync [--fast] [-n | --dry-run] [<files>...]"]
+        cases = [(["sync", "-n"], True), (["sync", "--fast", "a"], True), (["-n", "sync"], False),
+            (["--dry-run", "sync"], False), (["--fast", "sync", "a"], False), (["-n"], False)]
+        # With a single command, all options are global, with fetch, only
+        # --fast is
+        for validation in VALIDATION_MODES:
+            for template in [patterns, patterns + ["fetch [--fast] <remote>"]]:
+                out = StringIO()
+                genopts(template, CBackend(), False, validation=validation, out=out)
+                results = compile_and_run(out.getvalue(), VALIDATING_MAIN, [args for args, _ in cases])
+                for (args, ok), (returncode, stdout, stderr) in zip(cases, results):
+                    self.assertEquals(ok, returncode == 0, "{0} {1}: {2}".format(validation, args, stderr))
+                    if not ok:
+                        self.assertIn("may be given only for the", stderr)
+
+    @unittest.skipIf(distutils.spawn.find_executable("gcc") is None, "requires gcc")
+    def test_global_option_error_result(self):
+        # type: () -> None
+        main = ("int main(int argc, char **argv)\n{\n\tstruct cli cli = {0};\n\tstruct cli_result res;\n\tchar buf[256];\n"
+            "\tparse_cli_r(argc, argv, &cli, &res);\n\tformat_cli_error(&res, argv, buf, sizeof(buf));\n"
+            "\tprintf(\"%d %d %s\", res.code, res.option, buf);\n\treturn 0;\n}\n")
+        for validation in VALIDATION_MODES:
+            out = StringIO()
+            genopts(["sync [--fast] [-n | --dry-run] [<files>...]"], CBackend(), False, validation=validation, reentrant=True, out=out)
+            results = compile_and_run(out.getvalue(), main, [["sync", "-n", "--dry-run"], ["-n", "sync"], ["--fast", "sync"]])
+            exclusive, before, fast = [stdout.split(" ", 2) for _, stdout, _ in results]
+            self.assertEquals("4", exclusive[0])
+            # The wrong command is reported with the id of the option, just
+            # as the other errors
+            self.assertEquals(["3", exclusive[1], 'Option -n may be given only for the "sync" command\n'], before)
+            self.assertEquals("3", fast[0])
+            self.assertNotEquals(exclusive[1], fast[1])
+            self.assertEquals('Option --fast may be given only for the "sync" command\n', fast[2])
+
+    def test_positional_dispatch(self):
+        # type: () -> None
+        pam = PositionalActionMap()
+        pam.add(0, 2, "aux->positional0 = argv[i];")
+        pam.add(0, 3, "aux->positional0 = argv[i];")
+        pam.add(1, 3, "aux->variadic_argv = &argv[i];").ret(1)
+        b = Block()
+        self.assertTrue(pam.write(b, True))
+        code = [repr(s) for s in b.generated_code]
+        # The key of a command is never reached by the position that follows
+        # the last one of another command
+        self.assertEquals(["switch (cur_command * 3 + cur_position)", "{", "case 6:", "case 9:"], code[:4])
+        case = b.generated_code[4]
+        assert isinstance(case, Block)
+        self.assertEquals(["aux->positional0 = argv[i];", "continue;"], [repr(s) for s in case.generated_code])
+        self.assertEquals(["case 10:", "}"], code[5::2])
+
+        all_commands = [] # type: List[Tuple[List[Command], List[Arg], Set[str]]]
+        context = GeneratorContext(CBackend())
+        navigate(parse_pattern("branch [<old>] <new> [<base>]"), CompositeVisitor([GenerateParserVisitor(context), CommandListExtractorVisitor(all_commands)]))
+        commands, args, optional_args = all_commands[0]
+        vc = Block()
+        write_positional_resolution(vc, context, args, optional_args)
+        code = [repr(s) for s in vc.generated_code]
+        self.assertEquals(["switch (!!aux->positional0 + !!aux->positional1 + !!aux->positional2)", "{", "case 1:"], code[:3])
+        cases = [[repr(s) for s in c.generated_code] for c in vc.generated_code if isinstance(c, Block)]
+        self.assertEquals(["cli->new = aux->positional0;", "break;"], cases[0])
+        self.assertEquals(["cli->old = aux->positional0;", "cli->new = aux->positional1;", "break;"], cases[1])
+        self.assertEquals("default:", code[-3])
+
+    def test_pack_flags(self):
+        # type: () -> None
+        context = GeneratorContext(CBackend(), packed_flags=True)
+        for i in range(30):
+            context.set_cli_flag("flag{0}".format(i))
+        for name in ["a", "b", "c", "d"]:
+            context.set_cli_flag(name)
+
+        # The second group does not fit into the remaining bits of the first word
+        groups = [["flag{0}".format(i) for i in range(30)], ["a", "b", "c"]]
+        self.assertEquals(2, context.pack_flags(groups))
+        self.assertEquals((1, 0x7), context.flags_mask(["a", "b", "c"]))
+        self.assertEquals(35, context.flags["d"])
+        self.assertIsNone(context.flags_mask(["flag0", "a"]))
+        self.assertIsNone(context.flags_mask(["a", "file"]))
+        self.assertEquals("cli_flag(cli, CLI_FLAG_a)", repr(context.cli_flag("a")))
+        self.assertEquals("cli_set_flag(cli, CLI_FLAG_a)", repr(context.set_cli_flag("a")))
+
+    def test_mx_validation_packed(self):
+        # type: () -> None
+        template = Template([parse_pattern("commit [-a | --interactive | --patch] [-F <file> | -m <msg>]")])
+        context = GeneratorContext(CBackend(), packed_flags=True)
+        navigate(template, GenerateParserVisitor(context))
+        mx_validator = GenerateMXValidatorVisitor(None, context)
+        navigate(template, mx_validator)
+        self.assertEquals([["a", "interactive", "patch"], ["file", "msg"]], mx_validator.group_names())
+        context.pack_flags(mx_validator.group_names())
+
+        vc = Block()
+        mx_validator.write(vc)
+        self.assertEquals(["(cli->flags[0] & 0x7UL) & ((cli->flags[0] & 0x7UL) - 1)", "(!!cli->file + !!cli->msg) > (1)"],
+            [repr(s.cond) for s in vc.generated_code if isinstance(s, IfStatement)])
+
+    def test_reentrant_errors(self):
+        # type: () -> None
+        context = GeneratorContext(CBackend())
+        e = context.error('CLI_ERR_UNKNOWN', 'Unknown command or option \\"%s\\"\\n', index="i", arg_templates=["argv[{index}]"])
+        self.assertEquals(0, e.id)
+        self.assertEquals(["argv[i]"], [repr(a) for a in e.args])
+        self.assertEquals(1, context.error('CLI_ERR_NO_COMMAND', 'Please specify a proper command\\n').id)
+
+        pcs = Function(name="parse_cli_simple", output="static int", input=[])
+        pcs.add(e)
+        f = StringIO()
+        gf = GenFile(f)
+        backend = CBackend()
+        backend.write_block(gf, pcs)
+        backend.write_block(gf, pcs.reentrant(V('res', 'struct cli_result *')))
+        gf.flush()
+        output = f.getvalue()
+        self.assertIn('fprintf(stderr, "Unknown command or option \\"%s\\"\\n", argv[i]);', output)
+        self.assertIn("static int parse_cli_simple_r(struct cli_result *res)", output)
+        self.assertIn("res->code = CLI_ERR_UNKNOWN;", output)
+        self.assertIn("res->message = 0;", output)
+        self.assertIn("res->index = i;", output)
+        self.assertEquals(1, output.count("fprintf"))
+
+        fce = Block()
+        write_error_formatter(fce, context)
+        self.assertIn('case 0: return snprintf(buf, size, "Unknown command or option \\"%s\\"\\n", argv[res->index]);',
+            [repr(s) for s in fce.generated_code])
+
+    def test_line_tokenizer(self):
+        # type: () -> None
+        tcl = Function(name="tokenize_cli_line", output="static int", input=[])
+        write_line_tokenizer(tcl)
+        self.assertEquals(["argc", "d", "quote", "s"], sorted(tcl.locals.variables))
+        code = [repr(s) for s in tcl.generated_code]
+        self.assertIn("argc++;", code)
+        self.assertEquals("return argc;", code[-1])
+        # Braces must be balanced for the indentation of GenFile
+        self.assertEquals(code.count("{"), code.count("}"))
+
+    def test_response_file_expander(self):
+        # type: () -> None
+        ercf = Function(name="expand_cli_response_files", output="static int", input=[])
+        write_response_file_expander(ercf)
+        code = [repr(s) for s in ercf.generated_code]
+        self.assertEquals("cleanup_cli(cli);", code[0])
+        self.assertEquals("return 1;", code[-1])
+        self.assertEquals(code.count("{"), code.count("}"))
+
+    @unittest.skipIf(distutils.spawn.find_executable("gcc") is None, "requires gcc")
+    def test_response_files(self):
+        # type: () -> None
+        out = StringIO()
+        genopts(["sync [--fast] [<files>...]"], CBackend(), False, response_files=True, out=out)
+        # Parse twice with the same struct, the mappings of the first call
+        # must not be left behind
+        main = ("static int count_maps(void)\n{\n\tFILE *f = fopen(\"/proc/self/maps\", \"r\");\n\tint c, n = 0;\n"
+            "\tif (!f) return 0;\n\twhile ((c = fgetc(f)) != EOF) n += c == '\\n';\n\tfclose(f);\n\treturn n;\n}\n"
+            "int main(int argc, char **argv)\n{\n\tstruct cli cli = {0};\n\tint i, k, maps;\n"
+            "\tcount_maps();\n\tmaps = count_maps();\n"
+            "\tfor (k = 0; k < 2; k++)\n\t{\n\t\tif (!parse_cli(argc, argv, &cli, POF_VALIDATE)) return 1;\n"
+            "\t\tfor (i = 0; i < cli.files_count; i++) printf(\"%s\\n\", cli.files[i]);\n\t}\n"
+            "\tcleanup_cli(&cli);\n\treturn count_maps() != maps ? 2 : 0;\n}\n")
+        # Each @path is expanded in place
+        [(returncode, stdout, stderr)] = compile_and_run(out.getvalue(), main, [["sync", "--fast", "@a.rsp", "x", "@b.rsp"]],
+            files={"a.rsp": "a1 'a 2'\n", "b.rsp": "b1\n"})
+        self.assertEquals(0, returncode, stderr)
+        self.assertEquals(["a1", "a 2", "x", "b1"] * 2, stdout.splitlines())
+
+    def test_genopts_phases(self):
+        # type: () -> None
+        out = StringIO()
+        timings = PhaseTimings()
+        genopts(["sync [--fast] [-n | --dry-run] [<files>...]"], CBackend(), False, out=out, timings=timings)
+        self.assertEquals(["parse", "analyze", "build", "emit", "flush"], list(timings.phases))
+        self.assertIn("static int parse_cli(int argc, char **argv, struct cli *cli, parse_cli_options_t opts)", out.getvalue())
+
+    def test_phase_steps_and_counts(self):
+        # type: () -> None
+        timings = PhaseTimings()
+        genopts(["sync [--fast] [-n | --dry-run] [<files>...]"], CBackend(), False, reentrant=True, out=StringIO(), timings=timings)
+        self.assertEquals(["navigate"], list(timings.steps["analyze"]))
+        self.assertEquals(["validate_cli", "usage_cli", "parse_cli_simple", "parse_cli", "reentrant", "optimize"], list(timings.steps["build"]))
+        self.assertEquals(["header", "helpers", "functions"], list(timings.steps["emit"]))
+        self.assertEquals(5, timings.counts["tokens"])
+        self.assertEquals(1, timings.counts["commands"])
+        self.assertEquals(1, timings.counts["mx_groups"])
+        self.assertIn("parse_cli_simple", timings.report())
+
+    def test_optimize(self):
+        # type: () -> None
+        context = GeneratorContext(CBackend())
+        f = Function(name="f", output="static int", input=[])
+        f.iff("0").then.add("dead();")
+        choice = f.iff("1")
+        choice.then.add("taken();")
+        choice.otherwise.add("skipped();")
+        optimize([f], context, 1)
+        self.assertEquals(["taken();"], [repr(s) for s in f.generated_code])
+
+        # Only the accesses in expressions are reads, not the text of messages
+        context = GeneratorContext(CBackend())
+        f = Function(name="f", output="static int", input=[])
+        for k, name in enumerate(["read", "unread", "mentioned"]):
+            f.add(context.aux_access(name, "int") << k)
+        f.printerr("aux->mentioned is not read\\n")
+        f.iff(context.aux_access("read").ne(0)).then.ret(0)
+        optimize([f], context, 1)
+        self.assertEquals(["aux->read = 0;"], [repr(s) for s in f.generated_code][:1])
+        self.assertEquals(["read"], context.aux_vars.variables.keys())
+
+        # Code that is given as text might read any field
+        context = GeneratorContext(CBackend())
+        f = Function(name="f", output="static int", input=[])
+        f.add(context.aux_access("unread", "int") << 1)
+        f.add("use(aux->unread);")
+        optimize([f], context, 1)
+        self.assertEquals(["aux->unread = 1;", "use(aux->unread);"], [repr(s) for s in f.generated_code])
+
+        template = "sync [--fast] <file>\nfetch [--fast] <file>\n"
+        outputs = []
+        for level in OPTIMIZATION_LEVELS:
+            out = StringIO()
+            genopts(template.splitlines(), CBackend(), False, optimization=level, out=out)
+            outputs.append(out.getvalue())
+        # Positions are never read back, so their stores go away from -O1 on
+        self.assertIn("aux->fetch_pos = i;", outputs[0])
+        self.assertNotIn("fetch_pos", outputs[1])
+        # Both commands store their first positional the same way, which the
+        # dispatch shares, and resolve it the same way, which -O2 merges
+        for output in outputs:
+            self.assertEquals(1, output.count("aux->positional0 = argv[i];"))
+        merged = "if (cli->sync || cli->fetch)"
+        self.assertNotIn(merged, outputs[1])
+        self.assertIn(merged, outputs[2])
+
+        template = "sync [-n | --dry-run] <file>\nfetch [-n | --dry-run] [--all] <remote>\n"
+        outputs = []
+        for level in OPTIMIZATION_LEVELS:
+            out = StringIO()
+            genopts(template.splitlines(), CBackend(), False, optimization=level, out=out)
+            outputs.append(out.getvalue())
+        # Both patterns add the same check of the exclusive options, -O2 drops the repetition
+        check = "if ((!!cli->n + !!cli->dry_run) > (1))"
+        self.assertEquals(2, outputs[1].count(check))
+        self.assertEquals(1, outputs[2].count(check))
+        self.assertRaises(GeneratorError, check_options, ["c"], optimization=3)
+
+    def test_compact_nodes(self):
+        # type: () -> None
+        tree = parse_pattern("sync [--fast] <file>")
+        for n in [tree, tree.list[0], tree.list[0].options[0], tree.list[0].options[1]]:
+            self.assertFalse(hasattr(n, '__dict__'))
+        self.assertEquals(repr(tree), repr(pickle.loads(pickle.dumps(tree, pickle.HIGHEST_PROTOCOL))))
+
+        context = GeneratorContext(CBackend())
+        self.assertIs(context.cli_access("fast", "int"), context.cli_access("fast"))
+        self.assertIs(make_expr(1), make_expr("1"))
+        element = context.backend.argv(context.i_var)
+        assert isinstance(element, VectorElementExpression)
+        self.assertIs(context.backend.argv(), element.expr)
+        self.assertFalse(hasattr(make_expr(1), '__dict__'))
+        self.assertFalse(Block().has_locals())
+
+    def test_emit_backends(self):
+        # type: () -> None
+        patterns = ["sync [--fast] [-n | --dry-run] [<files>...]", "fetch [--all] <remote>"]
+        expected = [] # type: List[str]
+        for backend in [CBackend(), JavaBackend()]:
+            out = StringIO()
+            genopts(patterns, backend, False, out=out)
+            expected.append(out.getvalue())
+
+        result = analyze(patterns, CBackend(), False)
+        sources = [] # type: List[str]
+        for backend in [CBackend(), JavaBackend()]:
+            out = StringIO()
+            emit(result, backend, out)
+            sources.append(out.getvalue())
+        self.assertEquals(expected, sources)
+        if hasattr(os, 'fork'):
+            self.assertEquals(expected, emit_parallel(result, [CBackend(), JavaBackend()], 2))
+
+    def test_generate(self):
+        # type: () -> None
+        template = "sync [--fast] [-n | --dry-run] [<files>...]\nfetch [--all] <remote>"
+        out = StringIO()
+        genopts(template.splitlines(), CBackend(), False, dispatch='hash', out=out)
+        self.assertEquals(out.getvalue(), generate(template, dispatch='hash'))
+
+        generator = Generator()
+        java = generator.generate(template.splitlines(), 'java')
+        self.assertIn("public class CliParser", java)
+        self.assertIs(java, generator.generate(template.splitlines(), 'java'))
+        self.assertEquals([generator.generate(template), java], generator.generate_all(template, ['c', 'java']))
+
+        with self.assertRaises(GeneratorError):
+            generator.generate(template, 'java', packed_flags=True)
+        with self.assertRaises(GeneratorError):
+            generator.generate("sync [-n")
+        with self.assertRaises(TypeError):
+            generator.generate(template, fast=True)
+
+    def test_atomic_file(self):
+        # type: () -> None
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, "cli.c")
+            with open(path, 'w') as f:
+                f.write("old\n")
+
+            af = AtomicFile(path)
+            gf = GenFile(af)
+            for k in range(GENFILE_BUFFER_LINES + 1):
+                gf.writeline("line{0}".format(k))
+            gf.flush()
+            with open(path) as f:
+                self.assertEquals("old\n", f.read())
+            af.commit()
+            with open(path) as f:
+                self.assertEquals(GENFILE_BUFFER_LINES + 1, len(f.readlines()))
+
+            af = AtomicFile(path)
+            af.write("new\n")
+            af.discard()
+            self.assertEquals(["cli.c"], os.listdir(tmpdir))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_generator_cache(self):
+        # type: () -> None
+        tmpdir = tempfile.mkdtemp()
+        try:
+            cache = GeneratorCache(tmpdir)
+            pattern = "sync [--fast] [-n | --dry-run] [<files>...]"
+            self.assertEquals(repr(parse_pattern(pattern)), repr(cache.parse_pattern(pattern)))
+            key = cache.key(pattern)
+            self.assertNotEquals(key, cache.key(pattern + " "))
+            self.assertEquals(repr(parse_pattern(pattern)), repr(cache.load("patterns", key)))
+
+            self.assertIsNone(cache.load("outputs", key))
+            cache.store("outputs", key, "source")
+            self.assertEquals("source", GeneratorCache(tmpdir).load("outputs", key))
+
+            # Only the most recently used entries stay in memory
+            cache = GeneratorCache(limits={"outputs": 2})
+            for name in ["a", "b", "c"]:
+                cache.store("outputs", name, name)
+            self.assertIsNone(cache.load("outputs", "a"))
+            self.assertEquals("b", cache.load("outputs", "b"))
+            cache.store("outputs", "d", "d")
+            self.assertEquals(["b", "d"], list(cache.memory["outputs"]))
+
+            # The output file is not touched if the contents are the same
+            path = os.path.join(tmpdir, "cli.c")
+            for modified in [True, False]:
+                af = AtomicFile(path)
+                af.write("source")
+                self.assertEquals(modified, af.commit())
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_serve(self):
+        # type: () -> None
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, "genopts.sock")
+            server = threading.Thread(target=serve, args=(path, 2.0))
+            server.start()
+            while not os.path.exists(path):
+                time.sleep(0.01)
+
+            out = StringIO()
+            genopts(["sync [--fast] [-n | --dry-run] [<files>...]"], CBackend(), False, out=out)
+            response = request(path, [], u"sync [--fast] [-n | --dry-run] [<files>...]\n")
+            self.assertEquals(0, response['status'])
+            self.assertEquals(out.getvalue(), response['stdout'])
+
+            response = request(path, ["--dispatch=none"], u"sync\n")
+            self.assertEquals(1, response['status'])
+            self.assertIn("Unknown dispatch mode", response['stderr'])
+
+            server.join()
+            self.assertFalse(os.path.exists(path))
+            self.assertIsNone(request(path, []))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_parse_patterns(self):
+        # type: () -> None
+        patterns = ["cmd{0} [-a | --all-{0}] [<file{0}>]\n".format(k) for k in range(PARALLEL_MIN_PATTERNS)]
+        serial = parse_patterns(patterns)
+        self.assertEquals([repr(parse_pattern(p.strip())) for p in patterns], [repr(t) for t in serial])
+        self.assertEquals([repr(t) for t in serial], [repr(t) for t in parse_patterns(patterns, jobs=2)])
+
+        locations = ["a.genopts:1", "b.genopts:1", "b.genopts:2"]
+        with self.assertRaises(GeneratorError) as cm:
+            parse_patterns(["sync [--fast]", "sync [-n", "cmd"], locations)
+        self.assertEquals('b.genopts:1: Cannot parse pattern "sync [-n"', str(cm.exception))
+
+    def test_read_patterns(self):
+        # type: () -> None
+        f = StringIO("# A comment\n\nsync [--fast] \\\n    [-n | --dry-run]\n  # Indented\ncommit [-a]\nfetch \\\n")
+        self.assertEquals([("sync [--fast] [-n | --dry-run]", "t:3"), ("commit [-a]", "t:6"), ("fetch", "t:7")],
+            list(read_patterns(f, "t")))
+
+        # Patterns are parsed and analyzed while they are read
+        f = StringIO("sync [--fast]\ncommit [-a]\nsync [-n\nfetch\n")
+        patterns, locations = split_entries(read_patterns(f, "t"))
+        with self.assertRaises(GeneratorError) as cm:
+            analyze(patterns, CBackend(), False, locations=locations)
+        self.assertEquals('t:3: Cannot parse pattern "sync [-n"', str(cm.exception))
+        self.assertEquals("fetch\n", f.read())
+
+    def test_input_files(self):
+        # type: () -> None
+        tmpdir = tempfile.mkdtemp()
+        try:
+            for name in ["b.genopts", "a.genopts", "c.txt"]:
+                with open(os.path.join(tmpdir, name), 'w') as f:
+                    f.write("{0} [--fast]\n".format(name[0]))
+            a, b, c = [os.path.join(tmpdir, name) for name in ["a.genopts", "b.genopts", "c.txt"]]
+            self.assertEquals([a, b], input_files([tmpdir]))
+            self.assertEquals([c, a, b], input_files([c, os.path.join(tmpdir, "*.genopts")]))
+            self.assertEquals((["c [--fast]", "a [--fast]"], [c + ":1", a + ":1"]), read_inputs([c, a]))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_read_large_template(self):
+        # type: () -> None
+        tmpdir = tempfile.mkdtemp()
+        try:
+            name = os.path.join(tmpdir, "large.genopts")
+            with open(name, "w") as f:
+                for k in range(1000):
+                    f.write("# Command {0}\n\n".format(k))
+                    f.write("cmd{0} [--opt{0}] \\\n    [-v | --verbose] \\\n  <file>\n\n".format(k))
+                f.write("# The end\n")
+
+            # Each pattern is located at its first line
+            patterns, locations = read_inputs([name])
+            self.assertEquals(1000, len(patterns))
+            self.assertEquals("cmd999 [--opt999] [-v | --verbose] <file>", patterns[999])
+            self.assertEquals("{0}:{1}".format(name, 6 * 999 + 3), locations[999])
+
+            out = StringIO()
+            texts, text_locations = split_entries(iter_inputs([name]))
+            genopts(texts, CBackend(), False, out=out, locations=text_locations)
+            self.assertIn("cmd999 [--opt999] [-v | --verbose] <file>", out.getvalue())
+            self.assertIn("int opt999;", out.getvalue())
+
+            # A broken pattern is reported at its location behind all others
+            with open(name, "a") as f:
+                f.write("cmd1000 \\\n    [-n\n")
+            texts, text_locations = split_entries(iter_inputs([name]))
+            with self.assertRaises(GeneratorError) as cm:
+                genopts(texts, CBackend(), False, out=StringIO(), locations=text_locations)
+            self.assertEquals('{0}:{1}: Cannot parse pattern "cmd1000 [-n"'.format(name, 6 * 1000 + 2), str(cm.exception))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_bench_corpus(self):
+        # type: () -> None
+        template = Template([parse_pattern("sync [--fast] [-n | --dry-run] [<files>...]")])
+        self.assertEquals([
+            ("valid", ["sync", "--fast", "-n", "file1", "file2", "file3"]),
+            ("unknown", ["--unknown-option", "sync", "--fast", "-n", "file1", "file2", "file3"]),
+            ("mx", ["sync", "--fast", "-n", "--dry-run", "file1", "file2", "file3"]),
+            ("help", ["--help"])], bench_corpus(template))
+
+    @unittest.skipIf(distutils.spawn.find_executable("gcc") is None, "requires gcc")
+    def test_bench_main(self):
+        # type: () -> None
+        patterns = ["sync [--fast] [-n | --dry-run] [<files>...]", "commit [-a] <msg> [<file>]"]
+        out = StringIO()
+        genopts(patterns, CBackend(), False, bench=True, out=out)
+        # The generated code brings its own main()
+        results = compile_and_run(out.getvalue(), "", [["1"], ["0"], ["-5"], ["many"]], cflags=["-O2"])
+        returncode, stdout, stderr = results[0]
+        self.assertEquals(0, returncode, stderr)
+        rows = stdout.splitlines()[1:]
+        ok = [(row.split()[0], float(row.split()[4])) for row in rows]
+        self.assertEquals(["valid", "unknown", "mx", "valid", "unknown", "missing", "help"], [k for k, _ in ok])
+        for kind, value in ok:
+            self.assertEquals(1.0 if kind in ["valid", "help"] else 0.0, value, kind)
+
+        for returncode, stdout, stderr in results[1:]:
+            self.assertEquals(1, returncode)
+            self.assertIn("usage:", stderr)
+
 if __name__ == "__main__":
     unittest.main()
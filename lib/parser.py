@@ -7,11 +7,16 @@ if False: # For MyPy, see https://stackoverflow.com/questions/446052/how-can-i-c
 
 ################################################################################
 
-class Command:
+# The nodes of the parse tree use __slots__, as templates may consist of
+# many thousands of them
+
+class Command(object):
     """
     A command contains a command string, a list of options (that may be empty)
     and an optional subcommand.
     """
+    __slots__ = ('command', 'arg', 'options', 'subcommand')
+
     def __init__(self, command, options, subcommand, arg = None):
         # type: (str, List[Union[Optional, Arg]], Command, str)->None
         self.command = command
@@ -31,8 +36,10 @@ class Command:
             arg = ""
         return "Command(" + self.command + arg + ", "  + repr(self.options) + subcommand + ')'
 
-class Arg:
+class Arg(object):
     """Contains an argument"""
+    __slots__ = ('command', 'variadic')
+
     def __init__(self, name, variadic=False):
         # type: (str, bool) -> None
         self.command = name
@@ -42,8 +49,10 @@ class Arg:
         # type: () -> str
         return "Arg(" + self.command + ", variadic=" + str(self.variadic) + ")"
 
-class OptionWithArg:
+class OptionWithArg(object):
     """Contains an option with args"""
+    __slots__ = ('command', 'arg')
+
     def __init__(self, command, arg):
         # type: (str, str)->None
         self.command = command
@@ -56,8 +65,10 @@ class OptionWithArg:
             arg = ", " + self.arg
         return "OptionWithArg(" + self.command + arg + ")"
 
-class Optional:
+class Optional(object):
     """Contains a set of mutual exlusive options"""
+    __slots__ = ('list',)
+
     def __init__(self, list):
         # type: (List[Union[Arg, OptionWithArg]])->None
         self.list = list
@@ -65,8 +76,10 @@ class Optional:
         # type: ()->str
         return "Optional(" + repr(self.list) + ")"
 
-class Pattern:
+class Pattern(object):
     """Contains commands"""
+    __slots__ = ('list',)
+
     def __init__(self, list):
         # type: (List[Command])->None
         self.list = list
@@ -74,8 +87,10 @@ class Pattern:
         # type: ()->str
         return "Pattern(" + repr(self.list) + ")"
 
-class Template:
+class Template(object):
     """Contains patterns"""
+    __slots__ = ('list',)
+
     def __init__(self, list):
         # type: (List[Pattern])->None
         self.list = list
@@ -85,114 +100,139 @@ class Template:
 
 ################################################################################
 
+# The characters that terminate a command token
+SPECIAL_CHARS = frozenset(" [|]=")
+
+# The parsing functions below operate on a cursor, i.e., an index into the
+# entire text rather than on the remainder of the text, so no substrings
+# are created while parsing. They return the index of the remainder, or
+# None on failure, and the parsed element. The functions without the _at
+# suffix are string based wrappers that return the remainder itself.
+
+def skip_spaces_at(text, pos):
+    # type: (str, int) -> int
+    l = len(text)
+    if pos >= l: return pos
+
+    while pos < l and text[pos] == ' ':
+        pos = pos + 1
+    if pos == l:
+        # A remainder consisting of spaces only is reduced to its last space
+        return l - 1
+    return pos
+
 def skip_spaces(text):
     # type: (str) -> str
-    if len(text) == 0: return text
-
-    for i, c in enumerate(text):
-        if c != ' ': break
-    return text[i:]
+    return text[skip_spaces_at(text, 0):]
 
 def is_special(c):
     # type: (str) -> bool
-    if c == ' ':
-        return True
-    if c == '[':
-        return True
-    if c == '|':
-        return True
-    if c == ']':
-        return True
-    if c == '=':
-        return True
-    return False
+    return c in SPECIAL_CHARS
+
+def parse_command_token_at(text, pos):
+    # type: (str, int) -> Tuple[int, str]
+    """Parse a command token and return the index of the remainder and it"""
+    l = len(text)
+    i = pos
+    while i < l and text[i] not in SPECIAL_CHARS:
+        i = i + 1
+    # Tokens must consist of at least two characters unless they are followed
+    # by a special character
+    if i == pos or (i == l and i - pos == 1):
+        return None, None
+    return i, text[pos:i]
 
 def parse_command_token(command):
     # type: (str) -> Tuple[str, str]
     """Parse a command token and return it and and the remainder"""
-    for i, c in enumerate(command):
-        if is_special(c):
-            break
-    if i==0:
+    pos, token = parse_command_token_at(command, 0)
+    if pos is None:
         return None, None
+    return command[pos:], token
 
-    if not is_special(c):
-        i = i + 1
-    return command[i:], command[:i]
-
-def parse_command(command):
-    # type: (str) -> Tuple[str, Command]
-    rem, command_tk = parse_command_token(command)
-    if rem is None:
+def parse_command_at(text, pos):
+    # type: (str, int) -> Tuple[int, Command]
+    pos, command_tk = parse_command_token_at(text, pos)
+    if pos is None:
         return None, None
 
+    l = len(text)
     arg = None # type: str
     carg = None # type: str # direct command argument
     options = [] # type: List[Union[Optional, Arg]]
     subcommand = None # type: Command
 
-    while rem is not None and len(rem) != 0:
-        if rem[0] == '=' and arg is None:
+    while pos is not None and pos < l:
+        if text[pos] == '=' and arg is None:
             # Try comment arg
-            new_rem, carg = parse_arg(rem[1:])
-            if new_rem is not None:
-                rem = new_rem
+            new_pos, carg = parse_arg_at(text, pos + 1)
+            if new_pos is not None:
+                pos = new_pos
                 continue
-        rem = skip_spaces(rem)
-        if rem is None:
-            break
+        pos = skip_spaces_at(text, pos)
 
         # Try arg first
-        new_rem, arg = parse_arg(rem)
-        if new_rem is not None:
+        new_pos, arg = parse_arg_at(text, pos)
+        if new_pos is not None:
             options.append(Arg(arg))
 
-        if new_rem is None:
+        if new_pos is None:
             # Try command next
-            new_rem, subcommand = parse_command(rem)
-            if new_rem is not None:
-                rem = new_rem
-                #rem = ""
+            new_pos, subcommand = parse_command_at(text, pos)
+            if new_pos is not None:
+                pos = new_pos
                 break
 
         # Then optional
-        if new_rem is None:
-            new_rem, optional = parse_optional(rem)
-            if new_rem is not None:
+        if new_pos is None:
+            new_pos, optional = parse_optional_at(text, pos)
+            if new_pos is not None:
                 options.append(optional)
 
-        rem = new_rem
+        pos = new_pos
+
+    return pos, Command(command_tk, options, subcommand, carg)
+
+def parse_command(command):
+    # type: (str) -> Tuple[str, Command]
+    pos, c = parse_command_at(command, 0)
+    return (command[pos:] if pos is not None else None), c
 
-    return rem, Command(command_tk, options, subcommand, carg)
+def parse_arg_at(text, pos):
+    # type: (str, int) -> Tuple[int, str]
+    if len(text) - pos < 3:
+        return None, None
+    if text[pos] != '<':
+        return None, None
+    end = text.find('>', pos + 1)
+    if end < 0:
+        return None, None
+    return end + 1, text[pos + 1:end]
 
 def parse_arg(arg):
     # type: (str) -> Tuple[str, str]
-    is_arg = False
-    if len(arg) < 3:
+    pos, name = parse_arg_at(arg, 0)
+    if pos is None:
         return None, None
-    if arg[0] != '<':
+    return arg[pos:], name
+
+def parse_command_with_arg_at(text, pos):
+    # type: (str, int)->Tuple[int, OptionWithArg]
+    pos, command = parse_command_token_at(text, pos)
+    if pos is None:
         return None, None
-    rem = arg[1:]
-    for i, c in enumerate(rem):
-        if c == '>':
-            is_arg = True
-            break;
-    if not is_arg:
+    pos = skip_spaces_at(text, pos)
+    pos, arg = parse_arg_at(text, pos)
+    if pos is None:
         return None, None
-    return rem[i+1:], rem[:i]
+    return pos, OptionWithArg(command, arg)
 
 def parse_command_with_arg(command_with_arg):
     # type: (str)->Tuple[str, OptionWithArg]
-    rem, command = parse_command_token(command_with_arg)
-    if rem == None:
-        return None, None
-    rem = skip_spaces(rem)
-    if rem == None:
-        return None, None
-    rem, arg = parse_arg(rem)
-    if rem == None:
+    pos, o = parse_command_with_arg_at(command_with_arg, 0)
+    if pos is None:
         return None, None
-    return rem, OptionWithArg(command, arg)
+    return command_with_arg[pos:], o
 
 def combine(first,second):
     # type: (List[str],List[str])->List[str]
@@ -223,99 +263,138 @@ def expand(token):
     return combine(l, expanded)
 
 
-def parse_shorted_options(option):
-    # type: (str)->Tuple[str, List[str]]
+def parse_shorted_options_at(text, pos):
+    # type: (str, int)->Tuple[int, List[str]]
     """
     Parses a shorted option token that really is a mutual exlusive set of
-    options, e.g., --[no]-option. This call will already expand the argument,
-    i.e., it will return two options: --option and --no-option.
+    options, e.g., --[no]-option, starting at the given position. This call
+    will already expand the argument, i.e., it will return two options:
+    --option and --no-option.
 
     Parameters
     ----------
-    option : the string to parse
+    text : the string to parse
+    pos : the position at which the option starts
 
     Returns
     -------
-    rem, list
-        a tuple of the remainder (not consumed part) of the string and a list
-        of parsed options (OptionWithArg).
+    pos, list
+        a tuple of the index of the remainder (not consumed part) of the
+        string and a list of parsed options (OptionWithArg).
         None, None on a failure
     """
     level = 0 # Type: int
-    variants = 1 # Type: int
-    last_pos = 0 # Type: int
+    last_pos = pos # Type: int
     token = [] # Type: List[Tuple[int,str]]
-    for i in range(0,len(option)):
-        if option[i] == '[':
-            token.append((0, option[last_pos:i]))
+    l = len(text)
+    i = pos
+    while i < l:
+        c = text[i]
+        if c == '[':
+            token.append((0, text[last_pos:i]))
             level = level + 1
-            variants = variants + 1
             last_pos = i + 1
-        if option[i] == '|':
+        elif c == '|':
             return None,None
-        if option[i] == ']':
-            token.append((level, option[last_pos:i]))
+        elif c == ']':
+            token.append((level, text[last_pos:i]))
             if level == 0:
                 break
             level = level - 1
             last_pos = i + 1
+        i = i + 1
+    else:
+        # Not terminated, the remainder is the last character
+        i = l - 1
 
     options = expand(token)
     if options is None:
         return None, None
-    return option[i:], options
+    return i, options
 
-def parse_optional(optional):
-    # type: (str)->Tuple[str,Optional]
-    if optional[0] != '[': return None, None
-    rem = optional[1:]
+def parse_shorted_options(option):
+    # type: (str)->Tuple[str, List[str]]
+    """
+    Parses a shorted option token that really is a mutual exlusive set of
+    options, e.g., --[no]-option. This call will already expand the argument,
+    i.e., it will return two options: --option and --no-option.
+
+    Parameters
+    ----------
+    option : the string to parse
+
+    Returns
+    -------
+    rem, list
+        a tuple of the remainder (not consumed part) of the string and a list
+        of parsed options (OptionWithArg).
+        None, None on a failure
+    """
+    pos, options = parse_shorted_options_at(option, 0)
+    if pos is None:
+        return None, None
+    return option[pos:], options
+
+def parse_optional_at(text, pos):
+    # type: (str, int)->Tuple[int,Optional]
+    if text[pos] != '[': return None, None
+    pos = pos + 1
     l = [] # type: List[Union[Arg, OptionWithArg]]
-    while len(rem) > 0 and rem[0] != ']':
+    while pos < len(text) and text[pos] != ']':
         elm = None # type: Union[Arg, OptionWithArg]
-        new_rem, elm = parse_command_with_arg(rem)
+        new_pos, elm = parse_command_with_arg_at(text, pos)
 
-        if new_rem is None:
-            new_rem, arg = parse_arg(rem)
-            if new_rem is not None:
+        if new_pos is None:
+            new_pos, arg = parse_arg_at(text, pos)
+            if new_pos is not None:
                 varargs = False
-                if new_rem.startswith('...'):
+                if text.startswith('...', new_pos):
                     varargs = True
                     # skip three dots
-                    new_rem = new_rem[3:]
+                    new_pos = new_pos + 3
                 elm = Arg(arg, varargs)
-        if new_rem is None:
-            new_rem, options = parse_shorted_options(rem)
-            if new_rem is not None:
+        if new_pos is None:
+            new_pos, options = parse_shorted_options_at(text, pos)
+            if new_pos is not None:
                 for o in options[1:]:
                     l.append(OptionWithArg(o, None))
                 elm = OptionWithArg(options[0], None)
-        if new_rem is None:
-            new_rem, command = parse_command_token(rem)
+        if new_pos is None:
+            new_pos, command = parse_command_token_at(text, pos)
             elm = OptionWithArg(command, None)
-        if new_rem is None: return None, None
-        rem = new_rem
+        # Fail rather than loop if nothing was consumed, e.g., at the end of
+        # an unterminated shorted option
+        if new_pos is None or new_pos == pos: return None, None
+        pos = new_pos
         l.append(elm)
 
-        rem = skip_spaces(rem)
-        if rem[0] == '|':
-            rem = skip_spaces(rem[1:])
-    if rem[0] != ']': return None, None
-    return rem[1:], Optional(l)
+        pos = skip_spaces_at(text, pos)
+        if text[pos] == '|':
+            pos = skip_spaces_at(text, pos + 1)
+    if text[pos] != ']': return None, None
+    return pos + 1, Optional(l)
+
+def parse_optional(optional):
+    # type: (str)->Tuple[str,Optional]
+    pos, o = parse_optional_at(optional, 0)
+    if pos is None:
+        return None, None
+    return optional[pos:], o
 
 def parse_pattern(pattern):
     # type: (str) -> Pattern
-    rem = pattern
+    pos = 0 # type: int
     l = [] # type: List[Command]
-    while rem is not None and len(rem) != 0:
-        rem = skip_spaces(rem)
-        next_rem, command = parse_command(rem)
-        if next_rem is not None:
+    while pos is not None and pos < len(pattern):
+        pos = skip_spaces_at(pattern, pos)
+        next_pos, command = parse_command_at(pattern, pos)
+        if next_pos is not None:
             l.append(command)
         else:
-            next_rem, optional = parse_optional(rem)
+            next_pos, optional = parse_optional_at(pattern, pos)
             command = Command("", [optional], None)
             l.append(command)
-        if next_rem is None:
+        if next_pos is None:
             return None
-        rem = next_rem
+        pos = next_pos
     return Pattern(l)
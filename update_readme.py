@@ -15,7 +15,7 @@ with open('ReadMe.md', 'r') as f:
 with open('sync_cli.c', 'r') as f:
     sync_cli = f.read()
 
-m = re.search(r"(.*```c)(.*)(```.*)", readme, re.DOTALL | re.MULTILINE)
+m = re.search(r"(.*?```c)(\n.*?)(```.*)", readme, re.DOTALL | re.MULTILINE)
 if m is None:
     sys.exit("ReadMe.md didn't follow assumed format")
 